@@ -1,16 +1,34 @@
+import time
+STARTUP_STARTED = time.perf_counter()
+
 import asyncio
 import aiohttp
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, time as dt_time
 import os
 import json
 import sys
 import re
+import html
 import random
+import importlib.util
+import threading
+import math
+import struct
+import zlib
+import operator
+import statistics
+import heapq
+import bisect
+import multiprocessing
+import signal
+from array import array
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
 from dotenv import load_dotenv
 from aiohttp import web
 from zoneinfo import ZoneInfo
-from collections import Counter
+from collections import Counter, OrderedDict, deque
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -20,21 +38,78 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 logger.info("🚀 Бот запускается...")
 
-# Проверяем наличие yfinance
-try:
-    import yfinance as yf
-    YFINANCE_AVAILABLE = True
-    logger.info("✅ yfinance доступен")
-except ImportError:
-    YFINANCE_AVAILABLE = False
+# Замеры времени старта по этапам
+startup_timings = []
+_startup_mark = STARTUP_STARTED
+
+def mark_startup(phase):
+    """Запоминает длительность этапа старта (с предыдущей отметки)"""
+    global _startup_mark
+    now = time.perf_counter()
+    startup_timings.append((phase, now - _startup_mark))
+    _startup_mark = now
+
+def log_startup_timings():
+    """Пишет в лог разбивку времени старта"""
+    parts = ", ".join(f"{phase} {elapsed * 1000:.0f} мс" for phase, elapsed in startup_timings)
+    total = (time.perf_counter() - STARTUP_STARTED) * 1000
+    logger.info(f"⏱️ Старт за {total:.0f} мс: {parts}")
+
+mark_startup("импорт модулей")
+
+# yfinance (а с ним pandas и numpy) грузим в фоне уже после старта веб-сервера
+YFINANCE_AVAILABLE = importlib.util.find_spec('yfinance') is not None
+yf = None
+if YFINANCE_AVAILABLE:
+    logger.info("✅ yfinance доступен (загрузится в фоне)")
+else:
     logger.warning("⚠️ yfinance не установлен, индексы будут через другие источники")
 
+def load_yfinance():
+    """Импортирует yfinance; до окончания загрузки индексы и нефть берутся из кэша"""
+    global yf
+    if yf is not None or not YFINANCE_AVAILABLE:
+        return
+    started = time.perf_counter()
+    try:
+        import yfinance
+        yf = yfinance
+        logger.info(f"✅ yfinance загружен в фоне за {(time.perf_counter() - started) * 1000:.0f} мс")
+    except Exception as e:
+        logger.warning(f"⚠️ yfinance не загрузился: {e}")
+
+def start_background_imports():
+    """Запускает тяжёлые импорты провайдеров в отдельном потоке"""
+    if YFINANCE_AVAILABLE and yf is None:
+        threading.Thread(target=load_yfinance, name='background-imports', daemon=True).start()
+
+# matplotlib нужен только для графиков и импортируется внутри процесса-рендерера
+MATPLOTLIB_AVAILABLE = importlib.util.find_spec('matplotlib') is not None
+if not MATPLOTLIB_AVAILABLE:
+    logger.warning("⚠️ matplotlib не установлен, графики недоступны")
+
 # Конфигурация Telegram
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 
 # API ключи
 TWELVEDATA_KEY = os.getenv('TWELVEDATA_KEY')
 
+# Бюджет кредитов Twelve Data (бесплатный тариф: 800 в сутки, 8 в минуту)
+TWELVEDATA_DAILY_CREDITS = int(os.getenv('TWELVEDATA_DAILY_CREDITS', 800))
+TWELVEDATA_MINUTE_CREDITS = int(os.getenv('TWELVEDATA_MINUTE_CREDITS', 8))
+TWELVEDATA_OFFHOURS_SHARE = 0.1      # доля суточного бюджета на время закрытого рынка
+TWELVEDATA_RESERVE = 2               # кредиты, которые держим для инструментов с близкими алертами
+TWELVEDATA_NEAR_ALERT = 0.01         # алерт ближе 1% от цены — высокий приоритет
+# Как часто обновлять инструмент: алерт рядом / есть алерты / без алертов (секунды)
+TWELVEDATA_REFRESH = {'near': 10, 'alerts': 60, 'idle': 900}
+# Торговая сессия CBOT (по ней распределяем бюджет)
+TWELVEDATA_MARKET = {'tz': 'America/Chicago', 'open': (8, 30), 'close': (13, 20), 'days': (0, 1, 2, 3, 4)}
+
+# Инструменты, которые берём из Twelve Data (запрашиваются одним пакетом)
+TWELVEDATA_SYMBOLS = {
+    'CORN/USD': 'ZC',
+}
+
 # ===== НАСТРОЙКА ДОСТУПА =====
 ALLOWED_USER_IDS = [
     5799391012,  # ТВОЙ ID
@@ -49,10 +124,77 @@ if len(sys.argv) > 1:
 else:
     PRIVATE_MODE = (DEFAULT_MODE == "private")
 
+# Раздельный режим: отдельный процесс получает курсы и публикует их в общую память
+SPLIT_MODE = os.getenv('SPLIT_MODE', '0') == '1'
+RATES_SHM_NAME = os.getenv('RATES_SHM_NAME', 'currency_bot_rates')
+DEMAND_SHM_NAME = f"{RATES_SHM_NAME}_demand"
+FETCH_INTERVAL = 10
+
+# Шардирование пользователей по процессам (включает раздельный режим)
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', 0))
+
 # Файлы для хранения данных
 USER_ALERTS_FILE = "user_alerts.json"
 STATS_FILE = "user_stats.json"
 
+# Сводная статистика: размер топов и сколько последних пар помним на пользователя
+STATS_TOP_K = 5
+PAIR_HISTORY = 50
+
+# Снимок рабочего состояния для тёплого перезапуска
+RUNTIME_SNAPSHOT_FILE = os.getenv('RUNTIME_SNAPSHOT_FILE', "runtime_snapshot.json")
+SNAPSHOT_INTERVAL = 30
+
+# Пул исходящих HTTP-соединений
+HTTP_POOL_LIMIT = int(os.getenv('HTTP_POOL_LIMIT', 100))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv('HTTP_POOL_LIMIT_PER_HOST', 10))
+HTTP_DNS_CACHE_TTL = 300
+HTTP_KEEPALIVE_TIMEOUT = 60
+
+# Профили таймаутов по провайдерам
+HTTP_TIMEOUTS = {
+    'default': aiohttp.ClientTimeout(total=10, connect=5),
+    'binance': aiohttp.ClientTimeout(total=5, connect=3),
+    'fiat': aiohttp.ClientTimeout(total=5, connect=3),
+    'gold': aiohttp.ClientTimeout(total=10, connect=5),
+    'quotes': aiohttp.ClientTimeout(total=6, connect=3),
+    'twelvedata': aiohttp.ClientTimeout(total=10, connect=5),
+    'telegram': aiohttp.ClientTimeout(total=15, connect=5),
+    'telegram_poll': aiohttp.ClientTimeout(total=10, connect=5),
+    'ping': aiohttp.ClientTimeout(total=30, connect=10),
+}
+
+# Консенсус котировок: медиана нескольких источников
+CONSENSUS_QUORUM = 2
+CONSENSUS_OUTLIER = 0.02      # отклонение от медианы, после которого источник отбрасывается
+CONSENSUS_TIMEOUT = 8         # общий дедлайн опроса источников, секунды
+CONSENSUS_CONFIG = {
+    'XAU/USD': {'sources': ('gold_api', 'binance_paxg', 'yahoo', 'stooq'), 'bounds': (1000, 10000), 'max_age': 3600},
+    'XAG/USD': {'sources': ('gold_api', 'yahoo', 'stooq'), 'bounds': (10, 100), 'max_age': 3600},
+    'XPT/USD': {'sources': ('gold_api', 'yahoo', 'stooq'), 'bounds': (500, 5000), 'max_age': 3600},
+    # Индексы в выходные стоят на цене закрытия, поэтому допускаем старые метки
+    'S&P 500': {'sources': ('yfinance', 'yahoo', 'stooq'), 'bounds': None, 'max_age': 4 * 86400},
+    'NASDAQ': {'sources': ('yfinance', 'yahoo', 'stooq'), 'bounds': None, 'max_age': 4 * 86400},
+}
+
+# Символы инструментов у источников
+GOLD_API_SYMBOLS = {'XAU/USD': 'XAU', 'XAG/USD': 'XAG', 'XPT/USD': 'XPT'}
+YAHOO_SYMBOLS = {'XAU/USD': 'GC=F', 'XAG/USD': 'SI=F', 'XPT/USD': 'PL=F', 'S&P 500': 'SPY', 'NASDAQ': 'QQQ'}
+STOOQ_SYMBOLS = {'XAU/USD': 'xauusd', 'XAG/USD': 'xagusd', 'XPT/USD': 'xptusd', 'S&P 500': 'spy.us', 'NASDAQ': 'qqq.us'}
+
+# Хедж-запросы: дубль уходит, если ответа нет дольше наблюдаемого p90
+HEDGE_BUDGET = 0.05           # доля запросов, которую разрешено продублировать
+HEDGE_BURST = 3               # запас хеджей для редких провайдеров
+HEDGE_MIN_DELAY = 0.05
+HEDGE_DEFAULT_DELAY = 1.5     # пока мало замеров задержки
+HEDGE_MIN_SAMPLES = 20
+
+# Настройки графиков
+CHART_WORKERS = int(os.getenv('CHART_WORKERS', 1))
+CHART_CACHE_SIZE = 256
+CHART_DEFAULT_TIMEFRAME = '5m'
+CHART_MAX_CANDLES = 120
+
 # Словарь для конвертации цифр в эмодзи
 DIGIT_TO_EMOJI = {
     '0': '0️⃣',
@@ -197,25 +339,590 @@ def get_seasonal_slogan():
     
     return random.choice(all_slogans)
 
+class Alert:
+    """Ценовой алерт пользователя
+    
+    Виды: target — цель по цене, trailing — откат на percent % от пика
+    с момента создания, band — выход цены из диапазона low–high.
+    """
+    
+    __slots__ = ('id', 'user_id', 'pair', 'target', 'active', 'kind', 'low', 'high', 'percent', 'peak')
+    
+    def __init__(self, alert_id, user_id, pair, target=None, active=True,
+                 kind='target', low=None, high=None, percent=None, peak=None):
+        self.id = alert_id
+        self.user_id = user_id
+        self.pair = pair
+        self.target = target
+        self.active = active
+        self.kind = kind
+        self.low = low
+        self.high = high
+        self.percent = percent
+        self.peak = peak
+    
+    def label(self):
+        """Короткое описание для списков и кнопок"""
+        if self.kind == 'trailing':
+            return f"📉 −{self.percent:g}% от пика"
+        if self.kind == 'band':
+            return f"↔️ {self.low:g}–{self.high:g}"
+        return f"🎯 {self.target}"
+    
+    def to_dict(self):
+        data = {'id': self.id, 'pair': self.pair, 'active': self.active}
+        if self.kind == 'trailing':
+            data.update(kind='trailing', percent=self.percent, peak=self.peak)
+        elif self.kind == 'band':
+            data.update(kind='band', low=self.low, high=self.high)
+        else:
+            data['target'] = self.target
+        return data
+
+class TrailBucket:
+    """Трейлинг-алерты с общим пиком: куча (percent, id, alert) и текущий уровень срабатывания"""
+    
+    __slots__ = ('peak', 'heap', 'level', 'alive')
+    
+    def __init__(self, peak, heap):
+        self.peak = peak
+        self.heap = heap
+        self.level = None   # уровень, под которым корзина лежит в куче уровней
+        self.alive = True
+
+class TrailingBook:
+    """Трейлинг-алерты одной пары, сгруппированные в корзины с общим пиком
+    
+    Пик алерта — максимум цены с момента его создания. Новая цена поднимает
+    до себя все пики ниже неё, поэтому такие корзины сливаются в одну
+    (меньшие кучи вливаются в большую). Корзины хранятся по убыванию пика,
+    и слияние всегда затрагивает хвост списка. В каждой корзине куча по
+    проценту: сработавшие алерты лежат сверху.
+    
+    Уровень корзины — пик × (1 − минимальный процент / 100), цена ниже него
+    означает срабатывание. Корзины лежат в куче по уровню (с ленивым удалением
+    устаревших записей), поэтому тик посещает только сработавшие корзины,
+    а не все: алерты, созданные на падающей цене, дают по корзине на каждый.
+    """
+    
+    def __init__(self):
+        self.keys = []      # -пик, по возрастанию (т.е. пики по убыванию)
+        self.buckets = []   # параллельно: TrailBucket (опустевшие убираются пачкой)
+        self.dead = 0
+        self.levels = []    # куча (-уровень, номер, корзина): сверху самый высокий уровень
+        self.pushed = 0
+        self.stale = 0      # удалённые алерты, ещё лежащие в кучах
+        self.size = 0
+    
+    def _relevel(self, bucket):
+        """Ставит корзину в кучу уровней по её текущему минимальному проценту"""
+        level = bucket.peak * (1 - bucket.heap[0][0] / 100)
+        if level != bucket.level:
+            bucket.level = level
+            self.pushed += 1
+            heapq.heappush(self.levels, (-level, self.pushed, bucket))
+            if len(self.levels) > 2 * len(self.buckets) + 64:
+                self._rebuild_levels()
+    
+    def _rebuild_levels(self):
+        self.levels = [(-bucket.level, i, bucket) for i, bucket in enumerate(self.buckets) if bucket.alive]
+        heapq.heapify(self.levels)
+        self.pushed = len(self.levels)
+    
+    def _drop_bucket(self, bucket):
+        # Удаление из середины списка стоит O(n) — при массовом срабатывании
+        # это квадрат, поэтому только помечаем и чистим список пачкой
+        bucket.alive = False
+        self.dead += 1
+        if self.dead > max(64, len(self.buckets) // 2):
+            alive = [(key, bucket) for key, bucket in zip(self.keys, self.buckets) if bucket.alive]
+            self.keys = [key for key, _ in alive]
+            self.buckets = [bucket for _, bucket in alive]
+            self.dead = 0
+    
+    def add(self, alert):
+        key = -alert.peak
+        i = bisect.bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key and self.buckets[i].alive:
+            bucket = self.buckets[i]
+            heapq.heappush(bucket.heap, (alert.percent, alert.id, alert))
+        elif i < len(self.keys) and self.keys[i] == key:
+            # На месте опустевшей корзины с тем же пиком заводим новую
+            self.dead -= 1
+            bucket = TrailBucket(alert.peak, [(alert.percent, alert.id, alert)])
+            self.buckets[i] = bucket
+        else:
+            bucket = TrailBucket(alert.peak, [(alert.percent, alert.id, alert)])
+            self.keys.insert(i, key)
+            self.buckets.insert(i, bucket)
+        self.size += 1
+        self._relevel(bucket)
+    
+    def raise_peaks(self, price):
+        """Поднимает пики ниже price; возвращает True, если что-то изменилось"""
+        start = bisect.bisect_left(self.keys, -price)
+        if start == len(self.keys) or (start == len(self.keys) - 1 and self.keys[start] == -price):
+            return False
+        self.dead -= sum(1 for bucket in self.buckets[start:] if not bucket.alive)
+        tail = [bucket for bucket in self.buckets[start:] if bucket.alive]
+        del self.keys[start:], self.buckets[start:]
+        if not tail:
+            return False
+        merged = max(tail, key=lambda bucket: len(bucket.heap))
+        for bucket in tail:
+            if bucket is not merged:
+                for item in bucket.heap:
+                    heapq.heappush(merged.heap, item)
+                bucket.alive = False
+        merged.peak = price
+        self.keys.append(-price)
+        self.buckets.append(merged)
+        self._relevel(merged)
+        return True
+    
+    def _top(self):
+        """Корзина с самым высоким уровнем (сняв устаревшие записи и удалённые алерты) или None"""
+        levels = self.levels
+        while levels:
+            _, _, bucket = levels[0]
+            if not bucket.alive or -levels[0][0] != bucket.level:
+                heapq.heappop(levels)
+                continue
+            heap = bucket.heap
+            if heap and heap[0][2].active:
+                return bucket
+            while heap and not heap[0][2].active:
+                heapq.heappop(heap)
+                self.size -= 1
+                self.stale -= 1
+            heapq.heappop(levels)
+            if heap:
+                bucket.level = None
+                self._relevel(bucket)
+            else:
+                self._drop_bucket(bucket)
+        return None
+    
+    def pop_triggered(self, price):
+        triggered = []
+        while True:
+            bucket = self._top()
+            if bucket is None or bucket.level < price:
+                return triggered
+            # Откат от пика этой корзины в процентах
+            drawdown = (1 - price / bucket.peak) * 100
+            heap = bucket.heap
+            if heap[0][0] > drawdown:
+                # Уровень и откат разошлись на округлении — ждём следующей цены
+                return triggered
+            while heap and (not heap[0][2].active or heap[0][0] <= drawdown):
+                _, _, alert = heapq.heappop(heap)
+                self.size -= 1
+                if alert.active:
+                    alert.peak = bucket.peak
+                    triggered.append(alert)
+                else:
+                    self.stale -= 1
+            heapq.heappop(self.levels)
+            if heap:
+                bucket.level = None
+                self._relevel(bucket)
+            else:
+                self._drop_bucket(bucket)
+    
+    def nearest_trigger(self):
+        """Самая высокая цена срабатывания среди корзин (ближайшая снизу к текущей) или None"""
+        bucket = self._top()
+        return bucket.level if bucket is not None else None
+    
+    def discard(self, alert):
+        self.stale += 1
+        if self.stale > max(64, self.size // 2):
+            self.compact()
+    
+    def compact(self):
+        alive = []
+        for key, bucket in zip(self.keys, self.buckets):
+            if not bucket.alive:
+                continue
+            bucket.heap = [item for item in bucket.heap if item[2].active]
+            if bucket.heap:
+                heapq.heapify(bucket.heap)
+                bucket.level = bucket.peak * (1 - bucket.heap[0][0] / 100)
+                alive.append((key, bucket))
+            else:
+                bucket.alive = False
+        self.keys = [key for key, _ in alive]
+        self.buckets = [bucket for _, bucket in alive]
+        self.size = sum(len(bucket.heap) for bucket in self.buckets)
+        self.stale = 0
+        self.dead = 0
+        self._rebuild_levels()
+    
+    def sync_peaks(self):
+        """Записывает текущие пики корзин в сами алерты (перед сохранением)"""
+        for bucket in self.buckets:
+            if bucket.alive:
+                for _, _, alert in bucket.heap:
+                    alert.peak = bucket.peak
+
+class BandBook:
+    """Алерты-диапазоны одной пары, индексированные по границам
+    
+    Нижние границы отсортированы по возрастанию, верхние — тоже. Выход вниз —
+    это хвост списка нижних границ выше цены, выход вверх — голова списка
+    верхних границ ниже цены; оба находятся бинарным поиском.
+    """
+    
+    def __init__(self):
+        self.low_keys, self.low_alerts = [], []
+        self.high_keys, self.high_alerts = [], []
+        self.stale = 0
+    
+    def add(self, alert):
+        i = bisect.bisect_right(self.low_keys, alert.low)
+        self.low_keys.insert(i, alert.low)
+        self.low_alerts.insert(i, alert)
+        j = bisect.bisect_right(self.high_keys, alert.high)
+        self.high_keys.insert(j, alert.high)
+        self.high_alerts.insert(j, alert)
+    
+    def pop_triggered(self, price):
+        i = bisect.bisect_right(self.low_keys, price)
+        j = bisect.bisect_left(self.high_keys, price)
+        if i == len(self.low_keys) and j == 0:
+            return []
+        
+        crossed = self.low_alerts[i:] + self.high_alerts[:j]
+        del self.low_keys[i:], self.low_alerts[i:]
+        del self.high_keys[:j], self.high_alerts[:j]
+        
+        triggered = []
+        for alert in crossed:
+            if alert.active:
+                triggered.append(alert)
+                # Вторая граница этого алерта остаётся в другом списке
+                self.stale += 1
+            else:
+                self.stale -= 1
+        self.maybe_compact()
+        return triggered
+    
+    def nearest_gap(self, price):
+        """Расстояние от цены до ближайшей живой границы или None"""
+        gaps = []
+        for keys, alerts in ((self.low_keys, self.low_alerts), (self.high_keys, self.high_alerts)):
+            i = bisect.bisect_left(keys, price)
+            # Ближайшие соседи цены с каждой стороны, пропуская удалённые алерты
+            below = i - 1
+            while below >= 0 and not alerts[below].active:
+                below -= 1
+            above = i
+            while above < len(keys) and not alerts[above].active:
+                above += 1
+            if below >= 0:
+                gaps.append(price - keys[below])
+            if above < len(keys):
+                gaps.append(keys[above] - price)
+        return min(gaps) if gaps else None
+    
+    def discard(self, alert):
+        self.stale += 2
+        self.maybe_compact()
+    
+    def maybe_compact(self):
+        if self.stale > max(64, len(self.low_keys) // 2):
+            lows = [(key, alert) for key, alert in zip(self.low_keys, self.low_alerts) if alert.active]
+            highs = [(key, alert) for key, alert in zip(self.high_keys, self.high_alerts) if alert.active]
+            self.low_keys, self.low_alerts = [k for k, _ in lows], [a for _, a in lows]
+            self.high_keys, self.high_alerts = [k for k, _ in highs], [a for _, a in highs]
+            self.stale = 0
+
+class AlertWatchIndex:
+    """Трейлинг- и диапазонные алерты по парам; проверка пары не зависит от числа алертов"""
+    
+    def __init__(self):
+        self.trailing = {}   # pair -> TrailingBook
+        self.bands = {}      # pair -> BandBook
+        self.dirty = False   # пики поднялись с последнего сохранения
+    
+    def add(self, alert):
+        if alert.kind == 'trailing':
+            self.trailing.setdefault(alert.pair, TrailingBook()).add(alert)
+        elif alert.kind == 'band':
+            self.bands.setdefault(alert.pair, BandBook()).add(alert)
+    
+    def discard(self, alert):
+        books = self.trailing if alert.kind == 'trailing' else self.bands
+        book = books.get(alert.pair)
+        if book is not None:
+            book.discard(alert)
+    
+    def pairs(self):
+        return self.trailing.keys() | self.bands.keys()
+    
+    def nearest_gap(self, pair, price):
+        """Абсолютное расстояние от цены до ближайшего уровня срабатывания по паре или None"""
+        gaps = []
+        book = self.trailing.get(pair)
+        if book is not None:
+            level = book.nearest_trigger()
+            if level is not None:
+                gaps.append(abs(price - level))
+        book = self.bands.get(pair)
+        if book is not None:
+            gap = book.nearest_gap(price)
+            if gap is not None:
+                gaps.append(gap)
+        return min(gaps) if gaps else None
+    
+    def update(self, pair, price):
+        """Обновляет экстремумы по новой цене и возвращает сработавшие алерты"""
+        triggered = []
+        book = self.trailing.get(pair)
+        if book is not None:
+            if book.raise_peaks(price):
+                self.dirty = True
+            triggered.extend(book.pop_triggered(price))
+        book = self.bands.get(pair)
+        if book is not None:
+            triggered.extend(book.pop_triggered(price))
+        return triggered
+    
+    def sync_peaks(self):
+        for book in self.trailing.values():
+            book.sync_peaks()
+        self.dirty = False
+
+class AlertStore:
+    """Алерты с постоянными ID: индекс по пользователю и общий индекс id → алерт"""
+    
+    def __init__(self):
+        self.by_user = {}   # user_id -> {alert_id: Alert} (в порядке создания)
+        self.by_id = {}     # alert_id -> Alert
+        self.targets = {}   # alert_id -> Alert, только ценовые цели (их проверяем перебором)
+        self.target_levels = {}   # pair -> отсортированные цели активных алертов
+        self.watch = AlertWatchIndex()
+        self.pair_refs = {}   # pair -> число алертов (любых), чтобы не перебирать все при расчёте кроссов
+        self.next_id = 1
+    
+    def __len__(self):
+        return len(self.by_id)
+    
+    def __contains__(self, user_id):
+        return bool(self.by_user.get(user_id))
+    
+    def add(self, user_id, pair, target=None, active=True, alert_id=None,
+            kind='target', low=None, high=None, percent=None, peak=None):
+        if alert_id is None or alert_id in self.by_id:
+            alert_id = self.next_id
+        self.next_id = max(self.next_id, alert_id + 1)
+        
+        alert = Alert(alert_id, user_id, pair, float(target) if target is not None else None, active,
+                      kind, low, high, percent, peak)
+        self.by_user.setdefault(user_id, {})[alert_id] = alert
+        self.by_id[alert_id] = alert
+        self.pair_refs[pair] = self.pair_refs.get(pair, 0) + 1
+        if active:
+            if kind == 'target':
+                self.targets[alert_id] = alert
+                bisect.insort(self.target_levels.setdefault(pair, []), alert.target)
+            else:
+                self.watch.add(alert)
+        return alert
+    
+    def get(self, alert_id):
+        return self.by_id.get(alert_id)
+    
+    def deactivate(self, alert):
+        """Помечает алерт сработавшим (он остаётся в списке пользователя)"""
+        if alert.active and alert.kind == 'target':
+            self.drop_level(alert)
+        alert.active = False
+        self.targets.pop(alert.id, None)
+    
+    def drop_level(self, alert):
+        levels = self.target_levels[alert.pair]
+        del levels[bisect.bisect_left(levels, alert.target)]
+        if not levels:
+            del self.target_levels[alert.pair]
+    
+    def remove(self, alert_id, user_id=None):
+        """Удаляет алерт по ID; с user_id — только если алерт принадлежит этому пользователю"""
+        alert = self.by_id.get(alert_id)
+        if alert is None or (user_id is not None and alert.user_id != user_id):
+            return None
+        del self.by_id[alert_id]
+        user = self.by_user[alert.user_id]
+        del user[alert_id]
+        if not user:
+            del self.by_user[alert.user_id]
+        refs = self.pair_refs[alert.pair] - 1
+        if refs:
+            self.pair_refs[alert.pair] = refs
+        else:
+            del self.pair_refs[alert.pair]
+        
+        if alert.active:
+            alert.active = False
+            if alert.kind == 'target':
+                self.targets.pop(alert_id, None)
+                self.drop_level(alert)
+            else:
+                # Из индекса границ/пиков убирается лениво
+                self.watch.discard(alert)
+        return alert
+    
+    def remove_pair(self, user_id, pair):
+        """Удаляет все активные алерты пользователя по паре, возвращает количество"""
+        ids = [alert.id for alert in self.for_user(user_id) if alert.pair == pair and alert.active]
+        for alert_id in ids:
+            self.remove(alert_id)
+        return len(ids)
+    
+    def for_user(self, user_id):
+        return list(self.by_user.get(user_id, {}).values())
+    
+    def active_for(self, user_id, pair):
+        return [alert for alert in self.by_user.get(user_id, {}).values() if alert.pair == pair and alert.active]
+    
+    def active_counts(self, user_id):
+        """Число активных алертов пользователя по парам"""
+        counts = {}
+        for alert in self.by_user.get(user_id, {}).values():
+            if alert.active:
+                counts[alert.pair] = counts.get(alert.pair, 0) + 1
+        return counts
+    
+    def items(self):
+        return ((user_id, alerts.values()) for user_id, alerts in self.by_user.items())
+    
+    def all(self):
+        return self.by_id.values()
+    
+    def pairs(self):
+        """Пары, по которым есть хотя бы один алерт"""
+        return self.pair_refs.keys()
+    
+    def nearest_distance(self, pair, price):
+        """Относительное расстояние от цены до ближайшего активного алерта пары (или None)"""
+        gaps = []
+        levels = self.target_levels.get(pair)
+        if levels:
+            i = bisect.bisect_left(levels, price)
+            gaps.extend(abs(price - levels[k]) for k in (i - 1, i) if 0 <= k < len(levels))
+        gap = self.watch.nearest_gap(pair, price)
+        if gap is not None:
+            gaps.append(gap)
+        return min(gaps) / price if gaps else None
+    
+    def to_dict(self):
+        self.watch.sync_peaks()
+        return {user_id: [alert.to_dict() for alert in alerts.values()]
+                for user_id, alerts in self.by_user.items()}
+    
+    @classmethod
+    def from_dict(cls, data):
+        store = cls()
+        for user_id, alerts in data.items():
+            for alert in alerts:
+                if not alert.get('pair'):
+                    continue
+                kind = alert.get('kind', 'target')
+                if kind == 'trailing':
+                    store.add(str(user_id), alert['pair'], active=alert.get('active', True), alert_id=alert.get('id'),
+                              kind=kind, percent=alert['percent'], peak=alert['peak'])
+                elif kind == 'band':
+                    store.add(str(user_id), alert['pair'], active=alert.get('active', True), alert_id=alert.get('id'),
+                              kind=kind, low=alert['low'], high=alert['high'])
+                else:
+                    # Старые алерты хранили цель в target_price
+                    target = alert.get('target', alert.get('target_price'))
+                    if target is None:
+                        continue
+                    store.add(str(user_id), alert['pair'], target, alert.get('active', True), alert.get('id'))
+        return store
+
 def load_user_alerts():
     """Загружает алерты"""
     if os.path.exists(USER_ALERTS_FILE):
         with open(USER_ALERTS_FILE, 'r', encoding='utf-8') as f:
-            alerts = json.load(f)
-            
-        # Конвертируем старые алерты в новый формат
-        for user_id, user_alerts in alerts.items():
-            for alert in user_alerts:
-                if 'target_price' in alert and 'target' not in alert:
-                    alert['target'] = alert['target_price']
-                    
-        return alerts
-    return {}
+            return AlertStore.from_dict(json.load(f))
+    return AlertStore()
 
 def save_user_alerts(alerts):
     """Сохраняет пользовательские алерты"""
     with open(USER_ALERTS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(alerts, f, indent=2, ensure_ascii=False)
+        json.dump(alerts.to_dict(), f, indent=2, ensure_ascii=False)
+
+class StatsAggregates:
+    """Сводная статистика, которая обновляется по событиям, а не пересчётом всего файла
+    
+    Счётчики только растут, поэтому топ-K по сообщениям поддерживается точно:
+    пользователь попадает в топ, как только обгоняет последнего в нём.
+    """
+    
+    def __init__(self, top_k=STATS_TOP_K):
+        self.top_k = top_k
+        self.users = 0
+        self.interactions = 0
+        self.alerts_created = 0
+        self.alerts_triggered = 0
+        self.pair_counts = Counter()   # по последним PAIR_HISTORY парам каждого пользователя
+        self.top_users = {}            # user_id -> карточка для /stats
+    
+    @classmethod
+    def from_stats(cls, stats):
+        aggregates = cls()
+        for user_id, data in stats.items():
+            aggregates.users += 1
+            aggregates.interactions += data.get('interactions', 0)
+            aggregates.alerts_created += data.get('alerts_created', 0)
+            aggregates.alerts_triggered += data.get('alerts_triggered', 0)
+            aggregates.pair_counts.update(data.get('pairs', []))
+            aggregates.rank(user_id, data)
+        return aggregates
+    
+    def card(self, data):
+        name = data.get('first_name', '')
+        if data.get('username'):
+            name += f" (@{data['username']})"
+        return {
+            'name': name,
+            'interactions': data.get('interactions', 0),
+            'slogan': data.get('current_slogan', '—'),
+            'pinned': len(data.get('pinned_pairs', [])),
+        }
+    
+    def rank(self, user_id, data):
+        """Обновляет карточку пользователя в топе или вставляет его, вытесняя последнего"""
+        if user_id in self.top_users:
+            self.top_users[user_id] = self.card(data)
+            return
+        if len(self.top_users) >= self.top_k:
+            last = min(self.top_users, key=lambda uid: self.top_users[uid]['interactions'])
+            if data.get('interactions', 0) <= self.top_users[last]['interactions']:
+                return
+            del self.top_users[last]
+        self.top_users[user_id] = self.card(data)
+    
+    def add_pair(self, data, pair):
+        """Добавляет пару в историю пользователя и в общий счётчик, вытесняя старые"""
+        pairs = data.setdefault('pairs', [])
+        pairs.append(pair)
+        self.pair_counts[pair] += 1
+        if len(pairs) > PAIR_HISTORY:
+            for old in pairs[:-PAIR_HISTORY]:
+                self.pair_counts[old] -= 1
+                if self.pair_counts[old] <= 0:
+                    del self.pair_counts[old]
+            del pairs[:-PAIR_HISTORY]
+    
+    def leaders(self):
+        return sorted(self.top_users.values(), key=lambda card: card['interactions'], reverse=True)
+    
+    def popular_pairs(self, n=STATS_TOP_K):
+        return self.pair_counts.most_common(n)
 
 def load_user_stats():
     """Загружает статистику пользователей"""
@@ -235,6 +942,7 @@ def update_user_stats(chat_id, username, first_name, last_name, pair=None, timez
     user_id = str(chat_id)
     
     if user_id not in stats:
+        stats_aggregates.users += 1
         stats[user_id] = {
             'first_seen': datetime.now().isoformat(),
             'username': username,
@@ -253,11 +961,10 @@ def update_user_stats(chat_id, username, first_name, last_name, pair=None, timez
     
     stats[user_id]['last_seen'] = datetime.now().isoformat()
     stats[user_id]['interactions'] += 1
+    stats_aggregates.interactions += 1
     
     if pair:
-        stats[user_id]['pairs'].append(pair)
-        if len(stats[user_id]['pairs']) > 50:
-            stats[user_id]['pairs'] = stats[user_id]['pairs'][-50:]
+        stats_aggregates.add_pair(stats[user_id], pair)
     
     if timezone:
         stats[user_id]['timezone'] = timezone
@@ -272,6 +979,7 @@ def update_user_stats(chat_id, username, first_name, last_name, pair=None, timez
     if pinned_pairs is not None:
         stats[user_id]['pinned_pairs'] = pinned_pairs
     
+    stats_aggregates.rank(user_id, stats[user_id])
     save_user_stats(stats)
     return stats[user_id]
 
@@ -316,6 +1024,7 @@ def get_user_slogan(user_id):
     if user_id in stats:
         stats[user_id]['current_slogan'] = new_slogan
         stats[user_id]['slogan_updated'] = now.isoformat()
+        stats_aggregates.rank(user_id, stats[user_id])
         save_user_stats(stats)
     else:
         # Если пользователя нет в статистике
@@ -331,10 +1040,40 @@ def get_user_pinned_pairs(user_id):
         return stats[user_id]['pinned_pairs']
     return []
 
-# Глобальные переменные
-user_alerts = load_user_alerts()
+def load_runtime_snapshot(path):
+    """Загружает снимок рабочего состояния (или None)"""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"⚠️ Снимок {path} не прочитан: {e}")
+        return None
+
+def save_runtime_snapshot(path, snapshot):
+    """Атомарно сохраняет снимок: пишем во временный файл и подменяем"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(snapshot, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+# Глобальные переменные. Алерты и сводная статистика загружаются при старте бота
+# (load_user_state), а не при импорте: spawn-процессы фетчера и рендера графиков
+# импортируют модуль заново, и файлы пользователей им не нужны
+user_alerts = AlertStore()
+stats_aggregates = StatsAggregates()
 last_notifications = {}
 
+def load_user_state():
+    """Загружает алерты и сводную статистику процесса, который обслуживает пользователей"""
+    global user_alerts, stats_aggregates
+    user_alerts = load_user_alerts()
+    stats_aggregates = StatsAggregates.from_stats(load_user_stats())
+    mark_startup("загрузка алертов")
+
 # Московский часовой пояс для внутренних логов
 MSK_TZ = ZoneInfo('Europe/Moscow')
 
@@ -359,54 +1098,1446 @@ TIMEZONES = {
     'America/Los_Angeles': {'name': 'Лос-Анджелес (UTC-8)', 'offset': -8},
 }
 
-class CurrencyMonitor:
+# Клавиатура «ОК» под уведомлениями — сериализуется один раз
+OK_KEYBOARD = {"inline_keyboard": [[{"text": "✅ ОК", "callback_data": "main_menu"}]]}
+OK_KEYBOARD_JSON = json.dumps(OK_KEYBOARD)
+
+# Шаблоны уведомлений о срабатывании: отдельное сообщение и строка пачки для каждого вида алерта
+ALERT_TEMPLATES = {
+    'target': "🎯 <b>ЦЕЛЬ ДОСТИГНУТА!</b>\n\n📊 {pair}\n🎯 Цель: {target}\n⏱️ {time}",
+    'trailing': "📉 <b>ОТКАТ ОТ ПИКА!</b>\n\n📊 {pair}\n🏔 Пик: {peak}\n📉 Откат: {percent}%\n💰 Цена: {price}\n⏱️ {time}",
+    'band': "↔️ <b>ЦЕНА ВЫШЛА ИЗ ДИАПАЗОНА!</b>\n\n📊 {pair}\n↔️ Диапазон: {low}–{high}\n💰 Цена: {price}\n⏱️ {time}",
+}
+ALERT_LINE_TEMPLATES = {
+    'target': "📊 {pair} — 🎯 {target}",
+    'trailing': "📊 {pair} — 📉 −{percent}% от пика {peak} → {price}",
+    'band': "📊 {pair} — ↔️ вне {low}–{high} → {price}",
+}
+
+ALERT_BATCH_TEMPLATE = "🔔 <b>СРАБОТАЛО АЛЕРТОВ: {count}</b>\n\n{lines}\n\n⏱️ {time}"
+ALERT_DIGEST_TEMPLATE = "📬 <b>Дайджест алертов: {count}</b>\n\n{lines}\n\n⏱️ {time}"
+
+def alert_fields(fields):
+    """Поля срабатывания для шаблона; в старых снимках вместо них лежала строка цели"""
+    return fields if isinstance(fields, dict) else {'kind': 'target', 'target': fields}
+
+# Сколько секунд копить срабатывания пользователя перед отправкой одного сообщения
+# (0 — объединяются только срабатывания одного тика)
+NOTIFY_COALESCE_WINDOW = int(os.getenv('NOTIFY_COALESCE_WINDOW', 0))
+
+# Режим дайджеста: срабатывания приходят одним сообщением раз в интервал
+DIGEST_INTERVALS = {'15m': 900, '1h': 3600, '4h': 14400}
+
+# Общий лимит исходящих сообщений Telegram (бот может ~30 в секунду)
+TELEGRAM_SEND_RATE = 25
+TELEGRAM_SEND_BURST = 25
+
+# Ежедневная сводка по закреплённым парам
+SUMMARY_TEMPLATE = "☀️ <b>Сводка по закреплённым парам</b>\n\n{lines}\n\n⏱️ {time}"
+SUMMARY_SEND_BATCH = 100   # сколько сводок отправляем одновременно (темп держит общий лимит)
+
+# JSON API курсов: сколько клиентам можно кэшировать ответ и сколько кросс-пар держать готовыми
+RATES_API_MAX_AGE = FETCH_INTERVAL
+RATES_API_MAX_PAIRS = 512
+
+# Поток цен /stream (SSE и WebSocket)
+STREAM_QUEUE_SIZE = 256      # сколько событий ждут отправки одному клиенту, дальше — отключаем
+STREAM_MAX_CLIENTS = int(os.getenv('STREAM_MAX_CLIENTS', 10000))
+STREAM_HEARTBEAT = 15
+STREAM_POLL_INTERVAL = 1     # как часто проверять общий снимок, если нас не разбудили
+
+# Живое табло закреплённых пар: одно сообщение, которое редактируется на месте
+BOARD_INTERVAL = int(os.getenv('BOARD_INTERVAL', 30))
+BOARD_TEMPLATE = "📺 <b>Табло</b>\n\n{lines}\n\n🔄 изменено в {time}"
+BOARD_KEYBOARD_JSON = json.dumps({"inline_keyboard": [[{"text": "⏹ Остановить табло", "callback_data": "board_off"}]]})
+
+# Правила срабатывания: (пары, допуск, относительный ли допуск, формат цели)
+ALERT_RULES = (
+    (frozenset(['BTC/USD', 'ETH/USD', 'XAU/USD', 'XPT/USD', 'S&P 500', 'NASDAQ']), 0.0001, True, '{:.2f}'.format),
+    (frozenset(['DOGE/USD', 'XRP/USD']), 0.0001, False, '{:.4f}'.format),
+)
+ALERT_RULE_DEFAULT = (None, 0.00005, False, '{:.5f}'.format)
+
+def alert_rule(pair):
+    """Допуск, относительность допуска и формат цены для пары"""
+    for pairs, tolerance, relative, fmt in ALERT_RULES:
+        if pair in pairs:
+            return tolerance, relative, fmt
+    return ALERT_RULE_DEFAULT[1:]
+
+# Таймфреймы свечей (в секундах)
+CANDLE_TIMEFRAMES = {
+    '1m': 60,
+    '5m': 300,
+    '1h': 3600,
+    '1d': 86400,
+}
+
+# Сколько закрытых свечей храним на каждом таймфрейме
+CANDLE_HISTORY = {
+    '1m': 1440,   # сутки
+    '5m': 2016,   # неделя
+    '1h': 720,    # месяц
+    '1d': 365,    # год
+}
+
+class HttpMetrics:
+    """Счётчики исходящих запросов и соединений (через aiohttp TraceConfig)"""
+    
     def __init__(self):
-        self.session = None
-        self.last_update_id = 0
-        self.alert_states = {}
-        self.last_successful_rates = {
-            # Валюты (9 пар)
-            'EUR/USD': 1.08,
-            'GBP/USD': 1.26,
-            'USD/JPY': 155.0,
-            'USD/RUB': 90.0,
-            'EUR/GBP': 0.87,
-            'USD/CAD': 1.35,
-            'AUD/USD': 0.65,
-            'USD/CHF': 0.88,
-            'USD/CNY': 7.25,
+        self.requests = Counter()     # host -> запросов
+        self.errors = Counter()       # host -> ошибок
+        self.connections_created = 0
+        self.connections_reused = 0
+        self.connections_queued = 0
+        self.dns_cache_hits = 0
+        self.dns_cache_misses = 0
+    
+    def trace_config(self):
+        trace = aiohttp.TraceConfig()
+        
+        async def on_request_start(session, ctx, params):
+            self.requests[params.url.host] += 1
+        
+        async def on_request_exception(session, ctx, params):
+            self.errors[params.url.host] += 1
+        
+        async def on_connection_create_end(session, ctx, params):
+            self.connections_created += 1
+        
+        async def on_connection_reuseconn(session, ctx, params):
+            self.connections_reused += 1
+        
+        async def on_connection_queued_start(session, ctx, params):
+            self.connections_queued += 1
+        
+        async def on_dns_cache_hit(session, ctx, params):
+            self.dns_cache_hits += 1
+        
+        async def on_dns_cache_miss(session, ctx, params):
+            self.dns_cache_misses += 1
+        
+        trace.on_request_start.append(on_request_start)
+        trace.on_request_exception.append(on_request_exception)
+        trace.on_connection_create_end.append(on_connection_create_end)
+        trace.on_connection_reuseconn.append(on_connection_reuseconn)
+        trace.on_connection_queued_start.append(on_connection_queued_start)
+        trace.on_dns_cache_hit.append(on_dns_cache_hit)
+        trace.on_dns_cache_miss.append(on_dns_cache_miss)
+        return trace
+
+class SingleFlight:
+    """Склеивает одновременные вызовы с одним ключом в один запрос к провайдеру"""
+    
+    def __init__(self):
+        self.calls = {}          # key -> задача, которая сейчас выполняется
+        self.started = Counter()
+        self.joined = Counter()
+    
+    async def do(self, key, func, *args):
+        """Выполняет func или присоединяется к уже идущему вызову с тем же ключом"""
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args))
+            self.calls[key] = task
+            self.started[key] += 1
             
-            # Металлы (3 пары)
-            'XAU/USD': 5160.0,
-            'XAG/USD': 30.0,
-            'XPT/USD': 1000.0,
+            def forget(done, key=key):
+                if self.calls.get(key) is done:
+                    del self.calls[key]
             
-            # Крипта (5 пар)
-            'BTC/USD': 67000.0,
-            'ETH/USD': 1950.0,
-            'SOL/USD': 84.0,
-            'XRP/USD': 1.40,
-            'DOGE/USD': 0.098,
+            task.add_done_callback(forget)
+        else:
+            self.joined[key] += 1
+        
+        # shield: отмена одного ожидающего не отменяет общий запрос
+        return await asyncio.shield(task)
+
+# Стартовые значения котировок (до первого успешного опроса)
+DEFAULT_RATES = {
+    # Валюты (9 пар)
+    'EUR/USD': 1.08,
+    'GBP/USD': 1.26,
+    'USD/JPY': 155.0,
+    'USD/RUB': 90.0,
+    'EUR/GBP': 0.87,
+    'USD/CAD': 1.35,
+    'AUD/USD': 0.65,
+    'USD/CHF': 0.88,
+    'USD/CNY': 7.25,
+    
+    # Металлы (3 пары)
+    'XAU/USD': 5160.0,
+    'XAG/USD': 30.0,
+    'XPT/USD': 1000.0,
+    
+    # Крипта (5 пар)
+    'BTC/USD': 67000.0,
+    'ETH/USD': 1950.0,
+    'SOL/USD': 84.0,
+    'XRP/USD': 1.40,
+    'DOGE/USD': 0.098,
+    
+    # Индексы (2 пары)
+    'S&P 500': 5100.0,
+    'NASDAQ': 18000.0,
+    
+    # Товары (3 пары)
+    'CORN/USD': 4.50,
+    'WTI/USD': 75.0,
+    'BRENT/USD': 78.0,
+}
+
+# Сколько секунд котировка считается свежей
+QUOTE_MAX_AGE_DEFAULT = 600
+# Таблица фиата (open.er-api) публикуется раз в сутки; её время — время публикации,
+# поэтому кросс-курсы свежи, пока у нас последняя таблица (с часом запаса)
+FX_TABLE_MAX_AGE = 25 * 3600
+QUOTE_MAX_AGE = {
+    'BTC/USD': 120,
+    'ETH/USD': 120,
+    'SOL/USD': 120,
+    'XRP/USD': 120,
+    'DOGE/USD': 120,
+}
+# Twelve Data без алертов опрашивается раз в TWELVEDATA_REFRESH['idle'] секунд,
+# вне сессии кредиты копятся примерно так же медленно — свежесть считаем с запасом
+QUOTE_MAX_AGE.update({pair: int(TWELVEDATA_REFRESH['idle'] * 1.5) for pair in TWELVEDATA_SYMBOLS})
+
+# Провайдеры: какие пары обновляют и как называется источник
+PROVIDERS = {
+    'fiat': {'source': 'open.er-api', 'pairs': ('EUR/USD', 'GBP/USD', 'USD/JPY', 'USD/RUB', 'EUR/GBP', 'USD/CAD', 'AUD/USD', 'USD/CHF', 'USD/CNY')},
+    'binance': {'source': 'binance', 'pairs': ('BTC/USD', 'ETH/USD', 'SOL/USD', 'XRP/USD', 'DOGE/USD')},
+    'metals': {'source': 'consensus', 'pairs': ('XAU/USD', 'XAG/USD', 'XPT/USD')},
+    'indices': {'source': 'consensus', 'pairs': ('S&P 500', 'NASDAQ')},
+    'twelvedata': {'source': 'twelvedata', 'pairs': tuple(TWELVEDATA_SYMBOLS)},
+    'oil': {'source': 'yfinance', 'pairs': ('WTI/USD', 'BRENT/USD')},
+}
+
+class Quote:
+    """Котировка инструмента: значение, источник, время получения и время у провайдера"""
+    __slots__ = ('value', 'source', 'fetched_at', 'provider_ts')
+    
+    def __init__(self, value, source, fetched_at, provider_ts=None):
+        self.value = value
+        self.source = source
+        self.fetched_at = fetched_at
+        self.provider_ts = provider_ts
+    
+    def age(self, now=None):
+        if not self.fetched_at:
+            return math.inf
+        return (now if now is not None else time.time()) - self.fetched_at
+
+class QuoteTable:
+    """Таблица котировок по инструментам с отслеживанием свежести"""
+    
+    def __init__(self, defaults=None):
+        self.quotes = {}
+        self.version = 0   # растёт при каждой записи — по нему видно, что таблица изменилась
+        for pair, value in (defaults or {}).items():
+            self.quotes[pair] = Quote(value, 'default', 0.0)
+    
+    def __contains__(self, pair):
+        return pair in self.quotes
+    
+    def get(self, pair):
+        return self.quotes.get(pair)
+    
+    def value(self, pair, default=None):
+        quote = self.quotes.get(pair)
+        return quote.value if quote is not None else default
+    
+    def set(self, pair, value, source, fetched_at=None, provider_ts=None):
+        """Записывает свежую котировку (объект переиспользуется)"""
+        if fetched_at is None:
+            fetched_at = time.time()
+        self.version += 1
+        quote = self.quotes.get(pair)
+        if quote is None:
+            self.quotes[pair] = Quote(value, source, fetched_at, provider_ts)
+        else:
+            quote.value = value
+            quote.source = source
+            quote.fetched_at = fetched_at
+            quote.provider_ts = provider_ts
+    
+    @staticmethod
+    def max_age(pair):
+        return QUOTE_MAX_AGE.get(pair, QUOTE_MAX_AGE_DEFAULT)
+    
+    def age(self, pair, now=None):
+        quote = self.quotes.get(pair)
+        return quote.age(now) if quote is not None else math.inf
+    
+    def is_fresh(self, pair, now=None):
+        return self.age(pair, now) <= self.max_age(pair)
+    
+    def staleness(self, pairs, now=None):
+        """Насколько сильно устарела самая старая из пар (доля от допустимого возраста)"""
+        return max((self.age(pair, now) / self.max_age(pair) for pair in pairs), default=0.0)
+    
+    def stale_pairs(self, now=None):
+        """Устаревшие пары, самые старые первыми"""
+        if now is None:
+            now = time.time()
+        stale = [pair for pair in self.quotes if not self.is_fresh(pair, now)]
+        stale.sort(key=lambda pair: self.age(pair, now), reverse=True)
+        return stale
+    
+    def values(self):
+        return {pair: quote.value for pair, quote in self.quotes.items()}
+    
+    def timestamps(self):
+        return {pair: quote.fetched_at for pair, quote in self.quotes.items()}
+    
+    def to_dict(self):
+        return {
+            pair: [quote.value, quote.source, quote.fetched_at, quote.provider_ts]
+            for pair, quote in self.quotes.items()
+        }
+    
+    def load(self, data):
+        for pair, (value, source, fetched_at, provider_ts) in data.items():
+            self.set(pair, value, source, fetched_at, provider_ts)
+
+class CreditBudget:
+    """Токен-бакет для кредитов платного API
+    
+    Суточная квота распределяется по времени торговой сессии (малая доля — на
+    закрытый рынок), ёмкость бакета ограничена поминутным лимитом провайдера.
+    """
+    
+    def __init__(self, daily=TWELVEDATA_DAILY_CREDITS, per_minute=TWELVEDATA_MINUTE_CREDITS,
+                 market=TWELVEDATA_MARKET, offhours_share=TWELVEDATA_OFFHOURS_SHARE):
+        self.daily = daily
+        self.capacity = per_minute
+        self.market = market
+        self.market_tz = ZoneInfo(market['tz'])
+        
+        open_h, open_m = market['open']
+        close_h, close_m = market['close']
+        market_seconds = (close_h * 3600 + close_m * 60) - (open_h * 3600 + open_m * 60)
+        self.market_rate = daily * (1 - offhours_share) / market_seconds
+        self.offhours_rate = daily * offhours_share / (86400 - market_seconds)
+        
+        self.tokens = float(per_minute)
+        self.updated = time.time()
+        self.day = datetime.now(ZoneInfo('UTC')).date()
+        self.used_today = 0
+        self.denied = 0
+    
+    def is_market_open(self, now=None):
+        local = datetime.fromtimestamp(now if now is not None else time.time(), self.market_tz)
+        if local.weekday() not in self.market['days']:
+            return False
+        return self.market['open'] <= (local.hour, local.minute) < self.market['close']
+    
+    def _refill(self, now):
+        # Квота Twelve Data сбрасывается в полночь UTC
+        today = datetime.fromtimestamp(now, ZoneInfo('UTC')).date()
+        if today != self.day:
+            self.day = today
+            self.used_today = 0
+        
+        rate = self.market_rate if self.is_market_open(now) else self.offhours_rate
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+    
+    def available(self, now=None):
+        now = now if now is not None else time.time()
+        self._refill(now)
+        return min(self.tokens, self.daily - self.used_today)
+    
+    def try_spend(self, credits, reserve=0, now=None):
+        """Списывает кредиты, если после этого останется не меньше reserve"""
+        if self.available(now) - credits < reserve:
+            self.denied += 1
+            return False
+        self.tokens -= credits
+        self.used_today += credits
+        return True
+    
+    def charge(self, credits):
+        """Учитывает уже потраченные кредиты (например, хедж-дубль)"""
+        self.tokens -= credits
+        self.used_today += credits
+
+class HedgedRequests:
+    """Хедж-запросы к медленным провайдерам с ограничением по бюджету
+    
+    Если запрос не ответил за p90 своих недавних задержек, отправляется дубль
+    (или запрос к запасному эндпоинту); побеждает первый ответ, второй отменяется.
+    Каждый обычный запрос пополняет бюджет на HEDGE_BUDGET, каждый дубль тратит 1.
+    """
+    
+    def __init__(self, budget=HEDGE_BUDGET, burst=HEDGE_BURST):
+        self.budget = budget
+        self.burst = burst
+        self.latencies = {}       # провайдер -> deque последних задержек
+        self.tokens = {}
+        self.requests = Counter()
+        self.hedges = Counter()
+        self.hedge_wins = Counter()
+    
+    def delay(self, provider):
+        """Через сколько секунд отправлять дубль (p90 последних задержек)"""
+        samples = self.latencies.get(provider)
+        if not samples or len(samples) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        ordered = sorted(samples)
+        return max(ordered[int(len(ordered) * 0.9) - 1], HEDGE_MIN_DELAY)
+    
+    def record(self, provider, latency):
+        samples = self.latencies.get(provider)
+        if samples is None:
+            samples = self.latencies[provider] = deque(maxlen=200)
+        samples.append(latency)
+    
+    def _take_token(self, provider):
+        tokens = self.tokens.get(provider, self.burst)
+        if tokens < 1:
+            return False
+        self.tokens[provider] = tokens - 1
+        return True
+    
+    async def run(self, provider, primary, alternate=None):
+        """Выполняет primary(), при задержке — с дублем alternate() (или primary())"""
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        self.requests[provider] += 1
+        self.tokens[provider] = min(self.tokens.get(provider, self.burst) + self.budget, self.burst)
+        
+        first = asyncio.ensure_future(primary())
+        done, _ = await asyncio.wait({first}, timeout=self.delay(provider))
+        if done or not self._take_token(provider):
+            result = await first
+            self.record(provider, loop.time() - started)
+            return result
+        
+        self.hedges[provider] += 1
+        second = asyncio.ensure_future((alternate or primary)())
+        pending = {first, second}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None or not pending:
+                        if task is second:
+                            self.hedge_wins[provider] += 1
+                        self.record(provider, loop.time() - started)
+                        return task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+class HttpCache:
+    """Кэш JSON-ответов провайдеров с условными запросами
+    
+    Пока не наступило объявленное время обновления, запрос не отправляется вовсе.
+    Затем уходит запрос с If-None-Match / If-Modified-Since, и на 304 переиспользуется
+    уже разобранное тело.
+    """
+    
+    def __init__(self, max_entries=256):
+        self.entries = OrderedDict()  # url -> {data, etag, last_modified, expires_at}
+        self.max_entries = max_entries
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+    
+    @staticmethod
+    def _expires_from_headers(headers, now):
+        cache_control = headers.get('Cache-Control', '')
+        if 'no-store' in cache_control or 'no-cache' in cache_control:
+            return None
+        match = re.search(r'max-age=(\d+)', cache_control)
+        if match:
+            return now + int(match.group(1))
+        if headers.get('Expires'):
+            try:
+                from email.utils import parsedate_to_datetime
+                return parsedate_to_datetime(headers['Expires']).timestamp()
+            except (TypeError, ValueError):
+                return None
+        return None
+    
+    def _store(self, url, entry):
+        self.entries[url] = entry
+        self.entries.move_to_end(url)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+    
+    def fresh(self, url, now=None):
+        """Тело из кэша, если объявленное время обновления ещё не наступило, иначе None"""
+        entry = self.entries.get(url)
+        if entry is not None and entry['expires_at'] and (now or time.time()) < entry['expires_at']:
+            self.hits += 1
+            return entry['data']
+        return None
+    
+    async def get_json(self, session, url, timeout=HTTP_TIMEOUTS['default'], expires=None):
+        """Возвращает разобранный JSON (из кэша или сети) либо None при ошибке"""
+        now = time.time()
+        data = self.fresh(url, now)
+        if data is not None:
+            return data
+        entry = self.entries.get(url)
+        
+        headers = {}
+        if entry is not None:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        
+        async with session.get(url, timeout=timeout, headers=headers) as response:
+            if response.status == 304 and entry is not None:
+                self.revalidated += 1
+                entry['expires_at'] = self._expires_from_headers(response.headers, now)
+                self.entries.move_to_end(url)
+                return entry['data']
             
-            # Индексы (2 пары)
-            'S&P 500': 5100.0,
-            'NASDAQ': 18000.0,
+            if response.status != 200:
+                return None
             
-            # Товары (3 пары)
-            'CORN/USD': 4.50,
-            'WTI/USD': 75.0,
-            'BRENT/USD': 78.0,
+            data = await response.json(content_type=None)
+            self.misses += 1
+        
+        expires_at = self._expires_from_headers(response.headers, now)
+        if expires is not None:
+            try:
+                provider_expires = expires(data)
+                if provider_expires:
+                    expires_at = float(provider_expires)
+            except (TypeError, ValueError, AttributeError):
+                pass
+        
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if etag or last_modified or expires_at:
+            self._store(url, {
+                'data': data,
+                'etag': etag,
+                'last_modified': last_modified,
+                'expires_at': expires_at,
+            })
+        return data
+
+class TelegramThrottle:
+    """Общий токен-бакет для исходящих сообщений Telegram
+    
+    Каждый вызов резервирует токен сразу и при нехватке ждёт свою очередь,
+    поэтому параллельные отправки выстраиваются в ровный поток.
+    """
+    
+    def __init__(self, rate=TELEGRAM_SEND_RATE, burst=TELEGRAM_SEND_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.waits = 0
+    
+    async def acquire(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens < 0:
+            self.waits += 1
+            await asyncio.sleep(-self.tokens / self.rate)
+    
+    def penalize(self, retry_after):
+        """Telegram ответил 429 — приостанавливаем всю отправку на retry_after секунд"""
+        self.tokens = min(self.tokens, -retry_after * self.rate)
+
+class StreamSubscriber:
+    """Клиент потока цен: фильтр пар и ограниченная очередь кадров"""
+    
+    __slots__ = ('pairs', 'queue', 'dropped', 'transport')
+    
+    def __init__(self, pairs, queue_size):
+        self.pairs = pairs
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.dropped = False
+        self.transport = None   # соединение клиента: закрываем его при отключении
+
+class PriceStream:
+    """Раздача обновлений цен подписчикам
+    
+    Каждое обновление сериализуется один раз (JSON для WebSocket и готовый
+    кадр SSE), а подписчикам раскладываются ссылки на него. Клиент, чья
+    очередь переполнилась, отключается — один зависший не держит память.
+    """
+    
+    def __init__(self, queue_size=STREAM_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.subscribers = set()
+        self.by_pair = {}      # pair -> подписчики с фильтром
+        self.firehose = set()  # подписчики без фильтра
+        self.last = {}         # pair -> (price, fetched_at) последнего опубликованного
+        self.wake = asyncio.Event()
+        self.published = 0
+        self.dropped = 0
+    
+    def subscribe(self, pairs=None):
+        subscriber = StreamSubscriber(pairs, self.queue_size)
+        self.subscribers.add(subscriber)
+        if pairs:
+            for pair in pairs:
+                self.by_pair.setdefault(pair, set()).add(subscriber)
+        else:
+            self.firehose.add(subscriber)
+        return subscriber
+    
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+        self.firehose.discard(subscriber)
+        for pair in subscriber.pairs or ():
+            subscribers = self.by_pair.get(pair)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self.by_pair[pair]
+    
+    @staticmethod
+    def frame(event, data):
+        payload = json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+        return payload, f"event: {event}\ndata: {payload}\n\n".encode('utf-8')
+    
+    def offer(self, subscriber, frame):
+        if subscriber.dropped:
+            return
+        try:
+            subscriber.queue.put_nowait(frame)
+        except asyncio.QueueFull:
+            # Медленный клиент: выбрасываем его очередь и оставляем только сигнал отключения
+            subscriber.dropped = True
+            self.dropped += 1
+            while not subscriber.queue.empty():
+                subscriber.queue.get_nowait()
+            subscriber.queue.put_nowait(None)
+            # Обработчик может висеть в записи и не дойти до сигнала — рвём соединение сами
+            if subscriber.transport is not None:
+                subscriber.transport.abort()
+    
+    def publish(self, entries):
+        """Рассылает обновления {pair: entry} подписчикам этих пар и всем без фильтра"""
+        for pair, entry in entries.items():
+            frame = self.frame('price', entry)
+            for subscriber in self.firehose:
+                self.offer(subscriber, frame)
+            for subscriber in self.by_pair.get(pair, ()):
+                self.offer(subscriber, frame)
+            self.published += 1
+
+class DailyScheduler:
+    """Ежедневные задания в местное время пользователей
+    
+    Задания лежат в куче по времени следующего запуска, цикл спит до ближайшего.
+    Перенос и отмена не трогают кучу: устаревшие записи отбрасываются по версии.
+    """
+    
+    def __init__(self):
+        self.heap = []       # (due_ts, version, user_id)
+        self.jobs = {}       # user_id -> (hour, minute, tz, version)
+        self.version = 0
+        self.changed = asyncio.Event()
+    
+    @staticmethod
+    def next_run(hour, minute, tz, now):
+        tz_info = ZoneInfo(tz)
+        local = datetime.fromtimestamp(now, tz_info)
+        due = datetime.combine(local.date(), dt_time(hour, minute), tz_info)
+        if due.timestamp() <= now:
+            due = datetime.combine(local.date() + timedelta(days=1), dt_time(hour, minute), tz_info)
+        return due.timestamp()
+    
+    def schedule(self, user_id, hour, minute, tz, now=None):
+        now = now if now is not None else time.time()
+        self.version += 1
+        self.jobs[user_id] = (hour, minute, tz, self.version)
+        due = self.next_run(hour, minute, tz, now)
+        head = self.next_due()
+        heapq.heappush(self.heap, (due, self.version, user_id))
+        if head is None or due < head:
+            self.changed.set()
+    
+    def cancel(self, user_id):
+        self.jobs.pop(user_id, None)
+    
+    def _is_current(self, entry):
+        job = self.jobs.get(entry[2])
+        return job is not None and job[3] == entry[1]
+    
+    def next_due(self):
+        while self.heap and not self._is_current(self.heap[0]):
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+    
+    def pop_due(self, now):
+        """Забирает наступившие задания и сразу ставит их на следующий день"""
+        due_users = []
+        while self.heap and self.heap[0][0] <= now:
+            entry = heapq.heappop(self.heap)
+            if not self._is_current(entry):
+                continue
+            user_id = entry[2]
+            hour, minute, tz, _ = self.jobs[user_id]
+            due_users.append(user_id)
+            self.schedule(user_id, hour, minute, tz, now)
+        return due_users
+
+class CandleSeries:
+    """Свечи одной пары на одном таймфрейме: закрытые в колонках, текущая изменяемая"""
+    __slots__ = ('period', 'capacity', 'start', 'open', 'high', 'low', 'close', 'current')
+    
+    def __init__(self, period, capacity):
+        self.period = period
+        self.capacity = capacity
+        # Закрытые свечи хранятся по колонкам в компактных массивах
+        self.start = array('d')
+        self.open = array('d')
+        self.high = array('d')
+        self.low = array('d')
+        self.close = array('d')
+        # Текущая свеча: [начало, open, high, low, close]
+        self.current = None
+    
+    def add(self, price, ts):
+        """Добавляет тик в текущую свечу, закрывая её при смене интервала"""
+        bucket = ts - ts % self.period
+        current = self.current
+        
+        if current is None or bucket > current[0]:
+            if current is not None:
+                self._close(current)
+            self.current = [bucket, price, price, price, price]
+        elif bucket == current[0]:
+            if price > current[2]:
+                current[2] = price
+            elif price < current[3]:
+                current[3] = price
+            current[4] = price
+        # Тики из прошлых интервалов игнорируем
+    
+    def _close(self, candle):
+        """Переносит свечу в колоночное хранилище"""
+        self.start.append(candle[0])
+        self.open.append(candle[1])
+        self.high.append(candle[2])
+        self.low.append(candle[3])
+        self.close.append(candle[4])
+        
+        # Обрезаем историю пачкой, чтобы не сдвигать массивы на каждой свече
+        excess = len(self.start) - self.capacity
+        if excess >= max(1, self.capacity // 8):
+            for column in (self.start, self.open, self.high, self.low, self.close):
+                del column[:excess]
+    
+    def last_start(self):
+        """Начало последней (текущей) свечи или None"""
+        if self.current is not None:
+            return self.current[0]
+        return self.start[-1] if self.start else None
+    
+    def columns(self, limit=None, include_current=True):
+        """Возвращает свечи в виде колонок (start, open, high, low, close)"""
+        count = min(len(self.start), self.capacity)
+        if limit is not None:
+            count = min(count, max(limit - (1 if include_current and self.current else 0), 0))
+        offset = len(self.start) - count
+        
+        result = {
+            'start': self.start[offset:].tolist(),
+            'open': self.open[offset:].tolist(),
+            'high': self.high[offset:].tolist(),
+            'low': self.low[offset:].tolist(),
+            'close': self.close[offset:].tolist(),
         }
         
+        if include_current and self.current is not None:
+            for key, value in zip(('start', 'open', 'high', 'low', 'close'), self.current):
+                result[key].append(value)
+        
+        return result
+
+class CandleAggregator:
+    """Инкрементально собирает тики в OHLC-свечи по всем парам и таймфреймам"""
+    
+    def __init__(self, timeframes=None, history=None):
+        self.timeframes = dict(timeframes or CANDLE_TIMEFRAMES)
+        self.history = dict(history or CANDLE_HISTORY)
+        self.series = {}  # pair -> {timeframe: CandleSeries}
+    
+    def _pair_series(self, pair):
+        series = self.series.get(pair)
+        if series is None:
+            series = {
+                tf: CandleSeries(period, self.history.get(tf, 1000))
+                for tf, period in self.timeframes.items()
+            }
+            self.series[pair] = series
+        return series
+    
+    def add_tick(self, pair, price, ts=None):
+        """Добавляет один тик (подходит и для потоковых источников)"""
+        if price is None:
+            return
+        if ts is None:
+            ts = time.time()
+        price = float(price)
+        for candle_series in self._pair_series(pair).values():
+            candle_series.add(price, ts)
+    
+    def add_rates(self, rates, ts=None):
+        """Добавляет тики по всем парам из результата fetch_rates"""
+        if ts is None:
+            ts = time.time()
+        for pair, price in rates.items():
+            if isinstance(price, (int, float)):
+                self.add_tick(pair, price, ts)
+    
+    def get(self, pair, timeframe, limit=None, include_current=True):
+        """Возвращает колонки свечей пары или None, если данных нет"""
+        series = self.series.get(pair, {}).get(timeframe)
+        if series is None or series.last_start() is None:
+            return None
+        return series.columns(limit=limit, include_current=include_current)
+    
+    def last_candle_start(self, pair, timeframe):
+        """Начало последней свечи (нужно для ключей кэша)"""
+        series = self.series.get(pair, {}).get(timeframe)
+        return series.last_start() if series is not None else None
+
+# Фиксированный порядок инструментов (раскладка общей памяти)
+INSTRUMENT_PAIRS = (
+    'EUR/USD', 'GBP/USD', 'USD/JPY', 'USD/RUB', 'EUR/GBP', 'USD/CAD', 'AUD/USD', 'USD/CHF', 'USD/CNY',
+    'XAU/USD', 'XAG/USD', 'XPT/USD',
+    'BTC/USD', 'ETH/USD', 'SOL/USD', 'XRP/USD', 'DOGE/USD',
+    'S&P 500', 'NASDAQ',
+    'CORN/USD', 'WTI/USD', 'BRENT/USD',
+)
+
+# Валюты, курсы которых к USD публикуются в общую память для кросс-курсов
+FIAT_CODES = (
+    'EUR', 'GBP', 'JPY', 'CNY', 'RUB', 'CHF', 'CAD', 'AUD', 'NZD', 'HKD', 'SGD',
+    'SEK', 'NOK', 'DKK', 'PLN', 'CZK', 'HUF', 'RON', 'BGN', 'TRY', 'UAH', 'BYN',
+    'KZT', 'UZS', 'KGS', 'AMD', 'GEL', 'AZN', 'TJS', 'MDL', 'INR', 'KRW', 'THB',
+    'VND', 'IDR', 'MYR', 'PHP', 'AED', 'SAR', 'ILS', 'EGP', 'ZAR', 'BRL', 'MXN',
+    'ARS', 'CLP', 'COP',
+)
+
+# Раскладка общей памяти: инструменты + вектор USD-курсов
+SHARED_PAIRS = INSTRUMENT_PAIRS + tuple(f"FX:{code}" for code in FIAT_CODES)
+
+# Синонимы для /price и /convert
+INSTRUMENT_ALIASES = {
+    'BTC/USD': ('btc', 'bitcoin', 'биткоин', 'биткойн', 'биток'),
+    'ETH/USD': ('eth', 'ethereum', 'эфир', 'эфириум'),
+    'SOL/USD': ('sol', 'solana', 'солана'),
+    'XRP/USD': ('xrp', 'ripple', 'рипл'),
+    'DOGE/USD': ('doge', 'dogecoin', 'доги', 'додж'),
+    'XAU/USD': ('xau', 'gold', 'золото'),
+    'XAG/USD': ('xag', 'silver', 'серебро'),
+    'XPT/USD': ('xpt', 'platinum', 'платина'),
+    'S&P 500': ('sp500', 's&p', 'spx', 'снп'),
+    'NASDAQ': ('nasdaq', 'ndx', 'насдак'),
+    'CORN/USD': ('corn', 'кукуруза'),
+    'WTI/USD': ('wti', 'нефть'),
+    'BRENT/USD': ('brent', 'брент'),
+}
+CURRENCY_ALIASES = {
+    'USD': ('доллар', 'доллары', 'бакс', '$'),
+    'EUR': ('евро', '€'),
+    'RUB': ('рубль', 'рубли', 'руб', '₽'),
+    'GBP': ('фунт', '£'),
+    'JPY': ('иена', 'йена', '¥'),
+    'CNY': ('юань', 'юани'),
+    'CHF': ('франк',),
+}
+
+def alias_key(text):
+    """Ключ поиска: нижний регистр без пробелов и разделителей"""
+    return re.sub(r'[\s/\-_]', '', text.lower())
+
+def build_alias_indexes():
+    """Индексы синонимов: ключ → пара для /price и ключ → единица (код валюты или пара к USD) для /convert"""
+    pairs, units = {}, {}
+    for code in ('USD',) + FIAT_CODES:
+        units[alias_key(code)] = code
+    for code, aliases in CURRENCY_ALIASES.items():
+        for alias in aliases:
+            units[alias_key(alias)] = code
+    
+    for pair in INSTRUMENT_PAIRS:
+        pairs[alias_key(pair)] = pair
+    for pair, aliases in INSTRUMENT_ALIASES.items():
+        for alias in aliases:
+            pairs[alias_key(alias)] = pair
+            # В /convert годятся только активы с ценой в долларах
+            if pair.endswith('/USD'):
+                units[alias_key(alias)] = pair
+    return pairs, units
+
+PAIR_ALIAS_INDEX, UNIT_ALIAS_INDEX = build_alias_indexes()
+
+# Отсортированные ключи синонимов для поиска по префиксу (inline-режим)
+PAIR_PREFIX_KEYS = sorted(PAIR_ALIAS_INDEX)
+
+# Inline-режим: сколько результатов отдаём, сколько Telegram кэширует ответ, размер нашего кэша
+INLINE_MAX_RESULTS = 10
+INLINE_CACHE_TIME = 10
+INLINE_CACHE_SIZE = 512
+
+def pairs_by_prefix(prefix, limit=INLINE_MAX_RESULTS):
+    """Пары, у которых какой-либо синоним начинается с prefix (бинарный поиск по ключам)"""
+    key = alias_key(prefix)
+    if not key:
+        return list(INSTRUMENT_PAIRS[:limit])
+    
+    pairs = []
+    for i in range(bisect.bisect_left(PAIR_PREFIX_KEYS, key), len(PAIR_PREFIX_KEYS)):
+        alias = PAIR_PREFIX_KEYS[i]
+        if not alias.startswith(key):
+            break
+        pair = PAIR_ALIAS_INDEX[alias]
+        if pair not in pairs:
+            pairs.append(pair)
+            if len(pairs) >= limit:
+                break
+    return pairs
+
+class CrossRateEngine:
+    """Хранит вектор курсов к USD и считает любую пару X/Y делением"""
+    
+    def __init__(self):
+        self.codes = []
+        self.index = {}
+        self.vector = array('d')  # единиц валюты за 1 USD
+        self.updated_at = None
+        self.version = 0          # растёт, только когда поменялись сами курсы
+        self._plans = {}
+    
+    def update(self, usd_rates, ts=None):
+        """Обновляет вектор из таблицы вида {'EUR': 0.92, 'JPY': 155.0, ...}"""
+        rates = {code: float(value) for code, value in usd_rates.items() if value}
+        rates['USD'] = 1.0
+        codes = sorted(rates)
+        
+        if codes != self.codes:
+            self.codes = codes
+            self.index = {code: i for i, code in enumerate(codes)}
+            # Раскладка поменялась — планы индексов больше не годятся
+            self._plans = {}
+        
+        vector = array('d', (rates[code] for code in codes))
+        if vector != self.vector:
+            self.vector = vector
+            self.version += 1
+        self.updated_at = ts if ts is not None else time.time()
+    
+    def has(self, code):
+        return code in self.index
+    
+    def parse_pair(self, pair):
+        """Разбирает 'EUR/JPY', 'eurjpy' или 'EUR JPY' в ('EUR', 'JPY')"""
+        cleaned = re.sub(r'[\s/\-_]', '', pair.upper())
+        if len(cleaned) != 6:
+            return None
+        base, quote = cleaned[:3], cleaned[3:]
+        if base == quote or base not in self.index or quote not in self.index:
+            return None
+        return base, quote
+    
+    def normalize_pair(self, pair):
+        """Каноническое имя пары ('EUR/JPY') или None"""
+        parsed = self.parse_pair(pair)
+        return f"{parsed[0]}/{parsed[1]}" if parsed else None
+    
+    def rate(self, pair):
+        """Курс одной пары: сколько quote за 1 base"""
+        parsed = self.parse_pair(pair)
+        if parsed is None:
+            return None
+        return self.vector[self.index[parsed[1]]] / self.vector[self.index[parsed[0]]]
+    
+    def _plan(self, pairs):
+        """Индексы base/quote для набора пар (кэшируется до смены раскладки)"""
+        plan = self._plans.get(pairs)
+        if plan is None:
+            names, bases, quotes = [], [], []
+            for pair in pairs:
+                parsed = self.parse_pair(pair)
+                if parsed:
+                    names.append(pair)
+                    bases.append(self.index[parsed[0]])
+                    quotes.append(self.index[parsed[1]])
+            plan = (names, bases, quotes)
+            if len(self._plans) > 64:
+                self._plans.clear()
+            self._plans[pairs] = plan
+        return plan
+    
+    def rates_for(self, pairs):
+        """Считает пачку кросс-курсов одним проходом деления по векторам"""
+        if not self.vector:
+            return {}
+        names, bases, quotes = self._plan(tuple(pairs))
+        vector = self.vector
+        base_values = array('d', map(vector.__getitem__, bases))
+        quote_values = array('d', map(vector.__getitem__, quotes))
+        return dict(zip(names, map(operator.truediv, quote_values, base_values)))
+    
+    def as_dict(self):
+        return dict(zip(self.codes, self.vector))
+
+class SharedRates:
+    """Снимок курсов в multiprocessing.shared_memory под защитой seqlock
+    
+    Раскладка: [seq: uint64][published_at: double] + на каждую пару [price: double][ts: double].
+    Писатель один (процесс-фетчер), читателей сколько угодно.
+    """
+    HEADER = struct.Struct('<Qd')
+    SEQ = struct.Struct('<Q')
+    
+    def __init__(self, shm, pairs=SHARED_PAIRS, owner=False):
+        self.shm = shm
+        self.pairs = tuple(pairs)
+        self.index = {pair: i for i, pair in enumerate(self.pairs)}
+        self.slots = struct.Struct(f'<{len(self.pairs) * 2}d')
+        self.owner = owner
+        self.last_seq = None
+    
+    @classmethod
+    def size_for(cls, pairs):
+        return cls.HEADER.size + len(pairs) * 16
+    
+    @classmethod
+    def create(cls, name=RATES_SHM_NAME, pairs=SHARED_PAIRS):
+        """Создаёт сегмент (владелец — главный процесс)"""
+        size = cls.size_for(pairs)
+        try:
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            # Сегмент остался от упавшего запуска
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        
+        shared = cls(shm, pairs, owner=True)
+        shared.HEADER.pack_into(shm.buf, 0, 0, 0.0)
+        shared.slots.pack_into(shm.buf, cls.HEADER.size, *([math.nan, 0.0] * len(pairs)))
+        return shared
+    
+    @classmethod
+    def attach(cls, name=RATES_SHM_NAME, pairs=SHARED_PAIRS):
+        """Подключается к существующему сегменту"""
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Python < 3.13 не умеет track=False
+            shm = shared_memory.SharedMemory(name=name)
+        return cls(shm, pairs)
+    
+    def publish(self, rates, timestamps=None, ts=None):
+        """Записывает курсы и время их получения (только процесс-фетчер)"""
+        if ts is None:
+            ts = time.time()
+        timestamps = timestamps or {}
+        buf = self.shm.buf
+        seq = self.SEQ.unpack_from(buf, 0)[0]
+        
+        # Нечётный seq — запись в процессе
+        self.SEQ.pack_into(buf, 0, seq + 1)
+        offset = self.HEADER.size
+        for i, pair in enumerate(self.pairs):
+            price = rates.get(pair)
+            if isinstance(price, (int, float)):
+                struct.pack_into('<dd', buf, offset + i * 16, float(price), timestamps.get(pair, ts))
+        struct.pack_into('<d', buf, 8, ts)
+        self.SEQ.pack_into(buf, 0, seq + 2)
+    
+    def seq(self):
+        """Текущий номер публикации (без чтения самих курсов)"""
+        return self.SEQ.unpack_from(self.shm.buf, 0)[0]
+    
+    def read(self, retries=100):
+        """Читает согласованный снимок: (seq, published_at, {pair: (price, ts)})"""
+        buf = self.shm.buf
+        for _ in range(retries):
+            seq, published_at = self.HEADER.unpack_from(buf, 0)
+            if seq & 1:
+                # Писатель посередине записи — уступаем ему процессор
+                time.sleep(0)
+                continue
+            values = self.slots.unpack_from(buf, self.HEADER.size)
+            if self.SEQ.unpack_from(buf, 0)[0] != seq:
+                continue
+            
+            snapshot = {}
+            for i, pair in enumerate(self.pairs):
+                price = values[i * 2]
+                if not math.isnan(price):
+                    snapshot[pair] = (price, values[i * 2 + 1])
+            return seq, published_at, snapshot
+        return None
+    
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+
+class AlertDemand:
+    """Близость алертов к цене по инструментам Twelve Data для процесса-фетчера
+    
+    Алерты живут в воркерах (главный процесс или шарды), а кредиты тратит фетчер.
+    У каждого воркера своя строка [distance: double] на инструмент (NaN — алертов нет);
+    фетчер берёт минимум по строкам. Строку пишет только её владелец, поэтому
+    блокировка не нужна: запись одного double не рвётся.
+    """
+    
+    def __init__(self, shm, writers, slot=None, pairs=tuple(TWELVEDATA_SYMBOLS), owner=False):
+        self.shm = shm
+        self.writers = writers
+        self.slot = slot    # None — читатель (фетчер)
+        self.pairs = pairs
+        self.row = struct.Struct(f'<{len(pairs)}d')
+        self.owner = owner
+    
+    @classmethod
+    def create(cls, name=DEMAND_SHM_NAME, writers=1):
+        pairs = tuple(TWELVEDATA_SYMBOLS)
+        size = max(1, writers * len(pairs) * 8)
+        try:
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        demand = cls(shm, writers, owner=True)
+        for slot in range(writers):
+            demand.row.pack_into(shm.buf, slot * demand.row.size, *([math.nan] * len(pairs)))
+        return demand
+    
+    @classmethod
+    def attach(cls, name=DEMAND_SHM_NAME, writers=1, slot=None):
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            shm = shared_memory.SharedMemory(name=name)
+        return cls(shm, writers, slot)
+    
+    def publish(self, distances):
+        """Записывает расстояния до ближайших алертов этого воркера"""
+        values = [math.nan if distances.get(pair) is None else distances[pair] for pair in self.pairs]
+        self.row.pack_into(self.shm.buf, self.slot * self.row.size, *values)
+    
+    def distance(self, pair):
+        """Минимальное расстояние по всем воркерам или None"""
+        i = self.pairs.index(pair)
+        best = None
+        for slot in range(self.writers):
+            value = struct.unpack_from('<d', self.shm.buf, slot * self.row.size + i * 8)[0]
+            if not math.isnan(value) and (best is None or value < best):
+                best = value
+        return best
+    
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+
+def run_fetcher_process(shm_name, interval=FETCH_INTERVAL, demand_writers=1):
+    """Точка входа процесса-фетчера: опрашивает провайдеров и публикует снимок"""
+    async def fetch_loop():
+        monitor = CurrencyMonitor(snapshot_file=f"{RUNTIME_SNAPSHOT_FILE}.fetcher")
+        # Своих алертов у фетчера нет: приоритеты Twelve Data берём у воркеров
+        monitor.alert_demand = AlertDemand.attach(writers=demand_writers)
+        shared = SharedRates.attach(shm_name)
+        start_background_imports()
+        # Сразу публикуем восстановленные курсы, чтобы воркерам не ждать первого опроса
+        shared.publish(*monitor.shared_payload())
+        snapshot_task = asyncio.create_task(monitor.runtime_snapshot_task())
+        logger.info(f"📡 Фетчер запущен (PID {os.getpid()}), общая память: {shm_name}")
+        try:
+            while True:
+                try:
+                    await monitor.fetch_rates()
+                    shared.publish(*monitor.shared_payload())
+                except Exception as e:
+                    logger.error(f"Fetcher error: {e}")
+                await asyncio.sleep(interval)
+        finally:
+            snapshot_task.cancel()
+            monitor.save_snapshot()
+            shared.close()
+            monitor.alert_demand.close()
+            if monitor.session:
+                await monitor.session.close()
+    
+    try:
+        asyncio.run(fetch_loop())
+    except KeyboardInterrupt:
+        pass
+
+def shard_for(chat_id, shard_count):
+    """Номер шарда для пользователя (стабилен между перезапусками)"""
+    return zlib.crc32(str(chat_id).encode()) % shard_count
+
+def update_chat_id(update):
+    """Достаёт chat_id из апдейта Telegram для маршрутизации"""
+    if 'message' in update:
+        return update['message']['chat']['id']
+    if 'callback_query' in update:
+        return update['callback_query']['message']['chat']['id']
+    if 'inline_query' in update:
+        # У inline-запроса нет чата — шард выбираем по пользователю
+        return update['inline_query']['from']['id']
+    return None
+
+def split_command(text):
+    """('/price', 'btc eth') из '/price@MyBot btc eth'; для обычного текста — ('', text)"""
+    if not text.startswith('/'):
+        return '', text
+    parts = text.split(maxsplit=1)
+    command = parts[0].split('@', 1)[0]
+    return command, parts[1].strip() if len(parts) > 1 else ''
+
+def configure_shard_storage(shard_id, shard_count):
+    """Переключает файлы данных на файлы шарда, при первом запуске переносит своих пользователей"""
+    global USER_ALERTS_FILE, STATS_FILE
+    
+    base_alerts_file, base_stats_file = USER_ALERTS_FILE, STATS_FILE
+    USER_ALERTS_FILE = f"user_alerts.shard{shard_id}.json"
+    STATS_FILE = f"user_stats.shard{shard_id}.json"
+    
+    def migrate(base_file, shard_file):
+        if os.path.exists(shard_file) or not os.path.exists(base_file):
+            return
+        with open(base_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        own = {uid: value for uid, value in data.items() if shard_for(uid, shard_count) == shard_id}
+        with open(shard_file, 'w', encoding='utf-8') as f:
+            json.dump(own, f, indent=2, ensure_ascii=False)
+        logger.info(f"📦 Шард {shard_id}: перенесено {len(own)} записей из {base_file}")
+    
+    migrate(base_alerts_file, USER_ALERTS_FILE)
+    migrate(base_stats_file, STATS_FILE)
+    load_user_state()
+
+def run_shard_worker(shard_id, shard_count, conn, shm_name):
+    """Точка входа процесса-шарда: свои алерты, статистика и состояния"""
+    configure_shard_storage(shard_id, shard_count)
+    
+    async def worker():
+        monitor = CurrencyMonitor(
+            shared_rates=SharedRates.attach(shm_name),
+            snapshot_file=f"{RUNTIME_SNAPSHOT_FILE}.shard{shard_id}"
+        )
+        monitor.shard_id = shard_id
+        monitor.alert_demand = AlertDemand.attach(writers=shard_count, slot=shard_id)
+        # Лимит Telegram общий на бота — шарды делят его поровну
+        monitor.telegram_throttle = TelegramThrottle(
+            rate=TELEGRAM_SEND_RATE / shard_count,
+            burst=max(1, TELEGRAM_SEND_BURST // shard_count)
+        )
+        await monitor.run_shard(conn)
+    
+    def on_terminate(signum, frame):
+        # terminate() из главного процесса: завершаемся через finally run_shard,
+        # чтобы сохранить снимок и погасить пул рендера графиков
+        raise KeyboardInterrupt
+    
+    signal.signal(signal.SIGTERM, on_terminate)
+    try:
+        asyncio.run(worker())
+    except KeyboardInterrupt:
+        pass
+
+def render_chart_png(pair, timeframe, candles):
+    """Рисует свечной график в PNG (выполняется в отдельном процессе)"""
+    import io
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import matplotlib.dates as mdates
+    
+    starts = [datetime.fromtimestamp(ts, ZoneInfo('UTC')) for ts in candles['start']]
+    period = CANDLE_TIMEFRAMES[timeframe]
+    width = period / 86400 * 0.7
+    
+    fig, ax = plt.subplots(figsize=(8, 4.5), dpi=100)
+    try:
+        for start, o, h, l, c in zip(starts, candles['open'], candles['high'], candles['low'], candles['close']):
+            color = '#26a69a' if c >= o else '#ef5350'
+            x = mdates.date2num(start)
+            ax.vlines(x, l, h, color=color, linewidth=1)
+            ax.bar(x, abs(c - o) or (h - l) * 0.02 or 1e-9, width, bottom=min(o, c), color=color)
+        
+        ax.set_title(f"{pair} · {timeframe}")
+        ax.xaxis_date()
+        ax.xaxis.set_major_formatter(mdates.DateFormatter('%d.%m %H:%M' if period < 86400 else '%d.%m'))
+        ax.grid(True, alpha=0.3)
+        fig.autofmt_xdate()
+        fig.tight_layout()
+        
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format='png')
+        return buffer.getvalue()
+    finally:
+        plt.close(fig)
+
+class CurrencyMonitor:
+    def __init__(self, shared_rates=None, snapshot_file=RUNTIME_SNAPSHOT_FILE):
+        self.session = None
+        self.snapshot_file = snapshot_file
+        # В раздельном режиме курсы читаются из общей памяти, а не у провайдеров
+        self.shared_rates = shared_rates
+        # Фронт-процесс: соединения с шардами, апдейты не обрабатываются локально
+        self.shard_conns = None
+        self.shard_id = None
+        # Общая память с близостью алертов для приоритетов Twelve Data (раздельный режим)
+        self.alert_demand = None
+        self.last_update_id = 0
+        self.alert_states = {}
+        
+        # Срабатывания, ожидающие отправки: user_id -> {'due', 'digest', 'items'}
+        self.pending_notifications = {}
+        self.notifications_sent = 0
+        
+        # Кэш ответов на inline-запросы: запрос -> (цены, JSON результатов)
+        self.inline_cache = OrderedDict()
+        self.inline_queries = 0
+        self.inline_cache_hits = 0
+        
+        # Общий темп отправки в Telegram и расписание ежедневных сводок
+        self.telegram_throttle = TelegramThrottle()
+        self.summaries = DailyScheduler()
+        self.summaries_sent = 0
+        
+        # Поток цен для подписчиков /stream
+        self.stream = PriceStream()
+        
+        # Готовые тела JSON API /rates (пересобираются при изменении котировок)
+        self.rates_api = None
+        self.rates_api_requests = 0
+        self.rates_api_not_modified = 0
+        
+        # Живые табло: user_id -> {'message_id', 'lines'} (lines — что сейчас показано)
+        self.boards = {}
+        self.board_edits = 0
+        self.board_skipped = 0
+        # Котировки с источником и временем получения; захардкоженные значения
+        # считаются устаревшими, пока не придут реальные данные
+        self.quotes = QuoteTable(DEFAULT_RATES)
+        
+        # Агрегатор OHLC-свечей из тиков
+        self.candles = CandleAggregator()
+        
+        # Кэш ответов провайдеров (условные запросы, next update) и метрики пула
+        self.http_cache = HttpCache()
+        self.http_metrics = HttpMetrics()
+        
+        # Одновременные запросы к одному провайдеру выполняются один раз
+        self.flights = SingleFlight()
+        
+        # Хедж-запросы к провайдерам с «хвостами» задержек
+        self.hedger = HedgedRequests()
+        
+        # Суточный бюджет кредитов Twelve Data
+        self.twelvedata_budget = CreditBudget()
+        
+        # Метрики консенсуса: отклонение каждого источника от опубликованной медианы
+        self.consensus_deviation = {}
+        self.consensus_rejected = Counter()
+        self.consensus_errors = Counter()
+        
+        # Полная таблица фиатных курсов для произвольных пар (EUR/JPY, GBP/RUB, ...)
+        self.cross_rates = CrossRateEngine()
+        self.fiat_body = None   # последнее тело таблицы фиата (HttpCache отдаёт тот же объект)
+        
+        # Графики: пул процессов для рендера и кэш (pair, tf, последняя свеча) -> картинка
+        self.chart_pool = None
+        self.chart_cache = OrderedDict()
+        self.chart_renders = {}
+        
         # Для кэширования индексов
         self.last_indices_update = None
         self.cached_indices = None
         
+        # Поднимаем кэши и offset апдейтов из последнего снимка
+        if self.snapshot_file:
+            self.restore_runtime_snapshot()
+        
         # Списки для форматирования цен
         self.currency_pairs = ['EUR/USD', 'GBP/USD', 'USD/JPY', 'USD/RUB', 'EUR/GBP', 'USD/CAD', 'AUD/USD', 'USD/CHF', 'USD/CNY']
         self.high_value_pairs = ['BTC/USD', 'ETH/USD', 'XAU/USD', 'XPT/USD', 'S&P 500', 'NASDAQ']
         self.low_value_pairs = ['DOGE/USD', 'XRP/USD']
     
+    def runtime_snapshot(self):
+        """Собирает рабочее состояние для тёплого перезапуска"""
+        return {
+            'saved_at': time.time(),
+            'last_update_id': self.last_update_id,
+            'quotes': self.quotes.to_dict(),
+            'alert_states': self.alert_states,
+            'pending_notifications': self.pending_notifications,
+            'cached_indices': self.cached_indices,
+            'fiat_rates': self.cross_rates.as_dict(),
+            'fiat_updated_at': self.cross_rates.updated_at,
+            'last_indices_update': self.last_indices_update.isoformat() if self.last_indices_update else None,
+        }
+    
+    def restore_runtime_snapshot(self):
+        """Восстанавливает состояние из снимка вместо захардкоженных значений"""
+        started = time.perf_counter()
+        snapshot = load_runtime_snapshot(self.snapshot_file)
+        if not snapshot:
+            return
+        
+        self.last_update_id = snapshot.get('last_update_id') or self.last_update_id
+        if snapshot.get('quotes'):
+            self.quotes.load(snapshot['quotes'])
+        else:
+            # Снимки старого формата: время получения неизвестно, считаем моментом сохранения
+            for pair, value in (snapshot.get('last_successful_rates') or {}).items():
+                self.quotes.set(pair, value, 'snapshot', snapshot.get('saved_at', 0))
+        self.alert_states.update(snapshot.get('alert_states') or {})
+        self.pending_notifications.update(snapshot.get('pending_notifications') or {})
+        self.cached_indices = snapshot.get('cached_indices')
+        if snapshot.get('fiat_rates'):
+            self.cross_rates.update(snapshot['fiat_rates'], snapshot.get('fiat_updated_at') or snapshot.get('saved_at'))
+        if snapshot.get('last_indices_update'):
+            self.last_indices_update = datetime.fromisoformat(snapshot['last_indices_update'])
+        
+        age = time.time() - snapshot.get('saved_at', 0)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        logger.info(f"♻️ Состояние восстановлено из {self.snapshot_file} (возраст {age:.0f} с, {elapsed_ms:.1f} мс)")
+    
+    def save_snapshot(self):
+        try:
+            # Пики трейлинг-алертов растут между сохранениями — сбрасываем их на диск вместе со снимком
+            if user_alerts.watch.dirty:
+                save_user_alerts(user_alerts)
+            save_runtime_snapshot(self.snapshot_file, self.runtime_snapshot())
+        except Exception as e:
+            logger.error(f"Snapshot save error: {e}")
+    
+    async def runtime_snapshot_task(self, interval=SNAPSHOT_INTERVAL):
+        """Периодически сохраняет снимок состояния"""
+        while True:
+            await asyncio.sleep(interval)
+            self.save_snapshot()
+    
     def is_user_allowed(self, chat_id):
         if not PRIVATE_MODE:
             return True
@@ -417,10 +2548,29 @@ class CurrencyMonitor:
         return str(chat_id) in [str(id) for id in ALLOWED_USER_IDS]
     
     async def get_session(self):
-        if self.session is None:
-            self.session = aiohttp.ClientSession()
+        """Общий пул соединений для всех исходящих запросов (провайдеры, Telegram, самопинг)"""
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=HTTP_POOL_LIMIT,
+                limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+                ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+                use_dns_cache=True,
+                keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=HTTP_TIMEOUTS['default'],
+                headers={'Accept-Encoding': 'gzip, deflate'},
+                auto_decompress=True,
+                trace_configs=[self.http_metrics.trace_config()],
+            )
         return self.session
     
+    async def get_json_cached(self, url, timeout=HTTP_TIMEOUTS['default'], expires=None):
+        """GET с HTTP-кэшем: учитывает время следующего обновления, ETag и Last-Modified"""
+        session = await self.get_session()
+        return await self.http_cache.get_json(session, url, timeout=timeout, expires=expires)
+    
     async def fetch_from_binance(self):
         """Получает курсы криптовалют с Binance (только выбранные)"""
         try:
@@ -438,7 +2588,7 @@ class CurrencyMonitor:
             for coin, symbol in symbols.items():
                 try:
                     url = f"https://api.binance.com/api/v3/ticker/price?symbol={symbol}"
-                    async with session.get(url, timeout=5) as response:
+                    async with session.get(url, timeout=HTTP_TIMEOUTS['binance']) as response:
                         if response.status == 200:
                             data = await response.json()
                             price = float(data['price'])
@@ -447,74 +2597,194 @@ class CurrencyMonitor:
                         await asyncio.sleep(0.1)
                 except Exception as e:
                     logger.warning(f"Binance {coin} error: {e}")
-                    if f"{coin}/USD" in self.last_successful_rates:
-                        result[f"{coin}/USD"] = self.last_successful_rates[f"{coin}/USD"]
             
             return result
         except Exception as e:
             logger.error(f"Binance API error: {e}")
             return None
     
-    async def fetch_gold_price(self):
-        """Получает цену золота через Gold-API"""
-        try:
-            session = await self.get_session()
-            url = "https://api.gold-api.com/price/XAU"
-            
-            async with session.get(url, timeout=10) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    price = float(data['price'])
-                    
-                    if price and price > 1000 and price < 10000:
-                        logger.info(f"✅ Золото: ${price:.2f}/унция (источник: Gold-API)")
-                        return price
-        except Exception as e:
-            logger.error(f"Gold-API error: {e}")
+    async def quote_from_gold_api(self, instrument):
+        """Котировка металла с Gold-API: (цена, время провайдера)"""
+        url = f"https://api.gold-api.com/price/{GOLD_API_SYMBOLS[instrument]}"
+        # Попадания в кэш мимо хеджера: нулевые задержки занизили бы его p90
+        data = self.http_cache.fresh(url)
+        if data is None:
+            data = await self.hedger.run('gold_api', lambda: self.get_json_cached(url, timeout=HTTP_TIMEOUTS['gold']))
+        if data is None:
+            return None
+        provider_ts = time.time()
+        if data.get('updatedAt'):
+            provider_ts = datetime.fromisoformat(data['updatedAt'].replace('Z', '+00:00')).timestamp()
+        return float(data['price']), provider_ts
+    
+    async def quote_from_binance_paxg(self, instrument):
+        """Золото через токен PAXG (1 PAXG = 1 тройская унция)"""
+        session = await self.get_session()
+        url = "https://api.binance.com/api/v3/ticker/price?symbol=PAXGUSDT"
+        async with session.get(url, timeout=HTTP_TIMEOUTS['binance']) as response:
+            if response.status != 200:
+                return None
+            data = await response.json()
+            return float(data['price']), time.time()
+    
+    async def quote_from_yahoo(self, instrument):
+        """Котировка из Yahoo Finance chart API (без библиотеки yfinance)"""
+        session = await self.get_session()
+        url = f"https://query1.finance.yahoo.com/v8/finance/chart/{YAHOO_SYMBOLS[instrument]}?interval=1d&range=1d"
+        headers = {'User-Agent': 'Mozilla/5.0'}
+        async with session.get(url, timeout=HTTP_TIMEOUTS['quotes'], headers=headers) as response:
+            if response.status != 200:
+                return None
+            data = await response.json()
+            meta = data['chart']['result'][0]['meta']
+            return float(meta['regularMarketPrice']), float(meta.get('regularMarketTime') or time.time())
+    
+    async def quote_from_stooq(self, instrument):
+        """Котировка из CSV Stooq"""
+        session = await self.get_session()
+        url = f"https://stooq.com/q/l/?s={STOOQ_SYMBOLS[instrument]}&f=sd2t2c&h&e=csv"
+        async with session.get(url, timeout=HTTP_TIMEOUTS['quotes']) as response:
+            if response.status != 200:
+                return None
+            lines = (await response.text()).strip().splitlines()
+            if len(lines) < 2:
+                return None
+            symbol, date, time_str, close = lines[1].split(',')[:4]
+            if close in ('N/D', ''):
+                return None
+            provider_ts = time.time()
+            try:
+                provider_ts = datetime.fromisoformat(f"{date}T{time_str}").replace(tzinfo=ZoneInfo('Europe/Warsaw')).timestamp()
+            except ValueError:
+                pass
+            return float(close), provider_ts
+    
+    async def quote_from_yfinance(self, instrument):
+        """Котировка через yfinance (блокирующий вызов уходит в поток)"""
+        if yf is None:
+            return None
+        
+        def load_info():
+            return yf.Ticker(YAHOO_SYMBOLS[instrument]).info
         
-        return self.last_successful_rates.get('XAU/USD', 5160.0)
+        info = await asyncio.to_thread(load_info)
+        price = info.get('regularMarketPrice') or info.get('currentPrice')
+        if price is None:
+            return None
+        return float(price), float(info.get('regularMarketTime') or time.time())
     
-    async def fetch_silver_price(self):
-        """Получает цену серебра через Gold-API"""
+    async def consensus_quote(self, instrument):
+        """Медиана свежих котировок нескольких источников
+        
+        Источники опрашиваются параллельно; как только набирается кворум согласных
+        значений, результат публикуется, а медленные источники отменяются.
+        """
+        config = CONSENSUS_CONFIG[instrument]
+        bounds = config['bounds']
+        now = time.time()
+        
+        tasks = {
+            asyncio.ensure_future(getattr(self, f"quote_from_{source}")(instrument)): source
+            for source in config['sources']
+        }
+        values = {}
+        price = None
+        deadline = asyncio.get_running_loop().time() + CONSENSUS_TIMEOUT
+        pending = set(tasks)
+        
         try:
-            session = await self.get_session()
-            url = "https://api.gold-api.com/price/XAG"
-            
-            async with session.get(url, timeout=10) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    price = float(data['price'])
-                    
-                    if price and price > 10 and price < 100:
-                        logger.info(f"✅ Серебро: ${price:.2f}/унция")
-                        return price
-        except Exception as e:
-            logger.error(f"Silver API error: {e}")
+            while pending:
+                remaining = deadline - asyncio.get_running_loop().time()
+                if remaining <= 0:
+                    break
+                done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                
+                for task in done:
+                    source = tasks[task]
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        self.consensus_errors[(instrument, source)] += 1
+                        logger.warning(f"{instrument} {source} error: {e}")
+                        continue
+                    if not result:
+                        continue
+                    value, provider_ts = result
+                    if bounds and not (bounds[0] < value < bounds[1]):
+                        self.consensus_rejected[(instrument, source)] += 1
+                        continue
+                    if now - provider_ts > config['max_age']:
+                        self.consensus_rejected[(instrument, source)] += 1
+                        continue
+                    values[source] = value
+                
+                if len(values) >= CONSENSUS_QUORUM:
+                    agreed = self.agreeing_values(values)
+                    if len(agreed) >= CONSENSUS_QUORUM:
+                        price = statistics.median(agreed.values())
+                        break
+        finally:
+            for task in pending:
+                task.cancel()
+        
+        if price is None and values:
+            # Кворума нет — берём значение, ближайшее к последней известной цене
+            previous = self.quotes.value(instrument)
+            if previous:
+                price = min(values.values(), key=lambda value: abs(value - previous))
+            else:
+                price = statistics.median(values.values())
+            logger.warning(f"⚠️ {instrument}: нет кворума, источников {len(values)}")
         
-        return self.last_successful_rates.get('XAG/USD', 30.0)
+        if price is not None:
+            for source, value in values.items():
+                deviation = (value - price) / price
+                self.consensus_deviation[(instrument, source)] = deviation
+                if abs(deviation) > CONSENSUS_OUTLIER:
+                    self.consensus_rejected[(instrument, source)] += 1
+            logger.info(f"✅ {instrument}: {price:.2f} (источников: {len(values)})")
+        
+        return price
     
-    async def fetch_platinum_price(self):
-        """Получает цену платины через Gold-API"""
+    @staticmethod
+    def agreeing_values(values):
+        """Отбрасывает выбросы дальше CONSENSUS_OUTLIER от медианы"""
+        median = statistics.median(values.values())
+        return {source: value for source, value in values.items()
+                if abs(value - median) / median <= CONSENSUS_OUTLIER}
+    
+    async def fetch_consensus_price(self, instrument):
+        """Цена по консенсусу источников или None"""
         try:
-            session = await self.get_session()
-            url = "https://api.gold-api.com/price/XPT"
-            
-            async with session.get(url, timeout=10) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    price = float(data['price'])
-                    
-                    if price and price > 500 and price < 5000:
-                        logger.info(f"✅ Платина: ${price:.2f}/унция")
-                        return price
+            return await self.consensus_quote(instrument)
         except Exception as e:
-            logger.error(f"Platinum API error: {e}")
-        
-        return self.last_successful_rates.get('XPT/USD', 1000.0)
+            logger.error(f"{instrument} consensus error: {e}")
+            return None
+    
+    async def fetch_gold_price(self):
+        """Получает цену золота (медиана нескольких источников)"""
+        return await self.fetch_consensus_price('XAU/USD')
+    
+    async def fetch_silver_price(self):
+        """Получает цену серебра (медиана нескольких источников)"""
+        return await self.fetch_consensus_price('XAG/USD')
+    
+    async def fetch_platinum_price(self):
+        """Получает цену платины (медиана нескольких источников)"""
+        return await self.fetch_consensus_price('XPT/USD')
+    
+    async def fetch_metals(self):
+        """Металлы (3 пары) — источники всех металлов опрашиваются параллельно"""
+        prices = await asyncio.gather(
+            self.flights.do('gold', self.fetch_gold_price),
+            self.flights.do('silver', self.fetch_silver_price),
+            self.flights.do('platinum', self.fetch_platinum_price)
+        )
+        return {pair: price for pair, price in zip(('XAU/USD', 'XAG/USD', 'XPT/USD'), prices) if price is not None}
     
     async def fetch_oil_prices(self):
         """Получает цены на нефть через yfinance"""
-        if YFINANCE_AVAILABLE:
+        if yf is not None:
             try:
                 wti = yf.Ticker("CL=F")
                 brent = yf.Ticker("BZ=F")
@@ -540,10 +2810,7 @@ class CurrencyMonitor:
             except Exception as e:
                 logger.warning(f"Oil price error: {e}")
         
-        return {
-            'WTI/USD': self.last_successful_rates.get('WTI/USD', 75.0),
-            'BRENT/USD': self.last_successful_rates.get('BRENT/USD', 78.0)
-        }
+        return None
     
     async def fetch_indices(self):
         """Получает значения индексов из нескольких источников с переключением"""
@@ -556,188 +2823,620 @@ class CurrencyMonitor:
                 logger.info("📊 Индексы из кэша (обновление раз в минуту)")
                 return self.cached_indices
         
-        # Источник 1: yfinance (если доступен)
-        if YFINANCE_AVAILABLE:
-            try:
-                spy = yf.Ticker("SPY")
-                qqq = yf.Ticker("QQQ")
-                
-                spy_info = spy.info
-                qqq_info = qqq.info
-                
-                if 'regularMarketPrice' in spy_info:
-                    result['S&P 500'] = float(spy_info['regularMarketPrice'])
-                elif 'currentPrice' in spy_info:
-                    result['S&P 500'] = float(spy_info['currentPrice'])
-                
-                if 'regularMarketPrice' in qqq_info:
-                    result['NASDAQ'] = float(qqq_info['regularMarketPrice'])
-                elif 'currentPrice' in qqq_info:
-                    result['NASDAQ'] = float(qqq_info['currentPrice'])
-                
-                if result:
-                    logger.info("✅ Индексы от yfinance")
-                    self.cached_indices = result
-                    self.last_indices_update = now
-                    return result
-            except Exception as e:
-                logger.warning(f"yfinance error: {e}")
+        # Оба индекса опрашиваются параллельно, каждый — по нескольким источникам
+        instruments = ('S&P 500', 'NASDAQ')
+        quotes = await asyncio.gather(
+            *(self.consensus_quote(instrument) for instrument in instruments),
+            return_exceptions=True
+        )
+        for instrument, price in zip(instruments, quotes):
+            if isinstance(price, Exception):
+                logger.warning(f"{instrument} consensus error: {price}")
+            elif price is not None:
+                result[instrument] = price
         
-        # Если все источники упали, возвращаем кэш
-        logger.warning("⚠️ Все источники индексов недоступны, использую кэш")
-        return self.cached_indices if self.cached_indices else {
-            'S&P 500': self.last_successful_rates.get('S&P 500', 5100.0),
-            'NASDAQ': self.last_successful_rates.get('NASDAQ', 18000.0)
-        }
+        if result:
+            logger.info("✅ Индексы по консенсусу источников")
+            self.cached_indices = {**(self.cached_indices or {}), **result}
+            self.last_indices_update = now
+            return self.cached_indices
+        
+        # Все источники упали — котировки останутся прежними и постепенно устареют
+        logger.warning("⚠️ Все источники индексов недоступны")
+        return None
+    
+    def alert_distance(self, pair, price):
+        """Относительное расстояние от цены до ближайшего активного алерта (или None)"""
+        if self.alert_demand is not None and self.alert_demand.slot is None:
+            return self.alert_demand.distance(pair)
+        return user_alerts.nearest_distance(pair, price)
+    
+    def publish_alert_demand(self):
+        """Сообщает фетчеру, насколько близко алерты этого воркера к ценам Twelve Data"""
+        distances = {}
+        for pair in TWELVEDATA_SYMBOLS:
+            price = self.quotes.value(pair)
+            distances[pair] = user_alerts.nearest_distance(pair, price) if price else None
+        self.alert_demand.publish(distances)
+    
+    def plan_twelvedata(self, now=None):
+        """Выбирает инструменты Twelve Data для опроса в этом тике с учётом бюджета"""
+        now = now if now is not None else time.time()
+        candidates = []
+        for pair in TWELVEDATA_SYMBOLS:
+            price = self.quotes.value(pair)
+            distance = self.alert_distance(pair, price) if price else None
+            if distance is not None and distance <= TWELVEDATA_NEAR_ALERT:
+                priority = 'near'
+            elif distance is not None:
+                priority = 'alerts'
+            else:
+                priority = 'idle'
+            
+            if self.quotes.age(pair, now) < TWELVEDATA_REFRESH[priority]:
+                continue
+            candidates.append((priority != 'near', -self.quotes.age(pair, now), pair, priority))
+        
+        # Сначала алерты рядом с ценой, затем самые устаревшие
+        candidates.sort()
+        planned = []
+        for _, _, pair, priority in candidates:
+            reserve = 0 if priority == 'near' else TWELVEDATA_RESERVE
+            if self.twelvedata_budget.try_spend(1, reserve=reserve, now=now):
+                planned.append(pair)
+        return planned
     
-    async def fetch_corn_price(self):
-        """Получает цену кукурузы через Twelve Data"""
+    async def fetch_twelvedata(self):
+        """Товары из Twelve Data: один пакетный запрос по инструментам, на которые хватает кредитов"""
+        pairs = self.plan_twelvedata()
+        if not pairs:
+            return None
+        symbols = {TWELVEDATA_SYMBOLS[pair]: pair for pair in pairs}
+        symbol_list = ','.join(symbols)
+        
         try:
             session = await self.get_session()
-            url = f"https://api.twelvedata.com/quote?symbol=ZC&apikey={TWELVEDATA_KEY}"
             
-            async with session.get(url, timeout=10) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    if 'close' in data:
-                        price = float(data['close'])
-                        logger.info(f"✅ Кукуруза: ${price:.2f}/бушель")
-                        return price
-                    elif 'code' in data and data['code'] == 401:
-                        logger.error(f"Twelve Data ошибка: {data.get('message', 'Нет доступа')}")
-                else:
-                    logger.warning(f"Кукуруза API вернул статус {response.status}")
-                    
-        except Exception as e:
-            logger.error(f"Corn API error: {e}")
+            async def request(endpoint):
+                url = f"https://api.twelvedata.com/{endpoint}?symbol={symbol_list}&apikey={TWELVEDATA_KEY}"
+                async with session.get(url, timeout=HTTP_TIMEOUTS['twelvedata']) as response:
+                    if response.status != 200:
+                        return response.status, None
+                    return response.status, await response.json()
+            
+            # Запасной эндпоинт /price отвечает быстрее, если /quote застрял
+            hedges_before = self.hedger.hedges['twelvedata']
+            status, data = await self.hedger.run('twelvedata', lambda: request('quote'), lambda: request('price'))
+            if self.hedger.hedges['twelvedata'] != hedges_before:
+                self.twelvedata_budget.charge(len(symbols))
+            
+            if status != 200:
+                logger.warning(f"Twelve Data вернул статус {status}")
+                return None
+            
+            # Для одного символа ответ плоский, для нескольких — словарь по символам
+            if len(symbols) == 1:
+                data = {symbol_list: data}
+            
+            result = {}
+            for symbol, item in data.items():
+                pair = symbols.get(symbol)
+                if pair is None or not isinstance(item, dict):
+                    continue
+                if 'close' in item or 'price' in item:
+                    result[pair] = float(item.get('close', item.get('price')))
+                    logger.info(f"✅ {pair}: ${result[pair]:.2f} (Twelve Data)")
+                elif item.get('code') == 401:
+                    logger.error(f"Twelve Data ошибка: {item.get('message', 'Нет доступа')}")
+                elif item.get('code') == 429:
+                    # Квота закончилась раньше, чем мы рассчитывали
+                    self.twelvedata_budget.tokens = 0
+                    logger.warning(f"Twelve Data: лимит кредитов ({item.get('message', '')})")
+            return result or None
         
-        return self.last_successful_rates.get('CORN/USD', 4.50)
+        except Exception as e:
+            logger.error(f"Twelve Data error: {e}")
+            return None
     
     async def fetch_from_fiat_api(self):
         """Получает курсы фиатных валют (все 9 пар)"""
         try:
-            session = await self.get_session()
             url = "https://open.er-api.com/v6/latest/USD"
-            async with session.get(url, timeout=5) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    rates = data['rates']
-                    
-                    result = {}
-                    
-                    # Основные валюты
-                    if 'RUB' in rates:
-                        result['USD/RUB'] = rates['RUB']
-                    if 'EUR' in rates:
-                        result['EUR/USD'] = 1.0 / rates['EUR']
-                    if 'GBP' in rates:
-                        result['GBP/USD'] = 1.0 / rates['GBP']
-                    if 'JPY' in rates:
-                        result['USD/JPY'] = rates['JPY']
-                    if 'CNY' in rates:
-                        result['USD/CNY'] = 1.0 / rates['CNY']
-                    if 'CAD' in rates:
-                        result['USD/CAD'] = rates['CAD']
-                    if 'AUD' in rates:
-                        result['AUD/USD'] = 1.0 / rates['AUD']
-                    if 'CHF' in rates:
-                        result['USD/CHF'] = rates['CHF']
-                    
-                    # EUR/GBP
-                    if 'EUR' in rates and 'GBP' in rates:
-                        eur_usd = 1.0 / rates['EUR']
-                        gbp_usd = 1.0 / rates['GBP']
-                        result['EUR/GBP'] = eur_usd / gbp_usd
-                    
-                    return result
+            # Таблица обновляется раз в сутки: до time_next_update_unix запрос не нужен
+            data = await self.get_json_cached(url, timeout=HTTP_TIMEOUTS['fiat'], expires=lambda d: d.get('time_next_update_unix'))
+            if data is not None:
+                rates = data['rates']
+                
+                # Сохраняем весь вектор: из него считаются любые кросс-курсы.
+                # Тот же объект из HttpCache — таблица не менялась, время её публикации тоже
+                if data is not self.fiat_body:
+                    self.fiat_body = data
+                    self.cross_rates.update(rates, data.get('time_last_update_unix'))
+                
+                result = {}
+                
+                # Основные валюты
+                if 'RUB' in rates:
+                    result['USD/RUB'] = rates['RUB']
+                if 'EUR' in rates:
+                    result['EUR/USD'] = 1.0 / rates['EUR']
+                if 'GBP' in rates:
+                    result['GBP/USD'] = 1.0 / rates['GBP']
+                if 'JPY' in rates:
+                    result['USD/JPY'] = rates['JPY']
+                if 'CNY' in rates:
+                    result['USD/CNY'] = 1.0 / rates['CNY']
+                if 'CAD' in rates:
+                    result['USD/CAD'] = rates['CAD']
+                if 'AUD' in rates:
+                    result['AUD/USD'] = 1.0 / rates['AUD']
+                if 'CHF' in rates:
+                    result['USD/CHF'] = rates['CHF']
+                
+                # EUR/GBP
+                if 'EUR' in rates and 'GBP' in rates:
+                    eur_usd = 1.0 / rates['EUR']
+                    gbp_usd = 1.0 / rates['GBP']
+                    result['EUR/GBP'] = eur_usd / gbp_usd
+                
+                return result
         except Exception as e:
             logger.error(f"Fiat API error: {e}")
-            return {
-                'EUR/USD': self.last_successful_rates.get('EUR/USD', 1.08),
-                'GBP/USD': self.last_successful_rates.get('GBP/USD', 1.26),
-                'USD/JPY': self.last_successful_rates.get('USD/JPY', 155.0),
-                'USD/RUB': self.last_successful_rates.get('USD/RUB', 90.0),
-                'EUR/GBP': self.last_successful_rates.get('EUR/GBP', 0.87),
-                'USD/CAD': self.last_successful_rates.get('USD/CAD', 1.35),
-                'AUD/USD': self.last_successful_rates.get('AUD/USD', 0.65),
-                'USD/CHF': self.last_successful_rates.get('USD/CHF', 0.88),
-                'USD/CNY': self.last_successful_rates.get('USD/CNY', 7.25),
-            }
+            return None
+    
+    def read_shared_rates(self):
+        """Читает курсы из общей памяти, которую заполняет процесс-фетчер"""
+        result = self.shared_rates.read()
+        if result is None:
+            logger.warning("⚠️ Не удалось прочитать согласованный снимок курсов")
+            all_rates = self.quotes.values()
+            self.add_cross_rates(all_rates)
+            return all_rates
+        
+        seq, published_at, snapshot = result
+        fiat = {}
+        fiat_ts = 0.0
+        for pair, (price, ts) in snapshot.items():
+            if pair.startswith('FX:'):
+                fiat[pair[3:]] = price
+                fiat_ts = max(fiat_ts, ts)
+                continue
+            
+            # Время получения публикует фетчер — свежесть видна и в воркерах
+            quote = self.quotes.get(pair)
+            if quote is None or ts > quote.fetched_at:
+                self.quotes.set(pair, price, 'shared', ts)
+                if ts:
+                    self.candles.add_tick(pair, price, ts)
+        
+        if fiat and seq != self.shared_rates.last_seq:
+            self.shared_rates.last_seq = seq
+            self.cross_rates.update(fiat, fiat_ts or published_at)
+        
+        all_rates = self.quotes.values()
+        self.add_cross_rates(all_rates)
+        return all_rates
+    
+    def cross_pairs_in_use(self):
+        """Кросс-пары, на которые есть алерты (закрепления досчитываются по запросу в current_price)"""
+        return sorted(pair for pair in user_alerts.pairs() if pair not in self.quotes)
+    
+    def add_cross_rates(self, rates):
+        """Досчитывает кросс-курсы для используемых пар одной пачкой"""
+        pairs = self.cross_pairs_in_use()
+        if pairs:
+            rates.update(self.cross_rates.rates_for(pairs))
+        return rates
+    
+    def shared_payload(self):
+        """Данные для общей памяти: котировки и вектор USD-курсов с временем получения"""
+        payload = self.quotes.values()
+        timestamps = self.quotes.timestamps()
+        for code, value in self.cross_rates.as_dict().items():
+            payload[f"FX:{code}"] = value
+            timestamps[f"FX:{code}"] = self.cross_rates.updated_at or 0.0
+        return payload, timestamps
     
     async def fetch_rates(self):
         """Получает все курсы"""
-        all_rates = {}
+        if self.shared_rates is not None:
+            return self.read_shared_rates()
         
-        # Фиатные валюты (9 пар)
-        fiat = await self.fetch_from_fiat_api()
-        if fiat:
-            all_rates.update(fiat)
+        providers = {
+            'fiat': self.fetch_from_fiat_api,      # Фиатные валюты (9 пар)
+            'binance': self.fetch_from_binance,    # Криптовалюты (5 пар)
+            'metals': self.fetch_metals,           # Металлы (3 пары)
+            'indices': self.fetch_indices,         # Индексы (2 пары)
+            'twelvedata': self.fetch_twelvedata,   # Товары (3 пары)
+            'oil': self.fetch_oil_prices,
+        }
         
-        # Криптовалюты (5 пар)
-        crypto = await self.fetch_from_binance()
-        if crypto:
-            all_rates.update(crypto)
+        # Первыми обновляем провайдеров с самыми устаревшими котировками
+        now = time.time()
+        order = sorted(providers, key=lambda key: self.quotes.staleness(PROVIDERS[key]['pairs'], now), reverse=True)
         
-        # Металлы (3 пары)
-        gold = await self.fetch_gold_price()
-        all_rates['XAU/USD'] = gold
+        updated = {}
+        for key in order:
+            result = await self.flights.do(key, providers[key])
+            if not result:
+                continue
+            
+            fetched_at = time.time()
+            if key == 'indices' and self.last_indices_update:
+                # Индексы могли прийти из минутного кэша
+                fetched_at = self.last_indices_update.timestamp()
+            for pair, value in result.items():
+                self.quotes.set(pair, value, PROVIDERS[key]['source'], fetched_at)
+            updated.update(result)
+            # Подписчики потока получают цены провайдера, не дожидаясь остальных
+            self.stream.wake.set()
         
-        silver = await self.fetch_silver_price()
-        all_rates['XAG/USD'] = silver
+        # В свечи попадают только реально полученные значения
+        if updated:
+            self.candles.add_rates(updated)
         
-        platinum = await self.fetch_platinum_price()
-        all_rates['XPT/USD'] = platinum
+        all_rates = self.quotes.values()
+        self.add_cross_rates(all_rates)
+        return all_rates
+    
+    def is_quote_fresh(self, pair, now=None):
+        """Свежая ли котировка (для кросс-курсов — по времени обновления таблицы)"""
+        if pair in self.quotes:
+            return self.quotes.is_fresh(pair, now)
+        updated_at = self.cross_rates.updated_at
+        if not updated_at:
+            return False
+        return (now if now is not None else time.time()) - updated_at <= FX_TABLE_MAX_AGE
+    
+    def freshness_note(self, pair):
+        """Пометка для интерфейса, если котировка устарела"""
+        if self.is_quote_fresh(pair):
+            return ""
+        quote = self.quotes.get(pair)
+        if quote is None or not quote.fetched_at:
+            return " ⚠️ нет свежих данных"
+        minutes = int(quote.age() // 60)
+        return f" ⚠️ обновлено {minutes} мин назад"
+    
+    def resolve_pair(self, text):
+        """Пара по синониму ('btc', 'золото', 'eurusd', 'eur/jpy') или None"""
+        key = alias_key(text)
+        pair = PAIR_ALIAS_INDEX.get(key)
+        if pair is None:
+            pair = self.cross_rates.normalize_pair(key)
+        return pair
+    
+    def current_price(self, pair):
+        """Цена из таблицы котировок или кросс-курс, без обращения к провайдерам"""
+        value = self.quotes.value(pair)
+        return value if value is not None else self.cross_rates.rate(pair)
+    
+    def unit_in_usd(self, unit):
+        """Стоимость одной единицы (валюты или актива) в долларах"""
+        if unit == 'USD':
+            return 1.0
+        if unit in self.quotes:
+            return self.quotes.value(unit)
+        return self.cross_rates.rate(f"{unit}/USD")
+    
+    async def show_prices(self, chat_id, args):
+        """/price btc eurusd золото — цены из памяти, несколько пар за раз"""
+        tokens = [token for token in re.split(r'[\s,;]+', args) if token]
+        if not tokens:
+            await self.send_telegram_message(chat_id, "💰 Использование: /price btc eurusd золото")
+            return
         
-        # Индексы (2 пары)
-        indices = await self.fetch_indices()
-        if indices:
-            all_rates.update(indices)
+        # Сначала пробуем всю строку целиком ('S&P 500', 'eur jpy')
+        whole = self.resolve_pair(args)
+        pairs = [whole] if whole else [self.resolve_pair(token) or token for token in tokens]
         
-        # Товары (3 пары)
-        corn = await self.fetch_corn_price()
-        all_rates['CORN/USD'] = corn
+        lines = []
+        for pair in pairs:
+            price = self.current_price(pair)
+            # Сообщение уходит с parse_mode HTML: сырой ввод вроде '<b' сломал бы весь ответ
+            name = html.escape(pair)
+            if price is None:
+                lines.append(f"❓ {name}: не знаю такую пару")
+            else:
+                lines.append(f"💰 {name}: {self.format_price(pair, price)}{self.freshness_note(pair)}")
+        await self.send_telegram_message(chat_id, "\n".join(lines))
+    
+    async def convert_amount(self, chat_id, args):
+        """/convert 100 usd rub — пересчёт через курсы к доллару"""
+        match = re.fullmatch(r'\s*([\d.,]+)\s*(\S+)\s+(?:(?:в|to|in)\s+)?(\S+)\s*', args)
+        amount = None
+        if match:
+            try:
+                amount = float(match.group(1).replace(',', '.'))
+            except ValueError:
+                amount = None
+        if amount is None:
+            await self.send_telegram_message(chat_id, "💱 Использование: /convert 100 usd rub\n\nМожно и так: /convert 0.5 btc в рубли")
+            return
         
-        oil = await self.fetch_oil_prices()
-        if oil:
-            all_rates.update(oil)
+        source = UNIT_ALIAS_INDEX.get(alias_key(match.group(2)))
+        target = UNIT_ALIAS_INDEX.get(alias_key(match.group(3)))
+        source_usd = self.unit_in_usd(source) if source else None
+        target_usd = self.unit_in_usd(target) if target else None
+        if not source_usd or not target_usd:
+            unknown = match.group(2) if not source_usd else match.group(3)
+            await self.send_telegram_message(chat_id, f"❓ Не знаю, как пересчитать «{html.escape(unknown)}»")
+            return
         
-        if all_rates:
-            self.last_successful_rates.update(all_rates)
-            return all_rates
+        result = amount * source_usd / target_usd
+        source_name, target_name = source.split('/')[0], target.split('/')[0]
+        result_str = f"{result:.2f}" if abs(result) >= 1 else f"{result:.8f}".rstrip('0')
+        notes = {self.freshness_note(unit) for unit in (source, target) if '/' in unit}
+        await self.send_telegram_message(
+            chat_id,
+            f"💱 {amount:g} {source_name} = <b>{result_str}</b> {target_name}{''.join(notes)}"
+        )
+    
+    def inline_results(self, query):
+        """Результаты inline-запроса как готовый JSON
         
-        return self.last_successful_rates
+        Кэш по нормализованному запросу; запись годится, пока не изменилась
+        ни одна из цен, из которых она собрана.
+        """
+        key = alias_key(query)
+        pairs = pairs_by_prefix(key)
+        if not pairs:
+            cross = self.cross_rates.normalize_pair(key)
+            pairs = [cross] if cross else []
+        prices = tuple(self.current_price(pair) for pair in pairs)
+        
+        cached = self.inline_cache.get(key)
+        if cached is not None and cached[0] == prices:
+            self.inline_cache.move_to_end(key)
+            self.inline_cache_hits += 1
+            return cached[1]
+        
+        results = []
+        for pair, price in zip(pairs, prices):
+            if price is None:
+                continue
+            price_str = self.format_price(pair, price)
+            note = self.freshness_note(pair)
+            results.append({
+                'type': 'article',
+                'id': alias_key(pair),
+                'title': f"{pair} — {price_str}",
+                'description': note.strip() or "Курс из последнего обновления",
+                'input_message_content': {'message_text': f"💰 {pair}: {price_str}{note}"},
+            })
+        
+        results_json = json.dumps(results, ensure_ascii=False)
+        self.inline_cache[key] = (prices, results_json)
+        if len(self.inline_cache) > INLINE_CACHE_SIZE:
+            self.inline_cache.popitem(last=False)
+        return results_json
     
-    async def send_telegram_message(self, chat_id, message):
+    async def handle_inline_query(self, update):
+        """Отвечает на @bot <запрос> ценами из памяти"""
         try:
+            if 'inline_query' not in update:
+                return
+            
+            query = update['inline_query']
+            if not self.is_user_allowed(query['from']['id']):
+                return
+            self.inline_queries += 1
+            
+            results_json = self.inline_results(query.get('query', ''))
+            body = (
+                f'{{"inline_query_id": {json.dumps(query["id"])}, '
+                f'"results": {results_json}, "cache_time": {INLINE_CACHE_TIME}}}'
+            )
+            
             session = await self.get_session()
-            url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
+            url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/answerInlineQuery"
+            async with session.post(url, data=body.encode('utf-8'), headers={'Content-Type': 'application/json'},
+                                    timeout=HTTP_TIMEOUTS['telegram']) as response:
+                if response.status != 200:
+                    self.handle_telegram_error(response.status, await response.text())
+        except Exception as e:
+            logger.error(f"Inline query error: {e}")
+    
+    def handle_telegram_error(self, status, text):
+        """Логирует ошибку Telegram; на 429 притормаживает всю отправку и возвращает retry_after"""
+        logger.error(f"Telegram error: {text}")
+        if status != 429:
+            return None
+        try:
+            retry_after = json.loads(text).get('parameters', {}).get('retry_after', 1)
+        except ValueError:
+            retry_after = 1
+        self.telegram_throttle.penalize(retry_after)
+        return retry_after
+    
+    async def post_telegram(self, method, build_form=None, **kwargs):
+        """POST в Bot API через общий троттлинг, возвращает (status, text)
+        
+        На 429 запрос один раз повторяется: acquire() дождётся retry_after,
+        потому что handle_telegram_error уже оштрафовал бакет. Multipart-тело
+        одноразовое, поэтому его собирает build_form заново для каждой попытки.
+        """
+        session = await self.get_session()
+        url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/{method}"
+        for attempt in range(2):
+            if build_form is not None:
+                kwargs['data'] = build_form()
+            await self.telegram_throttle.acquire()
+            async with session.post(url, timeout=HTTP_TIMEOUTS['telegram'], **kwargs) as response:
+                status, text = response.status, await response.text()
+            if status == 429 and attempt == 0:
+                self.handle_telegram_error(status, text)
+                continue
+            return status, text
+    
+    async def send_telegram_message(self, chat_id, message):
+        try:
             payload = {
                 'chat_id': chat_id,
                 'text': message,
                 'parse_mode': 'HTML'
             }
-            async with session.post(url, json=payload) as response:
-                if response.status != 200:
-                    logger.error(f"Telegram error: {await response.text()}")
+            status, text = await self.post_telegram('sendMessage', json=payload)
+            if status != 200:
+                self.handle_telegram_error(status, text)
         except Exception as e:
             logger.error(f"Error sending Telegram: {e}")
     
     async def send_telegram_message_with_keyboard(self, chat_id, message, keyboard):
         try:
-            session = await self.get_session()
-            url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-            
+            # Клавиатуру можно передать уже сериализованной (общие клавиатуры рассылок)
             payload = {
                 'chat_id': chat_id,
                 'text': message,
                 'parse_mode': 'HTML',
-                'reply_markup': json.dumps(keyboard)
+                'reply_markup': keyboard if isinstance(keyboard, str) else json.dumps(keyboard)
             }
-            async with session.post(url, json=payload) as response:
-                if response.status != 200:
-                    logger.error(f"Telegram error: {await response.text()}")
+            status, text = await self.post_telegram('sendMessage', json=payload)
+            if status != 200:
+                self.handle_telegram_error(status, text)
+                return None
+            return json.loads(text).get('result', {}).get('message_id')
         except Exception as e:
             logger.error(f"Error sending keyboard: {e}")
+            return None
+    
+    async def edit_telegram_message(self, chat_id, message_id, message, keyboard):
+        """Редактирует сообщение
+        
+        True — правка применена, None — временная ошибка (повторить позже),
+        False — сообщение удалено или бот заблокирован, править больше нечего.
+        """
+        try:
+            payload = {
+                'chat_id': chat_id,
+                'message_id': message_id,
+                'text': message,
+                'parse_mode': 'HTML',
+                'reply_markup': keyboard if isinstance(keyboard, str) else json.dumps(keyboard)
+            }
+            status, text = await self.post_telegram('editMessageText', json=payload)
+            if status == 200 or 'message is not modified' in text:
+                return True
+            if status == 429:
+                self.handle_telegram_error(status, text)
+                return None
+            logger.warning(f"Telegram edit error: {text}")
+            if 'message to edit not found' in text or 'bot was blocked' in text:
+                return False
+            return None
+        except Exception as e:
+            logger.error(f"Error editing message: {e}")
+            return None
+    
+    async def send_telegram_photo(self, chat_id, photo, caption, keyboard=None):
+        """Отправляет картинку (байты PNG или file_id), возвращает file_id"""
+        try:
+            if isinstance(photo, bytes):
+                def build_form():
+                    data = aiohttp.FormData()
+                    data.add_field('chat_id', str(chat_id))
+                    data.add_field('caption', caption)
+                    data.add_field('parse_mode', 'HTML')
+                    if keyboard:
+                        data.add_field('reply_markup', json.dumps(keyboard))
+                    data.add_field('photo', photo, filename='chart.png', content_type='image/png')
+                    return data
+                status, text = await self.post_telegram('sendPhoto', build_form=build_form)
+            else:
+                payload = {
+                    'chat_id': chat_id,
+                    'photo': photo,
+                    'caption': caption,
+                    'parse_mode': 'HTML'
+                }
+                if keyboard:
+                    payload['reply_markup'] = json.dumps(keyboard)
+                status, text = await self.post_telegram('sendPhoto', json=payload)
+            
+            if status != 200:
+                self.handle_telegram_error(status, text)
+                return None
+            sizes = json.loads(text).get('result', {}).get('photo', [])
+            return sizes[-1]['file_id'] if sizes else None
+        except Exception as e:
+            logger.error(f"Error sending photo: {e}")
+            return None
+    
+    def get_chart_pool(self):
+        """Лениво создаёт пул процессов для рендера графиков"""
+        if self.chart_pool is None:
+            self.chart_pool = ProcessPoolExecutor(
+                max_workers=CHART_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return self.chart_pool
+    
+    async def render_chart(self, key, pair, timeframe, candles):
+        """Рендерит график в пуле процессов; одинаковые запросы ждут один рендер"""
+        render = self.chart_renders.get(key)
+        if render is None:
+            loop = asyncio.get_running_loop()
+            render = loop.run_in_executor(self.get_chart_pool(), render_chart_png, pair, timeframe, candles)
+            self.chart_renders[key] = render
+            render.add_done_callback(lambda _: self.chart_renders.pop(key, None))
+        return await asyncio.shield(render)
+    
+    def chart_keyboard(self, pair, timeframe):
+        """Кнопки переключения таймфрейма под графиком"""
+        row = []
+        for tf in CANDLE_TIMEFRAMES:
+            mark = "• " if tf == timeframe else ""
+            row.append({"text": f"{mark}{tf}", "callback_data": f"chart_{tf}_{pair}"})
+        return {
+            "inline_keyboard": [
+                row,
+                OK_KEYBOARD["inline_keyboard"][0]
+            ]
+        }
+    
+    async def show_chart(self, chat_id, pair, timeframe=CHART_DEFAULT_TIMEFRAME):
+        """Отправляет график пары из накопленной истории свечей"""
+        if timeframe not in CANDLE_TIMEFRAMES:
+            timeframe = CHART_DEFAULT_TIMEFRAME
+        
+        if not MATPLOTLIB_AVAILABLE:
+            await self.send_telegram_message(chat_id, "❌ Графики временно недоступны")
+            return
+        
+        candles = self.candles.get(pair, timeframe, limit=CHART_MAX_CANDLES)
+        if not candles:
+            await self.send_telegram_message(chat_id, f"📭 По {html.escape(pair)} пока нет истории для графика")
+            return
+        
+        key = (pair, timeframe, candles['start'][-1], candles['close'][-1])
+        caption = f"📈 <b>{html.escape(pair)}</b> · {timeframe}\n💰 {self.format_price(pair, candles['close'][-1])}"
+        keyboard = self.chart_keyboard(pair, timeframe)
+        
+        cached = self.chart_cache.get(key)
+        if cached is not None:
+            self.chart_cache.move_to_end(key)
+            # Повторно используем загруженную в Telegram картинку
+            if cached.get('file_id'):
+                if await self.send_telegram_photo(chat_id, cached['file_id'], caption, keyboard):
+                    return
+            png = cached.get('png')
+        else:
+            png = None
+        
+        if png is None:
+            try:
+                png = await self.render_chart(key, pair, timeframe, candles)
+            except Exception as e:
+                logger.error(f"Chart render error: {e}")
+                await self.send_telegram_message(chat_id, "❌ Не удалось построить график")
+                return
+        
+        file_id = await self.send_telegram_photo(chat_id, png, caption, keyboard)
+        # После загрузки храним только file_id, байты картинки больше не нужны
+        self.chart_cache[key] = {'file_id': file_id} if file_id else {'png': png}
+        self.chart_cache.move_to_end(key)
+        while len(self.chart_cache) > CHART_CACHE_SIZE:
+            self.chart_cache.popitem(last=False)
     
     async def show_timezone_menu(self, chat_id):
         """Показывает меню выбора часового пояса с отметкой текущего"""
@@ -776,6 +3475,12 @@ class CurrencyMonitor:
                 stats[user_id]['timezone'] = tz_key
                 stats[user_id]['timezone_name'] = TIMEZONES[tz_key]['name']
                 save_user_stats(stats)
+                
+                # Сводка приходит по местному времени — переносим её в новый пояс
+                summary_time = stats[user_id].get('summary_time')
+                if summary_time:
+                    hour, minute = map(int, summary_time.split(':'))
+                    self.summaries.schedule(user_id, hour, minute, tz_key)
             
             await self.send_telegram_message(
                 chat_id,
@@ -935,44 +3640,26 @@ class CurrencyMonitor:
             await self.show_main_menu(chat_id)
             return
         
-        stats = load_user_stats()
+        aggregates = stats_aggregates
         
-        if not stats:
+        if not aggregates.users:
             await self.send_telegram_message(chat_id, "📊 Статистика пока пуста")
             await self.show_main_menu(chat_id)
             return
         
         msg = "📊 <b>СТАТИСТИКА БОТА</b>\n\n"
-        msg += f"👥 Всего пользователей: <b>{len(stats)}</b>\n"
-        
-        total_interactions = sum(u.get('interactions', 0) for u in stats.values())
-        total_alerts = sum(u.get('alerts_created', 0) for u in stats.values())
-        total_triggered = sum(u.get('alerts_triggered', 0) for u in stats.values())
-        
-        msg += f"💬 Всего сообщений: <b>{total_interactions}</b>\n"
-        msg += f"🎯 Создано алертов: <b>{total_alerts}</b>\n"
-        msg += f"⚡️ Сработало алертов: <b>{total_triggered}</b>\n\n"
+        msg += f"👥 Всего пользователей: <b>{aggregates.users}</b>\n"
+        msg += f"💬 Всего сообщений: <b>{aggregates.interactions}</b>\n"
+        msg += f"🎯 Создано алертов: <b>{aggregates.alerts_created}</b>\n"
+        msg += f"⚡️ Сработало алертов: <b>{aggregates.alerts_triggered}</b>\n\n"
         
         msg += "🏆 <b>Топ пользователей:</b>\n"
-        top_users = sorted(stats.items(), key=lambda x: x[1].get('interactions', 0), reverse=True)[:5]
-        
-        for i, (user_id, data) in enumerate(top_users, 1):
-            name = data.get('first_name', '')
-            if data.get('username'):
-                name += f" (@{data['username']})"
-            slogan = data.get('current_slogan', '—')
-            pinned_count = len(data.get('pinned_pairs', []))
-            msg += f"{i}. {name} — {data.get('interactions', 0)} сообщ.\n   📢 {slogan} | 📌 {pinned_count}\n"
+        for i, card in enumerate(aggregates.leaders(), 1):
+            msg += f"{i}. {card['name']} — {card['interactions']} сообщ.\n   📢 {card['slogan']} | 📌 {card['pinned']}\n"
         
         msg += "\n📈 <b>Популярные пары:</b>\n"
-        all_pairs = []
-        for user_data in stats.values():
-            all_pairs.extend(user_data.get('pairs', []))
-        
-        if all_pairs:
-            pair_counts = Counter(all_pairs)
-            for pair, count in pair_counts.most_common(5):
-                msg += f"• {pair}: {count} раз(а)\n"
+        for pair, count in aggregates.popular_pairs():
+            msg += f"• {pair}: {count} раз(а)\n"
         
         await self.send_telegram_message(chat_id, msg)
         await self.show_main_menu(chat_id)
@@ -986,35 +3673,41 @@ class CurrencyMonitor:
             return f"${price:.2f}"  # Убрана запятая
         elif pair in self.low_value_pairs:
             return f"${price:.4f}"
-        elif pair in self.currency_pairs:
+        elif pair in self.currency_pairs or (pair not in INSTRUMENT_PAIRS and self.cross_rates.parse_pair(pair)):
             return f"{price:.4f}"
         else:
             return f"${price:.2f}"    
             
+    def alert_kind_buttons(self, pair):
+        """Кнопки создания трейлинг- и диапазонного алерта"""
+        return [
+            {"text": "📉 Трейлинг", "callback_data": f"add_trail_{pair}"},
+            {"text": "↔️ Диапазон", "callback_data": f"add_band_{pair}"}
+        ]
+    
     async def handle_pair_management(self, chat_id, pair):
         """Показывает меню управления для конкретной пары"""
         user_id = str(chat_id)
-        user_alerts_list = user_alerts.get(user_id, [])
-        
-        active_alerts = [alert for alert in user_alerts_list 
-                         if alert.get('pair') == pair and alert.get('active')]
+        active_alerts = user_alerts.active_for(user_id, pair)
         
         if active_alerts:
             alerts_text = ""
             for i, alert in enumerate(active_alerts, 1):
-                alerts_text += f"{i}. 🎯 {alert['target']}\n"
+                alerts_text += f"{i}. {alert.label()}\n"
             
             keyboard = {"inline_keyboard": []}
             
-            for i, alert in enumerate(active_alerts, 1):
+            for alert in active_alerts:
                 keyboard["inline_keyboard"].append([
-                    {"text": f"❌ {alert['target']}", 
-                     "callback_data": f"delete_specific_{pair}_{i}"}
+                    {"text": f"❌ {alert.label()}", 
+                     "callback_data": f"alert_del_{alert.id}"}
                 ])
             
             keyboard["inline_keyboard"].append([
-                {"text": "➕ Добавить цель", "callback_data": f"add_{pair}"}
+                {"text": "➕ Добавить цель", "callback_data": f"add_{pair}"},
+                {"text": "📈 График", "callback_data": f"chart_{pair}"}
             ])
+            keyboard["inline_keyboard"].append(self.alert_kind_buttons(pair))
             
             # Кнопка "Назад" УБРАНА!
             
@@ -1028,16 +3721,24 @@ class CurrencyMonitor:
         else:
             # Получаем текущую цену для отображения при создании
             rates = await self.fetch_rates()
-            current_price = rates.get(pair, 'неизвестно')
-            price_str = self.format_price(pair, current_price)
+            current_price = rates.get(pair) or self.cross_rates.rate(pair) or 'неизвестно'
+            price_str = self.format_price(pair, current_price) + self.freshness_note(pair)
             
             self.alert_states[str(chat_id)] = {'pair': pair, 'step': 'waiting_price'}
             
-            await self.send_telegram_message(
+            keyboard = {
+                "inline_keyboard": [
+                    [{"text": "📈 График", "callback_data": f"chart_{pair}"}],
+                    self.alert_kind_buttons(pair)
+                ]
+            }
+            
+            await self.send_telegram_message_with_keyboard(
                 chat_id,
                 f"Создать алерт для {pair}\n"
                 f"💰 Текущая цена: {price_str}\n\n"
-                f"📝 Введи целевую цену:"
+                f"📝 Введи целевую цену:",
+                keyboard
             )
     
     async def show_main_menu(self, chat_id):
@@ -1058,7 +3759,7 @@ class CurrencyMonitor:
                 return    
                 
             user_id = str(chat_id)
-            user_alerts_list = user_alerts.get(user_id, [])
+            alert_counts = user_alerts.active_counts(user_id)
             pinned_pairs = get_user_pinned_pairs(user_id)
             
             def get_alert_indicator(count):
@@ -1077,8 +3778,7 @@ class CurrencyMonitor:
             currency_pairs = ['EUR/USD', 'GBP/USD', 'USD/JPY', 'USD/RUB', 'EUR/GBP', 'USD/CAD', 'AUD/USD', 'USD/CHF', 'USD/CNY']
             for pair in currency_pairs:
                 if pair in rates:
-                    alert_count = sum(1 for alert in user_alerts_list 
-                                      if alert.get('pair') == pair and alert.get('active'))
+                    alert_count = alert_counts.get(pair, 0)
                     alert_indicator = get_alert_indicator(alert_count)
                     pin = get_pin_indicator(pair)
                     
@@ -1118,8 +3818,7 @@ class CurrencyMonitor:
             metal_emojis = {'XAU/USD': '🥇', 'XAG/USD': '🥈', 'XPT/USD': '🥉'}
             for pair in metals:
                 if pair in rates:
-                    alert_count = sum(1 for alert in user_alerts_list 
-                                      if alert.get('pair') == pair and alert.get('active'))
+                    alert_count = alert_counts.get(pair, 0)
                     alert_indicator = get_alert_indicator(alert_count)
                     pin = get_pin_indicator(pair)
                     emoji = metal_emojis.get(pair, '🏅')
@@ -1144,8 +3843,7 @@ class CurrencyMonitor:
             }
             for pair in crypto_pairs:
                 if pair in rates:
-                    alert_count = sum(1 for alert in user_alerts_list 
-                                      if alert.get('pair') == pair and alert.get('active'))
+                    alert_count = alert_counts.get(pair, 0)
                     alert_indicator = get_alert_indicator(alert_count)
                     pin = get_pin_indicator(pair)
                     emoji = crypto_emojis.get(pair, '🪙')
@@ -1164,8 +3862,7 @@ class CurrencyMonitor:
             index_emojis = {'S&P 500': '📈', 'NASDAQ': '📊'}
             for pair in indices:
                 if pair in rates:
-                    alert_count = sum(1 for alert in user_alerts_list 
-                                      if alert.get('pair') == pair and alert.get('active'))
+                    alert_count = alert_counts.get(pair, 0)
                     alert_indicator = get_alert_indicator(alert_count)
                     pin = get_pin_indicator(pair)
                     emoji = index_emojis.get(pair, '📉')
@@ -1184,8 +3881,7 @@ class CurrencyMonitor:
             commodity_emojis = {'CORN/USD': '🌽', 'WTI/USD': '🛢️', 'BRENT/USD': '🛢️'}
             for pair in commodities:
                 if pair in rates:
-                    alert_count = sum(1 for alert in user_alerts_list 
-                                      if alert.get('pair') == pair and alert.get('active'))
+                    alert_count = alert_counts.get(pair, 0)
                     alert_indicator = get_alert_indicator(alert_count)
                     pin = get_pin_indicator(pair)
                     emoji = commodity_emojis.get(pair, '📦')
@@ -1199,6 +3895,23 @@ class CurrencyMonitor:
                         'sort_key': pair
                     })
             
+            # Кросс-курсы, на которые у пользователя есть алерты
+            cross_pairs = sorted(pair for pair in alert_counts
+                                 if pair in rates and pair not in INSTRUMENT_PAIRS)
+            for pair in cross_pairs:
+                alert_count = alert_counts.get(pair, 0)
+                alert_indicator = get_alert_indicator(alert_count)
+                pin = get_pin_indicator(pair)
+                
+                text = f"💱 {pair}{alert_indicator}{pin}"
+                all_pairs.append({
+                    'pair': pair,
+                    'text': text,
+                    'is_pinned': pair in pinned_pairs,
+                    'category': 'cross',
+                    'sort_key': pair
+                })
+            
             # Сортируем: сначала закрепленные, потом остальные
             pinned_items = [p for p in all_pairs if p['is_pinned']]
             regular_items = [p for p in all_pairs if not p['is_pinned']]
@@ -1255,7 +3968,6 @@ class CurrencyMonitor:
     async def handle_alert_input(self, chat_id, text):
         try:
             text = text.replace(',', '.')
-            target = float(text)
             
             if str(chat_id) not in self.alert_states:
                 await self.send_telegram_message(chat_id, "❌ Ошибка: начни сначала /start")
@@ -1269,24 +3981,63 @@ class CurrencyMonitor:
                 return
                 
             pair = state['pair']
-            
+            step = state.get('step', 'waiting_price')
             user_id = str(chat_id)
-            if user_id not in user_alerts:
-                user_alerts[user_id] = []
+            # Трейлинг и диапазон опираются на текущую цену — только на свежую,
+            # а не на DEFAULT_RATES или восстановленную после рестарта
+            fresh_price = self.current_price(pair) if self.is_quote_fresh(pair) else None
             
-            alert = {
-                'pair': pair,
-                'target': target,
-                'active': True
-            }
+            if step == 'waiting_trailing':
+                try:
+                    percent = float(text.strip().rstrip('%'))
+                except ValueError:
+                    await self.send_telegram_message(chat_id, "❌ Введи процент отката (например: 5)")
+                    return
+                if not 0 < percent < 100:
+                    await self.send_telegram_message(chat_id, "❌ Процент должен быть от 0 до 100")
+                    return
+                price = fresh_price
+                if price is None:
+                    await self.send_telegram_message(chat_id, "❌ Нет свежей цены, попробуй через минуту")
+                    return
+                user_alerts.add(user_id, pair, kind='trailing', percent=percent, peak=price)
+                created = f"📉 Сработает при откате на {percent:g}% от пика (сейчас {self.format_price(pair, price)})"
+            
+            elif step == 'waiting_band':
+                bounds = re.findall(r'\d+(?:\.\d+)?', text)
+                if len(bounds) != 2 or float(bounds[0]) == float(bounds[1]):
+                    await self.send_telegram_message(chat_id, "❌ Введи две границы (например: 1.08 1.10)")
+                    return
+                low, high = sorted(float(bound) for bound in bounds)
+                if fresh_price is None:
+                    await self.send_telegram_message(chat_id, "❌ Нет свежей цены, попробуй через минуту")
+                    return
+                if not low < fresh_price < high:
+                    # Цена уже вне диапазона — алерт сработал бы на следующем тике
+                    await self.send_telegram_message(
+                        chat_id,
+                        f"❌ Цена сейчас {self.format_price(pair, fresh_price)} — она должна быть внутри диапазона"
+                    )
+                    return
+                user_alerts.add(user_id, pair, kind='band', low=low, high=high)
+                created = f"↔️ Сработает при выходе из диапазона {low:g}–{high:g}"
+            
+            else:
+                try:
+                    target = float(text)
+                except ValueError:
+                    await self.send_telegram_message(chat_id, "❌ Это не число! Введи цену (например: 1.10)")
+                    return
+                user_alerts.add(user_id, pair, target)
+                created = f"🎯 Цель: {target}"
             
-            user_alerts[user_id].append(alert)
             save_user_alerts(user_alerts)
             
             stats = load_user_stats()
             if user_id in stats:
                 stats[user_id]['alerts_created'] = stats[user_id].get('alerts_created', 0) + 1
-                stats[user_id]['pairs'] = stats[user_id].get('pairs', []) + [pair]
+                stats_aggregates.alerts_created += 1
+                stats_aggregates.add_pair(stats[user_id], pair)
                 save_user_stats(stats)
             
             del self.alert_states[str(chat_id)]
@@ -1294,13 +4045,11 @@ class CurrencyMonitor:
             await self.send_telegram_message(
                 chat_id,
                 f"✅ Алерт для {pair} создан!\n\n"
-                f"🎯 Цель: {target}"
+                f"{created}"
             )
             
             await self.show_main_menu(chat_id)
             
-        except ValueError:
-            await self.send_telegram_message(chat_id, "❌ Это не число! Введи цену (например: 1.10)")
         except Exception as e:
             logger.error(f"Error in alert input: {e}")
             await self.send_telegram_message(chat_id, "❌ Ошибка при создании алерта")
@@ -1308,7 +4057,7 @@ class CurrencyMonitor:
     
     async def list_alerts(self, chat_id):
         user_id = str(chat_id)
-        alerts = user_alerts.get(user_id, [])
+        alerts = user_alerts.for_user(user_id)
         
         if not alerts:
             await self.send_telegram_message(chat_id, "📭 У тебя пока нет алертов")
@@ -1318,12 +4067,11 @@ class CurrencyMonitor:
         msg = "📋 Твои алерты:\n\n"
         
         for i, alert in enumerate(alerts, 1):
-            status = "✅" if alert.get('active', False) else "⚡️"
-            target = alert.get('target') or alert.get('target_price') or '?'
-            pair = alert.get('pair', '?')
-            msg += f"{number_to_emoji(i)} {status} {pair} = {target}\n"
+            status = "✅" if alert.active else "⚡️"
+            description = f"= {alert.target}" if alert.kind == 'target' else alert.label()
+            msg += f"{number_to_emoji(i)} {status} {alert.pair} {description}\n"
             keyboard["inline_keyboard"].append(
-                [{"text": f"❌ Удалить {i}", "callback_data": f"delete_{i}"}]
+                [{"text": f"❌ Удалить {i}", "callback_data": f"alert_del_{alert.id}"}]
             )
         
         keyboard["inline_keyboard"].append([{"text": "◀️ Назад", "callback_data": "main_menu"}])
@@ -1348,6 +4096,9 @@ class CurrencyMonitor:
                 logger.info(f"⛔ Запрещен: {chat_id}")
                 return
             
+            # Команды с аргументами сравниваем по первому слову целиком (без @имя_бота)
+            command, args = split_command(text)
+            
             if text in ['/start', '/menu']:
                 if str(chat_id) in self.alert_states:
                     del self.alert_states[str(chat_id)]
@@ -1366,6 +4117,54 @@ class CurrencyMonitor:
                 await self.show_pin_menu(chat_id)
                 return
             
+            if command == '/pair':
+                pair = self.cross_rates.normalize_pair(args) if args else None
+                if not pair:
+                    await self.send_telegram_message(
+                        chat_id,
+                        "💱 Использование: /pair EUR/JPY\n\nДоступна любая пара из валют: " + ", ".join(FIAT_CODES)
+                    )
+                    return
+                await self.handle_pair_management(chat_id, pair)
+                return
+            
+            if command == '/price':
+                await self.show_prices(chat_id, args)
+                return
+            
+            if command == '/convert':
+                await self.convert_amount(chat_id, args)
+                return
+            
+            if command == '/board':
+                if args.lower() == 'off':
+                    await self.stop_board(str(chat_id))
+                    await self.send_telegram_message(chat_id, "⏹ Табло остановлено")
+                else:
+                    await self.start_board(chat_id)
+                return
+            
+            if command == '/summary':
+                await self.set_user_summary(chat_id, args.split()[0].lower() if args else None)
+                return
+            
+            if command == '/digest':
+                await self.set_user_digest(chat_id, args.split()[0].lower() if args else None)
+                return
+            
+            if command == '/chart':
+                parts = args.split()
+                timeframe = parts[-1] if parts and parts[-1] in CANDLE_TIMEFRAMES else CHART_DEFAULT_TIMEFRAME
+                pair_parts = parts[:-1] if parts and parts[-1] in CANDLE_TIMEFRAMES else parts
+                if not pair_parts:
+                    await self.send_telegram_message(chat_id, "📈 Использование: /chart BTC/USD 1h")
+                    return
+                raw_pair = ' '.join(pair_parts)
+                # Те же синонимы, что в /price и /rates: 'btc', 'eurjpy', 'золото'
+                pair = self.resolve_pair(raw_pair) or raw_pair.upper()
+                await self.show_chart(chat_id, pair, timeframe)
+                return
+            
             if str(chat_id) in self.alert_states:
                 await self.handle_alert_input(chat_id, text)
                 return
@@ -1394,7 +4193,9 @@ class CurrencyMonitor:
             
             session = await self.get_session()
             url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/answerCallbackQuery"
-            await session.post(url, json={'callback_query_id': cb['id']})
+            # Ответ обязательно закрываем, иначе соединение не вернётся в пул
+            async with session.post(url, json={'callback_query_id': cb['id']}, timeout=HTTP_TIMEOUTS['telegram']):
+                pass
             
             if data == "main_menu":
                 if str(chat_id) in self.alert_states:
@@ -1431,47 +4232,34 @@ class CurrencyMonitor:
                 # Сразу возвращаемся в главное меню
                 await self.show_main_menu(chat_id)
                 
+            elif data.startswith("chart_"):
+                rest = data.replace("chart_", "", 1)
+                timeframe, _, pair = rest.partition("_")
+                if timeframe not in CANDLE_TIMEFRAMES or not pair:
+                    timeframe, pair = CHART_DEFAULT_TIMEFRAME, rest
+                await self.show_chart(chat_id, pair, timeframe)
+                
             elif data.startswith("manage_"):
                 pair = data.replace("manage_", "")
                 await self.handle_pair_management(chat_id, pair)
                 
-            elif data.startswith("delete_specific_"):
+            elif data.startswith("alert_del_"):
                 try:
-                    parts = data.replace("delete_specific_", "").rsplit("_", 1)
-                    pair = parts[0]
-                    alert_num = int(parts[1]) - 1
-                    
-                    user_id = str(chat_id)
-                    if user_id in user_alerts:
-                        pair_alerts = [alert for alert in user_alerts[user_id] 
-                                       if alert.get('pair') == pair and alert.get('active')]
-                        
-                        if 0 <= alert_num < len(pair_alerts):
-                            target_alert = pair_alerts[alert_num]
-                            user_alerts[user_id] = [a for a in user_alerts[user_id] 
-                                                     if not (a.get('pair') == pair and 
-                                                            a.get('target') == target_alert['target'] and 
-                                                            a.get('active'))]
-                            save_user_alerts(user_alerts)
-                            
-                            await self.send_telegram_message(chat_id, f"✅ Алерт удален")
-                            # ВСЕГДА показываем главное меню после удаления
-                            await self.show_main_menu(chat_id)
-                            return
-                except Exception as e:
-                    logger.error(f"Delete specific error: {e}")
+                    alert_id = int(data.replace("alert_del_", ""))
+                    if user_alerts.remove(alert_id, user_id=str(chat_id)):
+                        save_user_alerts(user_alerts)
+                        await self.send_telegram_message(chat_id, f"✅ Алерт удален")
+                except ValueError:
+                    logger.error(f"Bad alert id in callback: {data}")
                 
-                # Если что-то пошло не так, тоже показываем главное меню
-                await self.show_main_menu(chat_id) 
+                # ВСЕГДА показываем главное меню после удаления
+                await self.show_main_menu(chat_id)
                 
             elif data.startswith("delete_all_"):
                 pair = data.replace("delete_all_", "")
                 user_id = str(chat_id)
                 if user_id in user_alerts:
-                    old_count = len([a for a in user_alerts[user_id] 
-                                     if a.get('pair') == pair and a.get('active')])
-                    user_alerts[user_id] = [a for a in user_alerts[user_id] 
-                                             if not (a.get('pair') == pair and a.get('active'))]
+                    old_count = user_alerts.remove_pair(user_id, pair)
                     save_user_alerts(user_alerts)
                     logger.info(f"Удалено {old_count} алертов для {pair} у пользователя {user_id}")
                     
@@ -1479,13 +4267,41 @@ class CurrencyMonitor:
                     await self.show_main_menu(chat_id)
                     return
                     
+            elif data.startswith("add_trail_"):
+                pair = data.replace("add_trail_", "", 1)
+                price = self.current_price(pair)
+                price_str = self.format_price(pair, price) if price is not None else 'неизвестно'
+                
+                self.alert_states[str(chat_id)] = {'pair': pair, 'step': 'waiting_trailing'}
+                await self.send_telegram_message(
+                    chat_id,
+                    f"📉 Трейлинг-алерт для {pair}\n"
+                    f"💰 Текущая цена: {price_str}{self.freshness_note(pair)}\n\n"
+                    f"Пик считается с этого момента. Сообщу, когда цена откатится от него на заданный процент.\n"
+                    f"📝 Введи процент отката (например: 5):"
+                )
+                
+            elif data.startswith("add_band_"):
+                pair = data.replace("add_band_", "", 1)
+                price = self.current_price(pair)
+                price_str = self.format_price(pair, price) if price is not None else 'неизвестно'
+                
+                self.alert_states[str(chat_id)] = {'pair': pair, 'step': 'waiting_band'}
+                await self.send_telegram_message(
+                    chat_id,
+                    f"↔️ Алерт-диапазон для {pair}\n"
+                    f"💰 Текущая цена: {price_str}{self.freshness_note(pair)}\n\n"
+                    f"Сообщу, когда цена выйдет из диапазона.\n"
+                    f"📝 Введи нижнюю и верхнюю границу (например: 1.08 1.10):"
+                )
+                
             elif data.startswith("add_"):
                 pair = data.replace("add_", "")
                 
                 # Получаем текущую цену для отображения при создании
                 rates = await self.fetch_rates()
-                current_price = rates.get(pair, 'неизвестно')
-                price_str = self.format_price(pair, current_price)
+                current_price = rates.get(pair) or self.cross_rates.rate(pair) or 'неизвестно'
+                price_str = self.format_price(pair, current_price) + self.freshness_note(pair)
                 
                 self.alert_states[str(chat_id)] = {'pair': pair, 'step': 'waiting_price'}
                 await self.send_telegram_message(
@@ -1503,18 +4319,16 @@ class CurrencyMonitor:
                     "Спасибо, что пользуетесь ботом! 🚀"
                 )
                 
-                ok_keyboard = {
-                    "inline_keyboard": [
-                        [{"text": "✅ ОК", "callback_data": "main_menu"}]
-                    ]
-                }
-                
                 await self.send_telegram_message_with_keyboard(
                     chat_id, 
                     collab_text, 
-                    ok_keyboard
+                    OK_KEYBOARD_JSON
                 )            
                             
+            elif data == "board_off":
+                await self.stop_board(str(chat_id))
+                await self.send_telegram_message(chat_id, "⏹ Табло остановлено")
+                
             elif data == "cancel_alert":
                 if str(chat_id) in self.alert_states:
                     del self.alert_states[str(chat_id)]
@@ -1522,18 +4336,9 @@ class CurrencyMonitor:
                 await self.show_main_menu(chat_id)
                 
             elif data.startswith("delete_"):
-                try:
-                    num = int(data.replace("delete_", "")) - 1
-                    user_id = str(chat_id)
-                    if user_id in user_alerts and 0 <= num < len(user_alerts[user_id]):
-                        user_alerts[user_id].pop(num)
-                        save_user_alerts(user_alerts)
-                        await self.send_telegram_message(chat_id, f"✅ Алерт удален")
-                        # Сразу показываем главное меню
-                        await self.show_main_menu(chat_id)
-                except Exception as e:
-                    logger.error(f"Delete error: {e}")
-                    await self.show_main_menu(chat_id)  
+                # Кнопки старого формата (по номеру в списке) — номера могли сдвинуться
+                await self.send_telegram_message(chat_id, "⚠️ Список алертов изменился, открой его заново")
+                await self.show_main_menu(chat_id)
                     
         except Exception as e:
             logger.error(f"Callback error: {e}")
@@ -1547,120 +4352,394 @@ class CurrencyMonitor:
             if self.last_update_id > 0:
                 url += f"?offset={self.last_update_id + 1}"
             
-            async with session.get(url, timeout=10) as response:
+            async with session.get(url, timeout=HTTP_TIMEOUTS['telegram_poll']) as response:
                 if response.status == 200:
                     data = await response.json()
                     for update in data.get('result', []):
-                        await self.handle_telegram_commands(update)
-                        await self.handle_callback_query(update)
+                        if self.shard_conns:
+                            self.route_update(update)
+                        else:
+                            await self.process_update(update)
                         if update['update_id'] > self.last_update_id:
                             self.last_update_id = update['update_id']
         except Exception as e:
             logger.error(f"Updates error: {e}")
     
+    async def process_update(self, update):
+        """Обрабатывает один апдейт Telegram"""
+        await self.handle_telegram_commands(update)
+        await self.handle_callback_query(update)
+        await self.handle_inline_query(update)
+    
+    def route_update(self, update):
+        """Отправляет апдейт шарду, которому принадлежит пользователь"""
+        chat_id = update_chat_id(update)
+        if chat_id is None:
+            return
+        conn = self.shard_conns[shard_for(chat_id, len(self.shard_conns))]
+        try:
+            conn.send(update)
+        except Exception as e:
+            logger.error(f"Shard route error: {e}")
+    
     async def check_thresholds(self, rates):
         """Проверяет достижение целей"""
-        notifications = []
+        triggered = []
         stats = load_user_stats()
         now_utc = datetime.now(ZoneInfo('UTC'))
+        now_ts = now_utc.timestamp()
         
-        for user_id, alerts in user_alerts.items():
-            user_tz = stats.get(str(user_id), {}).get('timezone', 'Europe/Moscow')
-            tz_info = TIMEZONES.get(user_tz, TIMEZONES['Europe/Moscow'])
-            user_time = now_utc.astimezone(ZoneInfo(user_tz))
-            current_time = user_time.strftime('%H:%M:%S')
+        def record(alert, fields):
+            triggered.append((alert.user_id, alert.pair, fields))
+            user_alerts.deactivate(alert)
+            if alert.user_id in stats:
+                stats[alert.user_id]['alerts_triggered'] = stats[alert.user_id].get('alerts_triggered', 0) + 1
+                stats_aggregates.alerts_triggered += 1
+        
+        for alert in list(user_alerts.targets.values()):
+            target = alert.target
+            pair = alert.pair
+            if pair not in rates:
+                continue
             
-            for alert in alerts:
-                if not alert.get('active', False):
-                    continue
-                
-                target = alert.get('target') or alert.get('target_price')
-                if target is None:
-                    continue
-                    
-                pair = alert.get('pair')
-                if not pair or pair not in rates:
-                    continue
-                
-                current = rates[pair]
-                
-                if pair in ['BTC/USD', 'ETH/USD', 'XAU/USD', 'XPT/USD', 'S&P 500', 'NASDAQ']:
-                    if abs(current - target) / target < 0.0001:
-                        msg = (
-                            f"🎯 <b>ЦЕЛЬ ДОСТИГНУТА!</b>\n\n"
-                            f"📊 {pair}\n"
-                            f"🎯 Цель: {target:.2f}\n"
-                            f"⏱️ {current_time} ({tz_info['name']})"
-                        )
-                        
-                        # Создаем клавиатуру с кнопкой ОК
-                        ok_keyboard = {
-                            "inline_keyboard": [
-                                [{"text": "✅ ОК", "callback_data": "main_menu"}]
-                            ]
-                        }
-                        
-                        notifications.append((int(user_id), msg, ok_keyboard))
-                        alert['active'] = False
-                        
-                        if user_id in stats:
-                            stats[user_id]['alerts_triggered'] = stats[user_id].get('alerts_triggered', 0) + 1
-                        
-                        save_user_alerts(user_alerts)
-                        logger.info(f"Цель {pair}: {current:.2f}")
-                
-                elif pair in ['DOGE/USD', 'XRP/USD']:
-                    if abs(current - target) <= 0.0001:
-                        msg = (
-                            f"🎯 <b>ЦЕЛЬ ДОСТИГНУТА!</b>\n\n"
-                            f"📊 {pair}\n"
-                            f"🎯 Цель: {target:.4f}\n"
-                            f"⏱️ {current_time} ({tz_info['name']})"
-                        )
-                        
-                        # Создаем клавиатуру с кнопкой ОК
-                        ok_keyboard = {
-                            "inline_keyboard": [
-                                [{"text": "✅ ОК", "callback_data": "main_menu"}]
-                            ]
-                        }
-                        
-                        notifications.append((int(user_id), msg, ok_keyboard))
-                        alert['active'] = False
-                        
-                        if user_id in stats:
-                            stats[user_id]['alerts_triggered'] = stats[user_id].get('alerts_triggered', 0) + 1
-                        
-                        save_user_alerts(user_alerts)
-                        logger.info(f"Цель {pair}: {current:.4f}")
-                
+            # По устаревшим котировкам алерты не срабатывают
+            if not self.is_quote_fresh(pair, now_ts):
+                continue
+            
+            current = rates[pair]
+            tolerance, relative, fmt = alert_rule(pair)
+            
+            gap = abs(current - target) / target if relative else abs(current - target)
+            if (relative and gap < tolerance) or (not relative and gap <= tolerance):
+                record(alert, {'kind': 'target', 'target': fmt(target)})
+                logger.info(f"Цель {pair}: {fmt(current)}")
+        
+        # Трейлинг и диапазоны: одно обновление индекса на пару, сколько бы алертов ни было
+        for pair in list(user_alerts.watch.pairs()):
+            if pair not in rates or not self.is_quote_fresh(pair, now_ts):
+                continue
+            current = rates[pair]
+            _, _, fmt = alert_rule(pair)
+            for alert in user_alerts.watch.update(pair, current):
+                if alert.kind == 'trailing':
+                    record(alert, {'kind': 'trailing', 'percent': f"{alert.percent:g}",
+                                   'peak': fmt(alert.peak), 'price': fmt(current)})
                 else:
-                    if abs(current - target) <= 0.00005:
-                        msg = (
-                            f"🎯 <b>ЦЕЛЬ ДОСТИГНУТА!</b>\n\n"
-                            f"📊 {pair}\n"
-                            f"🎯 Цель: {target:.5f}\n"
-                            f"⏱️ {current_time} ({tz_info['name']})"
-                        )
-                        
-                        # Создаем клавиатуру с кнопкой ОК
-                        ok_keyboard = {
-                            "inline_keyboard": [
-                                [{"text": "✅ ОК", "callback_data": "main_menu"}]
-                            ]
-                        }
-                        
-                        notifications.append((int(user_id), msg, ok_keyboard))
-                        alert['active'] = False
-                        
-                        if user_id in stats:
-                            stats[user_id]['alerts_triggered'] = stats[user_id].get('alerts_triggered', 0) + 1
-                        
-                        save_user_alerts(user_alerts)
-                        logger.info(f"Цель {pair}: {current:.5f}")
+                    record(alert, {'kind': 'band', 'low': fmt(alert.low), 'high': fmt(alert.high),
+                                   'price': fmt(current)})
+                logger.info(f"{alert.label()} {pair}: {fmt(current)}")
         
+        if triggered:
+            save_user_alerts(user_alerts)
         save_user_stats(stats)
+        
+        self.queue_notifications(triggered, stats, now_ts)
+        return self.flush_notifications(stats, now_utc)
+    
+    def queue_notifications(self, triggered, stats, now_ts):
+        """Копит срабатывания по пользователям до окна объединения или дайджеста"""
+        for user_id, pair, fields in triggered:
+            pending = self.pending_notifications.get(user_id)
+            if pending is None:
+                digest = stats.get(user_id, {}).get('digest', 0)
+                pending = {
+                    'due': now_ts + (digest or NOTIFY_COALESCE_WINDOW),
+                    'digest': bool(digest),
+                    'items': [],
+                }
+                self.pending_notifications[user_id] = pending
+            pending['items'].append((pair, fields, now_ts))
+    
+    def flush_notifications(self, stats, now_utc):
+        """Забирает пользователей, у которых подошло время отправки"""
+        now_ts = now_utc.timestamp()
+        due = [user_id for user_id, pending in self.pending_notifications.items() if pending['due'] <= now_ts]
+        batches = [(user_id, self.pending_notifications.pop(user_id)) for user_id in due]
+        notifications = self.render_notifications(batches, stats, now_utc)
+        self.notifications_sent += len(notifications)
         return notifications
+    
+    def render_notifications(self, batches, stats, now_utc):
+        """Собирает готовые к отправке уведомления пачкой: одно сообщение на пользователя
+        
+        Местное время считается один раз на часовой пояс, клавиатура общая
+        и уже сериализована.
+        """
+        local_times = {}
+        notifications = []
+        
+        def local_clock(user_tz, ts):
+            key = (user_tz, ts)
+            clock = local_times.get(key)
+            if clock is None:
+                clock = datetime.fromtimestamp(ts, ZoneInfo(user_tz)).strftime('%H:%M:%S')
+                local_times[key] = clock
+            return clock
+        
+        now_ts = now_utc.timestamp()
+        for user_id, pending in batches:
+            user_tz = stats.get(str(user_id), {}).get('timezone', 'Europe/Moscow')
+            if user_tz not in TIMEZONES:
+                user_tz = 'Europe/Moscow'
+            local_time = f"{local_clock(user_tz, now_ts)} ({TIMEZONES[user_tz]['name']})"
+            items = pending['items']
+            
+            if len(items) == 1 and not pending['digest']:
+                pair, fields, _ = items[0]
+                fields = alert_fields(fields)
+                msg = ALERT_TEMPLATES[fields['kind']].format(pair=pair, time=local_time, **fields)
+            else:
+                # Время каждого срабатывания показываем, только если они из разных тиков
+                same_tick = len({ts for _, _, ts in items}) == 1
+                lines = []
+                for pair, fields, ts in items:
+                    fields = alert_fields(fields)
+                    line = ALERT_LINE_TEMPLATES[fields['kind']].format(pair=pair, **fields)
+                    lines.append(line if same_tick else f"{line} · {local_clock(user_tz, ts)}")
+                template = ALERT_DIGEST_TEMPLATE if pending['digest'] else ALERT_BATCH_TEMPLATE
+                msg = template.format(count=len(items), lines="\n".join(lines), time=local_time)
+            
+            notifications.append((int(user_id), msg, OK_KEYBOARD_JSON))
+        
+        return notifications
+    
+    def snapshot_rates(self):
+        """Текущие курсы без опроса провайдеров (общий снимок или таблица котировок)"""
+        if self.shared_rates is not None:
+            return self.read_shared_rates()
+        return self.add_cross_rates(self.quotes.values())
+    
+    def load_summary_schedule(self):
+        """Ставит в расписание сводки всех пользователей, у которых они включены"""
+        now = time.time()
+        for user_id, data in load_user_stats().items():
+            summary_time = data.get('summary_time')
+            if summary_time:
+                hour, minute = map(int, summary_time.split(':'))
+                self.summaries.schedule(user_id, hour, minute, data.get('timezone', 'Europe/Moscow'), now)
+        logger.info(f"☀️ Ежедневных сводок в расписании: {len(self.summaries.jobs)}")
+    
+    def render_summaries(self, user_ids, stats):
+        """Сводки для пачки пользователей: строки пар и время по поясу считаются один раз"""
+        rates = self.snapshot_rates()
+        now_ts = time.time()
+        pair_lines = {}
+        local_times = {}
+        summaries = []
+        
+        for user_id in user_ids:
+            data = stats.get(user_id, {})
+            lines = []
+            for pair in data.get('pinned_pairs', []):
+                line = pair_lines.get(pair)
+                if line is None:
+                    price = rates.get(pair)
+                    line = f"📌 {pair}: {self.format_price(pair, price) + self.freshness_note(pair) if price else 'нет данных'}"
+                    pair_lines[pair] = line
+                lines.append(line)
+            if not lines:
+                continue
+            
+            user_tz = data.get('timezone', 'Europe/Moscow')
+            if user_tz not in TIMEZONES:
+                user_tz = 'Europe/Moscow'
+            local_time = local_times.get(user_tz)
+            if local_time is None:
+                local_time = f"{datetime.fromtimestamp(now_ts, ZoneInfo(user_tz)).strftime('%H:%M')} ({TIMEZONES[user_tz]['name']})"
+                local_times[user_tz] = local_time
+            
+            summaries.append((int(user_id), SUMMARY_TEMPLATE.format(lines="\n".join(lines), time=local_time)))
+        return summaries
+    
+    async def send_summaries(self, user_ids):
+        summaries = self.render_summaries(user_ids, load_user_stats())
+        summaries = [(chat_id, msg) for chat_id, msg in summaries if self.is_user_allowed(chat_id)]
+        for i in range(0, len(summaries), SUMMARY_SEND_BATCH):
+            batch = summaries[i:i + SUMMARY_SEND_BATCH]
+            await asyncio.gather(*(self.send_telegram_message_with_keyboard(chat_id, msg, OK_KEYBOARD_JSON)
+                                   for chat_id, msg in batch))
+        self.summaries_sent += len(summaries)
+        if summaries:
+            logger.info(f"☀️ Отправлено сводок: {len(summaries)}")
+    
+    async def summary_task(self):
+        """Спит до ближайшей сводки по расписанию и отправляет всё, что наступило"""
+        self.load_summary_schedule()
+        while True:
+            try:
+                self.summaries.changed.clear()
+                due = self.summaries.next_due()
+                timeout = None if due is None else max(0.0, due - time.time())
+                try:
+                    # Новое задание раньше текущего ближайшего будит цикл досрочно
+                    await asyncio.wait_for(self.summaries.changed.wait(), timeout)
+                    continue
+                except asyncio.TimeoutError:
+                    pass
+                
+                user_ids = self.summaries.pop_due(time.time())
+                if user_ids:
+                    await self.send_summaries(user_ids)
+            except Exception as e:
+                logger.error(f"Summary task error: {e}")
+                await asyncio.sleep(5)
+    
+    async def set_user_summary(self, chat_id, value):
+        """Включает ежедневную сводку в HH:MM по местному времени или выключает её"""
+        user_id = str(chat_id)
+        stats = load_user_stats()
+        data = stats.get(user_id, {})
+        
+        if value == 'off':
+            data.pop('summary_time', None)
+            self.summaries.cancel(user_id)
+            if user_id in stats:
+                save_user_stats(stats)
+            await self.send_telegram_message(chat_id, "✅ Ежедневная сводка выключена")
+            return
+        
+        match = re.fullmatch(r'(\d{1,2}):(\d{2})', value or '')
+        if not match or int(match.group(1)) > 23 or int(match.group(2)) > 59:
+            current = data.get('summary_time', 'выключена')
+            await self.send_telegram_message(
+                chat_id,
+                f"☀️ Ежедневная сводка: <b>{current}</b>\n\n"
+                f"Использование: /summary 09:00 или /summary off\n"
+                f"Время — по твоему часовому поясу, в сводке закреплённые пары 📌"
+            )
+            return
+        
+        hour, minute = int(match.group(1)), int(match.group(2))
+        user_tz = data.get('timezone', 'Europe/Moscow')
+        if user_id in stats:
+            data['summary_time'] = f"{hour:02d}:{minute:02d}"
+            save_user_stats(stats)
+        self.summaries.schedule(user_id, hour, minute, user_tz)
+        
+        note = "" if data.get('pinned_pairs') else "\n\n📌 Закрепи пары через /pin — без них сводка не приходит"
+        await self.send_telegram_message(chat_id, f"✅ Сводка будет приходить в {hour:02d}:{minute:02d} ({TIMEZONES.get(user_tz, {}).get('name', user_tz)}){note}")
+    
+    def load_boards(self):
+        """Поднимает табло пользователей, у которых оно включено"""
+        for user_id, data in load_user_stats().items():
+            if data.get('board_message_id'):
+                self.boards[user_id] = {'message_id': data['board_message_id'], 'lines': None}
+    
+    def board_lines(self, pinned_pairs, rates, line_cache):
+        """Строки табло; форматированная строка пары считается один раз на тик"""
+        lines = []
+        for pair in pinned_pairs:
+            line = line_cache.get(pair)
+            if line is None:
+                price = rates.get(pair)
+                line = f"📌 {pair}: {self.format_price(pair, price) + self.freshness_note(pair) if price else '—'}"
+                line_cache[pair] = line
+            lines.append(line)
+        return tuple(lines)
+    
+    def render_board(self, lines, user_tz):
+        user_tz = user_tz if user_tz in TIMEZONES else 'Europe/Moscow'
+        changed_at = datetime.now(ZoneInfo(user_tz)).strftime('%H:%M:%S')
+        body = "\n".join(lines) if lines else "Закреплённых пар нет — закрепи их через /pin"
+        return BOARD_TEMPLATE.format(lines=body, time=changed_at)
+    
+    async def refresh_boards(self):
+        """Правит табло, у которых изменилось хотя бы одно округлённое значение"""
+        if not self.boards:
+            return
+        rates = self.snapshot_rates()
+        stats = load_user_stats()
+        line_cache = {}
+        edits = []
+        
+        for user_id, board in self.boards.items():
+            data = stats.get(user_id, {})
+            lines = self.board_lines(data.get('pinned_pairs', []), rates, line_cache)
+            if lines == board['lines']:
+                self.board_skipped += 1
+                continue
+            edits.append((user_id, board['message_id'], lines, self.render_board(lines, data.get('timezone'))))
+        
+        # Темп правок держит общий лимит Telegram, пачки просто ограничивают число задач
+        for i in range(0, len(edits), SUMMARY_SEND_BATCH):
+            batch = edits[i:i + SUMMARY_SEND_BATCH]
+            results = await asyncio.gather(*(self.edit_telegram_message(int(user_id), message_id, text, BOARD_KEYBOARD_JSON)
+                                             for user_id, message_id, _, text in batch))
+            for (user_id, message_id, lines, _), ok in zip(batch, results):
+                board = self.boards.get(user_id)
+                if ok:
+                    # Запоминаем показанное только после настоящего ответа 200,
+                    # иначе после 429 или сбоя сети табло не догонит цены
+                    if board is not None and board['message_id'] == message_id:
+                        board['lines'] = lines
+                    self.board_edits += 1
+                elif ok is False and board is not None and board['message_id'] == message_id:
+                    await self.stop_board(user_id)
+    
+    async def board_task(self, interval=BOARD_INTERVAL):
+        self.load_boards()
+        while True:
+            try:
+                await asyncio.sleep(interval)
+                await self.refresh_boards()
+            except Exception as e:
+                logger.error(f"Board task error: {e}")
+    
+    async def start_board(self, chat_id):
+        """Отправляет новое табло (старое перестаёт обновляться)"""
+        user_id = str(chat_id)
+        stats = load_user_stats()
+        data = stats.get(user_id, {})
+        lines = self.board_lines(data.get('pinned_pairs', []), self.snapshot_rates(), {})
+        message_id = await self.send_telegram_message_with_keyboard(
+            chat_id, self.render_board(lines, data.get('timezone')), BOARD_KEYBOARD_JSON
+        )
+        if message_id is None:
+            return
+        
+        self.boards[user_id] = {'message_id': message_id, 'lines': lines}
+        if user_id in stats:
+            stats[user_id]['board_message_id'] = message_id
+            save_user_stats(stats)
+    
+    async def stop_board(self, user_id):
+        self.boards.pop(user_id, None)
+        stats = load_user_stats()
+        if stats.get(user_id, {}).pop('board_message_id', None):
+            save_user_stats(stats)
+    
+    async def set_user_digest(self, chat_id, interval_key):
+        """Включает или выключает режим дайджеста уведомлений"""
+        user_id = str(chat_id)
+        stats = load_user_stats()
+        
+        if interval_key == 'off':
+            interval = 0
+        elif interval_key in DIGEST_INTERVALS:
+            interval = DIGEST_INTERVALS[interval_key]
+        else:
+            current = stats.get(user_id, {}).get('digest', 0)
+            mode = next((key for key, value in DIGEST_INTERVALS.items() if value == current), 'выключен')
+            await self.send_telegram_message(
+                chat_id,
+                f"📬 Дайджест алертов: <b>{mode}</b>\n\n"
+                f"Использование: /digest {'|'.join(DIGEST_INTERVALS)}|off"
+            )
+            return
+        
+        if user_id in stats:
+            stats[user_id]['digest'] = interval
+            save_user_stats(stats)
+        
+        # Накопленное при выключении отправим на ближайшем тике
+        pending = self.pending_notifications.get(user_id)
+        if pending and not interval:
+            pending['due'] = 0
+        
+        if interval:
+            await self.send_telegram_message(chat_id, f"✅ Дайджест включён: срабатывания приходят раз в {interval_key}")
+        else:
+            await self.send_telegram_message(chat_id, "✅ Дайджест выключен: уведомления приходят сразу")
         
     async def check_rates_task(self, interval=10):
         while True:
@@ -1668,6 +4747,8 @@ class CurrencyMonitor:
                 rates = await self.fetch_rates()
                 if rates:
                     notifications = await self.check_thresholds(rates)
+                    if self.alert_demand is not None:
+                        self.publish_alert_demand()
                     for chat_id, msg, keyboard in notifications:
                         if self.is_user_allowed(chat_id):
                             await self.send_telegram_message_with_keyboard(chat_id, msg, keyboard)
@@ -1688,6 +4769,341 @@ class CurrencyMonitor:
     async def health_check(self, request):
         return web.Response(text="OK")
     
+    def render_metrics(self):
+        """Метрики в текстовом формате Prometheus"""
+        lines = []
+        metrics = self.http_metrics
+        
+        lines.append("# TYPE bot_http_requests_total counter")
+        for host, count in sorted(metrics.requests.items()):
+            lines.append(f'bot_http_requests_total{{host="{host}"}} {count}')
+        lines.append("# TYPE bot_http_errors_total counter")
+        for host, count in sorted(metrics.errors.items()):
+            lines.append(f'bot_http_errors_total{{host="{host}"}} {count}')
+        
+        lines.append(f"bot_http_connections_created_total {metrics.connections_created}")
+        lines.append(f"bot_http_connections_reused_total {metrics.connections_reused}")
+        lines.append(f"bot_http_connections_queued_total {metrics.connections_queued}")
+        lines.append(f"bot_http_dns_cache_hits_total {metrics.dns_cache_hits}")
+        lines.append(f"bot_http_dns_cache_misses_total {metrics.dns_cache_misses}")
+        lines.append(f"bot_http_pool_limit {HTTP_POOL_LIMIT}")
+        lines.append(f"bot_http_pool_limit_per_host {HTTP_POOL_LIMIT_PER_HOST}")
+        
+        lines.append("# TYPE bot_provider_fetches_total counter")
+        for key, count in sorted(self.flights.started.items()):
+            lines.append(f'bot_provider_fetches_total{{provider="{key}"}} {count}')
+        lines.append("# TYPE bot_provider_fetches_coalesced_total counter")
+        for key, count in sorted(self.flights.joined.items()):
+            lines.append(f'bot_provider_fetches_coalesced_total{{provider="{key}"}} {count}')
+        
+        lines.append("# TYPE bot_quote_source_deviation gauge")
+        for (instrument, source), deviation in sorted(self.consensus_deviation.items()):
+            lines.append(f'bot_quote_source_deviation{{instrument="{instrument}",source="{source}"}} {deviation:.6f}')
+        lines.append("# TYPE bot_quote_source_rejected_total counter")
+        for (instrument, source), count in sorted(self.consensus_rejected.items()):
+            lines.append(f'bot_quote_source_rejected_total{{instrument="{instrument}",source="{source}"}} {count}')
+        lines.append("# TYPE bot_quote_source_errors_total counter")
+        for (instrument, source), count in sorted(self.consensus_errors.items()):
+            lines.append(f'bot_quote_source_errors_total{{instrument="{instrument}",source="{source}"}} {count}')
+        
+        lines.append("# TYPE bot_hedge_requests_total counter")
+        for provider, count in sorted(self.hedger.requests.items()):
+            lines.append(f'bot_hedge_requests_total{{provider="{provider}"}} {count}')
+            lines.append(f'bot_hedge_sent_total{{provider="{provider}"}} {self.hedger.hedges[provider]}')
+            lines.append(f'bot_hedge_wins_total{{provider="{provider}"}} {self.hedger.hedge_wins[provider]}')
+            lines.append(f'bot_hedge_delay_seconds{{provider="{provider}"}} {self.hedger.delay(provider):.3f}')
+        
+        now = time.time()
+        lines.append("# TYPE bot_quote_age_seconds gauge")
+        for pair, quote in sorted(self.quotes.quotes.items()):
+            age = quote.age(now)
+            value = f"{age:.1f}" if age != math.inf else "+Inf"
+            lines.append(f'bot_quote_age_seconds{{pair="{pair}",source="{quote.source}"}} {value}')
+        lines.append(f"bot_quotes_stale {len(self.quotes.stale_pairs(now))}")
+        
+        budget = self.twelvedata_budget
+        lines.append(f"bot_twelvedata_credits_available {budget.available():.2f}")
+        lines.append(f"bot_twelvedata_credits_used_today {budget.used_today}")
+        lines.append(f"bot_twelvedata_credits_daily {budget.daily}")
+        lines.append(f"bot_twelvedata_requests_denied_total {budget.denied}")
+        lines.append(f"bot_twelvedata_market_open {int(budget.is_market_open())}")
+        
+        aggregates = stats_aggregates
+        lines.append(f"bot_users_total {aggregates.users}")
+        lines.append(f"bot_user_interactions_total {aggregates.interactions}")
+        lines.append(f"bot_alerts_created_total {aggregates.alerts_created}")
+        lines.append(f"bot_alerts_triggered_total {aggregates.alerts_triggered}")
+        lines.append(f"bot_alerts_stored {len(user_alerts)}")
+        for rank, card in enumerate(aggregates.leaders(), 1):
+            lines.append(f'bot_top_user_interactions{{rank="{rank}"}} {card["interactions"]}')
+        for pair, count in aggregates.popular_pairs():
+            lines.append(f'bot_pair_interest{{pair="{pair}"}} {count}')
+        
+        lines.append(f"bot_notifications_sent_total {self.notifications_sent}")
+        lines.append(f"bot_notifications_pending {sum(len(p['items']) for p in self.pending_notifications.values())}")
+        
+        lines.append(f"bot_summary_jobs {len(self.summaries.jobs)}")
+        lines.append(f"bot_summaries_sent_total {self.summaries_sent}")
+        lines.append(f"bot_telegram_throttle_waits_total {self.telegram_throttle.waits}")
+        
+        lines.append(f"bot_inline_queries_total {self.inline_queries}")
+        lines.append(f"bot_inline_cache_hits_total {self.inline_cache_hits}")
+        
+        lines.append(f"bot_boards_active {len(self.boards)}")
+        lines.append(f"bot_board_edits_total {self.board_edits}")
+        lines.append(f"bot_board_unchanged_total {self.board_skipped}")
+        
+        lines.append(f"bot_rates_api_requests_total {self.rates_api_requests}")
+        lines.append(f"bot_rates_api_not_modified_total {self.rates_api_not_modified}")
+        
+        lines.append(f"bot_stream_clients {len(self.stream.subscribers)}")
+        lines.append(f"bot_stream_events_total {self.stream.published}")
+        lines.append(f"bot_stream_dropped_clients_total {self.stream.dropped}")
+        
+        lines.append(f"bot_http_cache_hits_total {self.http_cache.hits}")
+        lines.append(f"bot_http_cache_revalidated_total {self.http_cache.revalidated}")
+        lines.append(f"bot_http_cache_misses_total {self.http_cache.misses}")
+        
+        return "\n".join(lines) + "\n"
+    
+    async def metrics_handler(self, request):
+        return web.Response(text=self.render_metrics(), content_type='text/plain')
+    
+    def quote_entry(self, pair, cross_rate=None):
+        """Описание котировки для JSON API и потока (кросс-курс — из таблицы фиата)"""
+        quote = self.quotes.get(pair)
+        if quote is not None:
+            return {
+                'pair': pair,
+                'price': quote.value,
+                'source': quote.source,
+                'fetched_at': quote.fetched_at or None,
+                'provider_ts': quote.provider_ts,
+                'max_age': self.quotes.max_age(pair),
+            }
+        rate = cross_rate if cross_rate is not None else self.cross_rates.rate(pair)
+        if rate is None:
+            return None
+        return {
+            'pair': pair,
+            'price': rate,
+            'source': 'cross',
+            'fetched_at': self.cross_rates.updated_at,
+            'provider_ts': None,
+            'max_age': FX_TABLE_MAX_AGE,
+        }
+    
+    def stream_changes(self):
+        """Котировки, изменившиеся с последней публикации в поток"""
+        last = self.stream.last
+        changes = {}
+        for pair, quote in self.quotes.quotes.items():
+            state = (quote.value, quote.fetched_at)
+            if last.get(pair) != state:
+                last[pair] = state
+                changes[pair] = self.quote_entry(pair)
+        
+        # Кросс-курсы считаем, только если на них кто-то подписан
+        crosses = [pair for pair in self.stream.by_pair if pair not in self.quotes]
+        if crosses:
+            for pair, rate in self.cross_rates.rates_for(crosses).items():
+                state = (rate, self.cross_rates.updated_at)
+                if last.get(pair) != state:
+                    last[pair] = state
+                    changes[pair] = self.quote_entry(pair, rate)
+        return changes
+    
+    async def stream_task(self):
+        """Публикует изменения котировок в поток, как только они появились"""
+        while True:
+            try:
+                try:
+                    await asyncio.wait_for(self.stream.wake.wait(), STREAM_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                self.stream.wake.clear()
+                if self.stream.subscribers:
+                    self.flush_stream()
+            except Exception as e:
+                logger.error(f"Stream task error: {e}")
+    
+    def flush_stream(self):
+        """Публикует накопившиеся изменения котировок подписчикам"""
+        # Во фронт-процессе котировки приходят только через общую память
+        if self.shared_rates is not None and self.shared_rates.seq() != self.shared_rates.last_seq:
+            self.read_shared_rates()
+        changes = self.stream_changes()
+        if changes:
+            self.stream.publish(changes)
+    
+    def stream_filter(self, request):
+        """Пары из ?pairs=btc,EUR/USD; None — без фильтра; ValueError — неизвестная пара"""
+        raw = request.query.get('pairs', '').strip()
+        if not raw:
+            return None
+        pairs = set()
+        for name in raw.split(','):
+            pair = self.resolve_pair(name)
+            if pair is None:
+                raise ValueError(name)
+            pairs.add(pair)
+        return frozenset(pairs)
+    
+    def stream_subscribe(self, request):
+        """Подписка для SSE/WebSocket или готовый ответ с ошибкой"""
+        if len(self.stream.subscribers) >= STREAM_MAX_CLIENTS:
+            return None, web.json_response({'error': 'too many clients'}, status=503)
+        try:
+            pairs = self.stream_filter(request)
+        except ValueError as e:
+            return None, web.json_response({'error': 'unknown pair', 'pair': str(e)}, status=400)
+        # Сначала раздаём накопившееся старым подписчикам: тогда stream.last совпадает
+        # со стартовым кадром нового, и первый тик не повторит его целиком
+        self.flush_stream()
+        subscriber = self.stream.subscribe(pairs)
+        subscriber.transport = request.transport
+        return subscriber, None
+    
+    def stream_snapshot(self, pairs):
+        """Стартовый кадр: текущие значения отфильтрованных пар"""
+        names = pairs if pairs else self.quotes.quotes.keys()
+        entries = {pair: self.quote_entry(pair) for pair in names}
+        for pair, entry in entries.items():
+            # Котировки уже отмечены в flush_stream, кросс-курсы — только здесь
+            if entry and pair not in self.quotes:
+                self.stream.last[pair] = (entry['price'], self.cross_rates.updated_at)
+        return PriceStream.frame('snapshot', {pair: entry for pair, entry in entries.items() if entry})
+    
+    async def stream_handler(self, request):
+        """Server-Sent Events: /stream?pairs=btc,EUR/USD"""
+        subscriber, error = self.stream_subscribe(request)
+        if error is not None:
+            return error
+        
+        response = web.StreamResponse(headers={
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+        })
+        try:
+            await response.prepare(request)
+            await response.write(self.stream_snapshot(subscriber.pairs)[1])
+            while True:
+                try:
+                    frame = await asyncio.wait_for(subscriber.queue.get(), STREAM_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    await response.write(b": ping\n\n")
+                    continue
+                if frame is None:
+                    # Отстал и был отключён — клиент переподключится сам
+                    break
+                await response.write(frame[1])
+        except (ConnectionResetError, ConnectionError):
+            pass
+        finally:
+            self.stream.unsubscribe(subscriber)
+        return response
+    
+    async def stream_ws_handler(self, request):
+        """WebSocket-вариант того же потока: /stream/ws?pairs=..."""
+        subscriber, error = self.stream_subscribe(request)
+        if error is not None:
+            return error
+        
+        ws = web.WebSocketResponse(heartbeat=STREAM_HEARTBEAT)
+        
+        async def writer():
+            await ws.send_str(self.stream_snapshot(subscriber.pairs)[0])
+            while True:
+                frame = await subscriber.queue.get()
+                if frame is None:
+                    await ws.close(code=aiohttp.WSCloseCode.TRY_AGAIN_LATER, message=b'slow consumer')
+                    return
+                await ws.send_str(frame[0])
+        
+        sender = None
+        try:
+            await ws.prepare(request)
+            sender = asyncio.create_task(writer())
+            # Ошибки отправки закрывают соединение; результат забираем, чтобы не было предупреждений
+            sender.add_done_callback(lambda task: task.cancelled() or task.exception())
+            # Клиент ничего не присылает; чтение нужно, чтобы заметить закрытие соединения
+            async for _ in ws:
+                pass
+        except (ConnectionResetError, ConnectionError):
+            pass
+        finally:
+            if sender is not None:
+                sender.cancel()
+            self.stream.unsubscribe(subscriber)
+        return ws
+    
+    def rates_api_document(self):
+        """JSON-тела /rates и /rates/{pair}; пересобираются, только когда изменились котировки"""
+        # Во фронт-процессе курсы никто не опрашивает — подтягиваем их из общей памяти по seq
+        if self.shared_rates is not None and self.shared_rates.seq() != self.shared_rates.last_seq:
+            self.read_shared_rates()
+        
+        # Версия содержимого и время публикации таблицы фиата, а не время опроса
+        key = (self.quotes.version, self.cross_rates.version, self.cross_rates.updated_at)
+        document = self.rates_api
+        if document is not None and document['key'] == key:
+            return document
+        
+        def encode(data):
+            body = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            return f'"{zlib.crc32(body):08x}-{len(body)}"', body
+        
+        entries = {pair: self.quote_entry(pair) for pair in self.quotes.quotes}
+        
+        etag, body = encode({
+            'updated_at': max((entry['fetched_at'] or 0 for entry in entries.values()), default=0) or None,
+            'rates': entries,
+            'fiat_per_usd': self.cross_rates.as_dict(),
+        })
+        self.rates_api = {
+            'key': key,
+            'etag': etag,
+            'body': body,
+            'pairs': {pair: encode(entry) for pair, entry in entries.items()},
+            'encode': encode,
+        }
+        return self.rates_api
+    
+    def json_response(self, request, etag, body):
+        """Ответ с ETag и Cache-Control; совпавший If-None-Match — пустой 304"""
+        headers = {'ETag': etag, 'Cache-Control': f"public, max-age={RATES_API_MAX_AGE}"}
+        if_none_match = request.headers.get('If-None-Match', '')
+        if if_none_match:
+            tags = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+            if etag in tags or '*' in tags:
+                self.rates_api_not_modified += 1
+                return web.Response(status=304, headers=headers)
+        return web.Response(body=body, content_type='application/json', charset='utf-8', headers=headers)
+    
+    async def rates_handler(self, request):
+        self.rates_api_requests += 1
+        document = self.rates_api_document()
+        return self.json_response(request, document['etag'], document['body'])
+    
+    async def pair_rate_handler(self, request):
+        self.rates_api_requests += 1
+        document = self.rates_api_document()
+        pair = self.resolve_pair(request.match_info['pair'])
+        
+        cached = document['pairs'].get(pair)
+        if cached is None and pair is not None:
+            # Кросс-курс: считаем и кладём в тела этой же версии котировок
+            entry = self.quote_entry(pair)
+            if entry is not None:
+                cached = document['encode'](entry)
+                if len(document['pairs']) < RATES_API_MAX_PAIRS:
+                    document['pairs'][pair] = cached
+        
+        if cached is None:
+            return web.json_response({'error': 'unknown pair', 'pair': request.match_info['pair']}, status=404)
+        return self.json_response(request, *cached)
+    
     async def self_ping_task(self):
         while True:
             try:
@@ -1697,19 +5113,67 @@ class CurrencyMonitor:
                 if not render_url:
                     render_url = "http://localhost:8080"
                 
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(f"{render_url}/health", timeout=30) as response:
-                        if response.status == 200:
-                            logger.info("✅ Самопинг успешен")
-                        else:
-                            logger.warning(f"⚠️ Самопинг вернул {response.status}")
+                session = await self.get_session()
+                async with session.get(f"{render_url}/health", timeout=HTTP_TIMEOUTS['ping']) as response:
+                    if response.status == 200:
+                        logger.info("✅ Самопинг успешен")
+                    else:
+                        logger.warning(f"⚠️ Самопинг вернул {response.status}")
             except asyncio.CancelledError:
                 break
             except Exception as e:
                 logger.error(f"❌ Ошибка самопинга: {e}")
                 continue
     
+    async def run_shard(self, conn):
+        """Цикл процесса-шарда: апдейты приходят от фронта, алерты проверяются локально"""
+        logger.info(f"🧩 Шард {self.shard_id} запущен (PID {os.getpid()})")
+        loop = asyncio.get_running_loop()
+        updates = asyncio.Queue()
+        
+        def on_readable():
+            try:
+                while conn.poll():
+                    updates.put_nowait(conn.recv())
+            except (EOFError, OSError):
+                loop.remove_reader(conn.fileno())
+                updates.put_nowait(None)
+        
+        async def handle_updates():
+            # Обрабатываем по одному, как и при обычном опросе
+            while True:
+                update = await updates.get()
+                if update is None:
+                    logger.info(f"⏹ Шард {self.shard_id}: фронт закрыл соединение")
+                    return
+                try:
+                    await self.process_update(update)
+                except Exception as e:
+                    logger.error(f"Shard {self.shard_id} update error: {e}")
+        
+        loop.add_reader(conn.fileno(), on_readable)
+        background = [
+            asyncio.create_task(self.check_rates_task(interval=FETCH_INTERVAL)),
+            asyncio.create_task(self.summary_task()),
+            asyncio.create_task(self.board_task()),
+            asyncio.create_task(self.runtime_snapshot_task())
+        ]
+        try:
+            await handle_updates()
+        finally:
+            for task in background:
+                task.cancel()
+            self.save_snapshot()
+            if self.session:
+                await self.session.close()
+            if self.chart_pool:
+                self.chart_pool.shutdown(wait=False, cancel_futures=True)
+    
     async def run(self):
+        mark_startup("инициализация монитора")
+        # Во фронте шардов пользователей обслуживают шарды — там и загружаются их данные
+        if not self.shard_conns:
+            load_user_state()
         mode = "ОТКРЫТЫЙ" if not PRIVATE_MODE else "ПРИВАТНЫЙ"
         logger.info(f"🚀 ЗАПУСК БОТА [{mode} РЕЖИМ]")
         logger.info(f"⚡️ Проверка: каждые 10 секунд")
@@ -1725,12 +5189,17 @@ class CurrencyMonitor:
         logger.info(f"✅ В меню часовых поясов галочка у выбранного")
         logger.info(f"🌞❄️🌸🍂 Сезонные слоганы: лето, зима, весна, осень")
         if YFINANCE_AVAILABLE:
-            logger.info(f"📈 Индексы и нефть: yfinance доступен")
+            logger.info(f"📈 Индексы и нефть: yfinance доступен (фоновая загрузка)")
         else:
             logger.info(f"📈 Индексы и нефть: yfinance не установлен, используются другие источники")
         
         app = web.Application()
         app.router.add_get('/health', self.health_check)
+        app.router.add_get('/metrics', self.metrics_handler)
+        app.router.add_get('/rates', self.rates_handler)
+        app.router.add_get('/rates/{pair:.+}', self.pair_rate_handler)
+        app.router.add_get('/stream', self.stream_handler)
+        app.router.add_get('/stream/ws', self.stream_ws_handler)
         
         port = int(os.environ.get('PORT', 8080))
         
@@ -1739,23 +5208,95 @@ class CurrencyMonitor:
         site = web.TCPSite(runner, '0.0.0.0', port)
         await site.start()
         logger.info(f"🌐 Веб-сервер для пинга запущен на порту {port}")
+        mark_startup("веб-сервер")
+        
+        tasks = [
+            asyncio.create_task(self.check_commands_task(interval=2)),
+            asyncio.create_task(self.self_ping_task()),
+            asyncio.create_task(self.stream_task()),
+            asyncio.create_task(self.runtime_snapshot_task())
+        ]
+        # Во фронт-процессе алерты проверяют шарды
+        if not self.shard_conns:
+            tasks.append(asyncio.create_task(self.check_rates_task(interval=10)))
+            tasks.append(asyncio.create_task(self.summary_task()))
+            tasks.append(asyncio.create_task(self.board_task()))
+        mark_startup("запуск опроса")
+        log_startup_timings()
+        
+        # Провайдеров опрашивает этот процесс — догружаем их зависимости в фоне
+        if self.shared_rates is None:
+            start_background_imports()
         
         try:
-            await asyncio.gather(
-                self.check_rates_task(interval=10),
-                self.check_commands_task(interval=2),
-                self.self_ping_task()
-            )
+            await asyncio.gather(*tasks)
         except KeyboardInterrupt:
             logger.info("⏹ Остановлено")
         finally:
+            self.save_snapshot()
             await runner.cleanup()
             if self.session:
                 await self.session.close()
+            if self.chart_pool:
+                self.chart_pool.shutdown(wait=False, cancel_futures=True)
 
 async def main():
-    monitor = CurrencyMonitor()
-    await monitor.run()
+    sharded = SHARD_COUNT > 1
+    if not SPLIT_MODE and not sharded:
+        monitor = CurrencyMonitor()
+        await monitor.run()
+        return
+    
+    # Раздельный режим: фетчер в своём процессе, бот читает снимки из общей памяти
+    context = multiprocessing.get_context('spawn')
+    shared = SharedRates.create(RATES_SHM_NAME)
+    # Алерты держат шарды (или главный процесс без шардов) — каждому своя строка спроса
+    demand_writers = SHARD_COUNT if sharded else 1
+    demand = AlertDemand.create(DEMAND_SHM_NAME, demand_writers)
+    processes = []
+    fetcher = context.Process(
+        target=run_fetcher_process,
+        args=(RATES_SHM_NAME, FETCH_INTERVAL, demand_writers),
+        name='rates-fetcher',
+        daemon=True
+    )
+    fetcher.start()
+    processes.append(fetcher)
+    logger.info(f"🔀 Раздельный режим: фетчер PID {fetcher.pid}")
+    
+    # Шарды: каждый процесс владеет своей частью пользователей
+    shard_conns = []
+    if sharded:
+        for shard_id in range(SHARD_COUNT):
+            recv_conn, send_conn = context.Pipe(duplex=False)
+            worker = context.Process(
+                target=run_shard_worker,
+                args=(shard_id, SHARD_COUNT, recv_conn, RATES_SHM_NAME),
+                name=f'shard-{shard_id}',
+                # Не daemon: шарду нужен собственный пул рендера графиков,
+                # а демонам запрещено порождать процессы. Остановку делает finally ниже
+                daemon=False
+            )
+            worker.start()
+            recv_conn.close()
+            shard_conns.append(send_conn)
+            processes.append(worker)
+        logger.info(f"🧩 Запущено шардов: {SHARD_COUNT}")
+    
+    try:
+        monitor = CurrencyMonitor(shared_rates=SharedRates.attach(RATES_SHM_NAME))
+        monitor.shard_conns = shard_conns
+        if not sharded:
+            monitor.alert_demand = AlertDemand.attach(writers=1, slot=0)
+        await monitor.run()
+    finally:
+        for conn in shard_conns:
+            conn.close()
+        for process in processes:
+            process.terminate()
+            process.join(timeout=5)
+        shared.close()
+        demand.close()
 
 if __name__ == "__main__":
     try: